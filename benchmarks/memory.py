@@ -0,0 +1,121 @@
+#encoding=utf-8
+"""Reports the memory held per object by the transport classes.
+
+Sizes are measured with sys.getsizeof over each object and everything it
+owns (its __dict__ if any, slot values and container contents); data
+shared between objects, such as DSDL types, per-type layouts and attribute
+names, is not counted.
+
+Usage: python benchmarks/memory.py
+"""
+
+import sys
+import types
+import collections
+
+from uavcan import transport
+from uavcan.dsdl import parser
+
+
+SHARED_TYPES = (
+    type(None), bool, int, long, float, types.FunctionType,
+    types.MethodType, types.BuiltinFunctionType, parser.Type,
+    transport.FieldLayout
+)
+
+
+def slot_names(cls):
+    for klass in cls.__mro__:
+        for name in klass.__dict__.get("__slots__", ()):
+            if name.startswith("__") and not name.endswith("__"):
+                name = "_" + klass.__name__.lstrip("_") + name
+            yield name
+
+
+def deep_size(obj, seen=None):
+    if seen is None:
+        seen = set()
+    if id(obj) in seen or isinstance(obj, SHARED_TYPES) or \
+            isinstance(obj, types.InstanceType):
+        return 0
+    seen.add(id(obj))
+
+    size = sys.getsizeof(obj)
+    if isinstance(obj, dict):
+        for key, value in obj.iteritems():
+            size += deep_size(key, seen) + deep_size(value, seen)
+    elif isinstance(obj, (list, tuple, set, frozenset)):
+        for item in obj:
+            size += deep_size(item, seen)
+    elif isinstance(obj, (str, unicode, bytearray)):
+        pass
+    else:
+        if hasattr(obj, "__dict__"):
+            # Attribute names are interned strings shared by every instance
+            size += sys.getsizeof(obj.__dict__)
+            for value in obj.__dict__.itervalues():
+                size += deep_size(value, seen)
+        for name in slot_names(type(obj)):
+            if hasattr(obj, name):
+                size += deep_size(getattr(obj, name), seen)
+    return size
+
+
+def primitive(kind, bitlen):
+    return parser.PrimitiveType(kind, bitlen,
+                                parser.PrimitiveType.CAST_MODE_SATURATED)
+
+
+def make_type():
+    # Shaped like uavcan.protocol.NodeStatus plus a short byte array
+    compound_type = parser.CompoundType("BenchmarkType",
+                                        parser.CompoundType.KIND_MESSAGE,
+                                        "benchmark.uavcan", 0, "")
+    compound_type.fields = [
+        parser.Field(
+            primitive(parser.PrimitiveType.KIND_UNSIGNED_INT, 28),
+            "uptime_sec"),
+        parser.Field(
+            primitive(parser.PrimitiveType.KIND_UNSIGNED_INT, 4),
+            "status_code"),
+        parser.Field(
+            primitive(parser.PrimitiveType.KIND_UNSIGNED_INT, 16),
+            "vendor_specific_status_code"),
+        parser.Field(
+            parser.ArrayType(
+                primitive(parser.PrimitiveType.KIND_UNSIGNED_INT, 8),
+                parser.ArrayType.MODE_DYNAMIC, 16),
+            "name")
+    ]
+    # Normally filled in when the DSDL definitions are loaded
+    compound_type.base_crc = 0xFFFF
+    return compound_type
+
+
+def main():
+    compound_type = make_type()
+    value = transport.CompoundValue(compound_type)
+    value.uptime_sec = 12345
+    value.status_code = 1
+    value.name.from_bytes(b"node")
+
+    samples = collections.OrderedDict([
+        ("Frame", transport.Frame(0x1234, b"\x01\x02\x03\x04\x05\x06\xC0")),
+        ("Transfer", transport.Transfer(transfer_id=1, source_node_id=10,
+                                        payload=value)),
+        ("PrimitiveValue", value.fields["uptime_sec"]),
+        ("ArrayValue (uint8[<=16], 4 items)", value.name),
+        ("CompoundValue (4 fields)", value),
+    ])
+
+    for name, obj in samples.iteritems():
+        print("{0:<36} {1:6d} bytes".format(name, deep_size(obj)))
+
+    frames = 100000
+    frame_bytes = deep_size(samples["Frame"])
+    print("{0:d} frames: {1:.1f} MiB".format(
+          frames, frames * frame_bytes / (1024.0 * 1024.0)))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,70 @@
+#encoding=utf-8
+"""Compares the CRC-64-WE (DSDL signature) and transfer CRC-16
+implementations against bit-by-bit reference versions.
+
+Usage: python benchmarks/signature.py [size in bytes]
+"""
+
+import os
+import sys
+import timeit
+
+from uavcan.dsdl import common, signature
+
+
+MASK64 = 0xFFFFFFFFFFFFFFFF
+
+
+def reference_signature(data):
+    # The original one-bit-at-a-time implementation
+    crc = MASK64
+    for b in bytearray(data):
+        crc ^= (b << 56) & MASK64
+        for _ in range(8):
+            if crc & (1 << 63):
+                crc = ((crc << 1) & MASK64) ^ signature.Signature.POLY
+            else:
+                crc <<= 1
+    return (crc & MASK64) ^ MASK64
+
+
+def reference_crc16(data):
+    crc = 0xFFFF
+    for b in bytearray(data):
+        crc ^= b << 8
+        for _ in range(8):
+            if crc & 0x8000:
+                crc = ((crc << 1) ^ 0x1021) & 0xFFFF
+            else:
+                crc = (crc << 1) & 0xFFFF
+    return crc
+
+
+def measure(name, fn, data, repeat=3):
+    assert fn(data) is not None
+    seconds = min(timeit.repeat(lambda: fn(data), number=1, repeat=repeat))
+    print("{0:<28} {1:10.3f} ms {2:10.2f} MiB/s".format(
+          name, seconds * 1000.0, len(data) / seconds / (1024.0 * 1024.0)))
+    return seconds
+
+
+def main():
+    size = int(sys.argv[1]) if len(sys.argv) > 1 else 1024 * 1024
+    data = os.urandom(size)
+    print("{0:d} bytes".format(size))
+
+    assert reference_signature(data[0:4096]) == \
+        signature.compute_signature(data[0:4096])
+    assert reference_crc16(data[0:4096]) == \
+        common.crc16_from_bytes(data[0:4096])
+
+    measure("CRC-64 bitwise", reference_signature, data, repeat=1)
+    measure("CRC-64 slice-by-8", signature.compute_signature, data)
+    measure("CRC-16 bitwise", reference_crc16, data, repeat=1)
+    measure("CRC-16 table",
+            lambda d: common.crc16_update_table(0xFFFF, d), data)
+    measure("CRC-16 crc16_from_bytes", common.crc16_from_bytes, data)
+
+
+if __name__ == "__main__":
+    main()
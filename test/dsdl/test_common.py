@@ -15,6 +15,42 @@ class TestCRC16FromBytes(unittest.TestCase):
             common.crc16_from_bytes(bytearray('123456789', 'utf-8')),
             0x29B1)
 
+    def test_memoryview(self):
+        data = bytearray(b'xx123456789')
+        self.assertEqual(common.crc16_from_bytes(memoryview(data)[2:]),
+                         0x29B1)
+
+    def test_integer_sequence(self):
+        self.assertEqual(
+            common.crc16_from_bytes([ord(c) for c in '123456789']), 0x29B1)
+
+
+class TestCRC16(unittest.TestCase):
+    def test_incremental(self):
+        crc = common.CRC16()
+        crc.add(b'123')
+        crc.add(bytearray(b'456'))
+        crc.add('789')
+        self.assertEqual(crc.get_value(), 0x29B1)
+
+    def test_initial(self):
+        crc = common.CRC16(common.crc16_from_bytes(b'1234'))
+        crc.add(b'56789')
+        self.assertEqual(crc.get_value(), 0x29B1)
+
+    def test_table_matches_bitwise(self):
+        data = bytearray(range(256)) * 3
+        crc = 0xFFFF
+        for byte in data:
+            crc ^= byte << 8
+            for bit in range(8):
+                if crc & 0x8000:
+                    crc = ((crc << 1) ^ 0x1021) & 0xFFFF
+                else:
+                    crc = (crc << 1) & 0xFFFF
+        self.assertEqual(common.crc16_update_table(0xFFFF, data), crc)
+        self.assertEqual(common.crc16_update(0xFFFF, data), crc)
+
 
 class TestBytesFromCRC64(unittest.TestCase):
     def test_zero(self):
@@ -1,8 +1,74 @@
 import unittest
-from uavcan.dsdl import parser
+from uavcan.dsdl import common, parser
 
 
-# TODO once module structure is clearer
+def primitive(kind, bitlen):
+    return parser.PrimitiveType(kind, bitlen,
+                                parser.PrimitiveType.CAST_MODE_SATURATED)
+
+
+class TestCompoundTypeSignature(unittest.TestCase):
+    def setUp(self):
+        self.inner_type = parser.CompoundType(
+            "source.InnerType",
+            parser.CompoundType.KIND_MESSAGE,
+            "source.uavcan",
+            None,
+            ""
+        )
+        self.inner_type.fields = [
+            parser.Field(
+                primitive(parser.PrimitiveType.KIND_UNSIGNED_INT, 8), "a")
+        ]
+        self.outer_type = parser.CompoundType(
+            "source.OuterType",
+            parser.CompoundType.KIND_MESSAGE,
+            "source.uavcan",
+            None,
+            ""
+        )
+        self.outer_type.fields = [
+            parser.Field(self.inner_type, "inner"),
+            parser.Field(
+                primitive(parser.PrimitiveType.KIND_BOOLEAN, 1), "b")
+        ]
+
+    def test_cached(self):
+        definition = self.outer_type.get_dsdl_signature_source_definition()
+        self.assertEqual(definition,
+                         "source.OuterType\nsource.InnerType inner\n" +
+                         "saturated bool b")
+        self.assertIs(
+            self.outer_type.get_dsdl_signature_source_definition(),
+            definition)
+        self.assertEqual(self.outer_type.get_data_type_signature(),
+                         self.outer_type._compute_data_type_signature())
+
+    def test_base_crc(self):
+        signature = self.outer_type.get_data_type_signature()
+        self.assertEqual(
+            self.outer_type.base_crc,
+            common.crc16_from_bytes(common.bytes_from_crc64(signature)))
+
+        self.outer_type.base_crc = 0x1234
+        self.assertEqual(self.outer_type.base_crc, 0x1234)
+
+    def test_invalidated_by_nested_type(self):
+        signature = self.outer_type.get_data_type_signature()
+        base_crc = self.outer_type.base_crc
+        self.inner_type.fields = [
+            parser.Field(
+                primitive(parser.PrimitiveType.KIND_UNSIGNED_INT, 16), "a")
+        ]
+        self.assertNotEqual(self.outer_type.get_data_type_signature(),
+                            signature)
+        self.assertEqual(self.outer_type.get_data_type_signature(),
+                         self.outer_type._compute_data_type_signature())
+        self.assertNotEqual(self.outer_type.base_crc, base_crc)
+
+    def test_missing_attribute(self):
+        self.assertRaises(AttributeError, getattr, self.outer_type,
+                          "_layouts")
 
 
 if __name__ == '__main__':
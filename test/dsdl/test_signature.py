@@ -1,7 +1,22 @@
+import io
+import random
 import unittest
 from uavcan.dsdl import signature
 
 
+def bitwise_signature(data):
+    mask = signature.Signature.MASK64
+    crc = mask
+    for b in bytearray(data):
+        crc ^= b << 56
+        for _ in range(8):
+            if crc & (1 << 63):
+                crc = ((crc << 1) & mask) ^ signature.Signature.POLY
+            else:
+                crc = (crc << 1) & mask
+    return crc ^ mask
+
+
 class TestSignature(unittest.TestCase):
     def test_add(self):
         s = signature.Signature()
@@ -24,6 +39,33 @@ class TestSignature(unittest.TestCase):
         s.add(bytearray('123456789', 'utf-8'))
         self.assertEqual(s.get_value(), 0x62EC59E3F1A4F00A)
 
+    def test_add_memoryview(self):
+        s = signature.Signature()
+        s.add(memoryview(bytearray(b'x123456789'))[1:])
+        self.assertEqual(s.get_value(), 0x62EC59E3F1A4F00A)
+
+    def test_add_chunks(self):
+        rng = random.Random(1)
+        data = bytearray(rng.randint(0, 255) for _ in range(5000))
+        expected = bitwise_signature(data)
+        for chunk_size in (1, 3, 8, 13, 4096):
+            s = signature.Signature()
+            for offset in range(0, len(data), chunk_size):
+                s.add(data[offset:offset + chunk_size])
+            self.assertEqual(s.get_value(), expected)
+
+    def test_add_file(self):
+        data = bytes(bytearray(range(256))) * 40
+        s = signature.Signature()
+        self.assertEqual(s.add_file(io.BytesIO(data), chunk_size=1000),
+                         len(data))
+        self.assertEqual(s.get_value(), bitwise_signature(data))
+
+    def test_extend_from(self):
+        s = signature.Signature(signature.compute_signature(b'1234'))
+        s.add(b'56789')
+        self.assertEqual(s.get_value(), 0x62EC59E3F1A4F00A)
+
 
 class TestComputeSignature(unittest.TestCase):
     def test_str(self):
@@ -0,0 +1,248 @@
+import math
+import random
+import unittest
+from uavcan import batch, transport
+from uavcan.dsdl import parser
+
+
+def primitive(kind, bitlen):
+    return parser.PrimitiveType(kind, bitlen,
+                                parser.PrimitiveType.CAST_MODE_SATURATED)
+
+
+class BatchTestCase(unittest.TestCase):
+    def setUp(self):
+        self.inner_type = parser.CompoundType(
+            "InnerType",
+            parser.CompoundType.KIND_MESSAGE,
+            "source.uavcan",
+            None,
+            ""
+        )
+        self.inner_type.fields = [
+            parser.Field(
+                primitive(parser.PrimitiveType.KIND_SIGNED_INT, 5), "x"),
+            parser.Field(
+                primitive(parser.PrimitiveType.KIND_BOOLEAN, 1), "y")
+        ]
+        self.custom_type = parser.CompoundType(
+            "CustomType",
+            parser.CompoundType.KIND_MESSAGE,
+            "source.uavcan",
+            None,
+            ""
+        )
+        self.custom_type.fields = [
+            parser.Field(
+                primitive(parser.PrimitiveType.KIND_UNSIGNED_INT, 32), "a"),
+            parser.Field(
+                primitive(parser.PrimitiveType.KIND_SIGNED_INT, 13), "b"),
+            parser.Field(self.inner_type, "inner"),
+            parser.Field(
+                primitive(parser.PrimitiveType.KIND_FLOAT, 16), "c"),
+            parser.Field(
+                parser.ArrayType(
+                    primitive(parser.PrimitiveType.KIND_UNSIGNED_INT, 12),
+                    parser.ArrayType.MODE_STATIC,
+                    3
+                ),
+                "d"
+            ),
+            parser.Field(
+                primitive(parser.PrimitiveType.KIND_SIGNED_INT, 64), "e"),
+            parser.Field(
+                parser.ArrayType(
+                    primitive(parser.PrimitiveType.KIND_UNSIGNED_INT, 8),
+                    parser.ArrayType.MODE_DYNAMIC,
+                    8
+                ),
+                "f"
+            ),
+            parser.Field(
+                primitive(parser.PrimitiveType.KIND_FLOAT, 32), "g"),
+            parser.Field(
+                parser.ArrayType(
+                    primitive(parser.PrimitiveType.KIND_SIGNED_INT, 16),
+                    parser.ArrayType.MODE_DYNAMIC,
+                    4
+                ),
+                "h"
+            )
+        ]
+
+        rng = random.Random(1)
+        self.values = []
+        self.payloads = []
+        for i in xrange(50):
+            value = transport.CompoundValue(self.custom_type, tao=True)
+            value.a = rng.randint(0, 0xFFFFFFFF)
+            value.b = rng.randint(-4096, 4095)
+            value.inner.x = rng.randint(-16, 15)
+            value.inner.y = rng.randint(0, 1)
+            value.c = rng.choice([0.0, 1.5, -2.25, 1024.0])
+            for j in xrange(3):
+                value.d[j] = rng.randint(0, 4095)
+            value.e = rng.randint(-(1 << 63), (1 << 63) - 1)
+            for j in xrange(rng.randint(0, 8)):
+                value.f.append(rng.randint(0, 255))
+            value.g = rng.choice([0.0, 0.5, -3.0, 1e10])
+            for j in xrange(rng.randint(0, 4)):
+                value.h.append(rng.randint(-32768, 32767))
+            stream = transport.BitStreamWriter()
+            value._pack(stream)
+            self.values.append(value)
+            self.payloads.append(stream.getvalue())
+
+
+@unittest.skipIf(batch.numpy is None, "NumPy is not available")
+class TestDecodeBatch(BatchTestCase):
+    def test_columns(self):
+        columns = batch.decode_batch(self.custom_type, self.payloads)
+        self.assertEqual(list(columns.keys()),
+                         ["a", "b", "inner.x", "inner.y", "c", "d", "e",
+                          "f", "g", "h"])
+        self.assertEqual(columns["a"].dtype, batch.numpy.uint32)
+        self.assertEqual(columns["b"].dtype, batch.numpy.int16)
+        self.assertEqual(columns["c"].dtype, batch.numpy.float16)
+        self.assertEqual(columns["d"].shape, (50, 3))
+        self.assertEqual(columns["g"].dtype, batch.numpy.float32)
+
+    def test_matches_scalar_decode(self):
+        columns = batch.decode_batch(self.custom_type, self.payloads)
+        for i, value in enumerate(self.values):
+            self.assertEqual(columns["a"][i], value.a)
+            self.assertEqual(columns["b"][i], value.b)
+            self.assertEqual(columns["inner.x"][i], value.inner.x)
+            self.assertEqual(columns["inner.y"][i], value.inner.y)
+            self.assertEqual(columns["c"][i], value.c)
+            self.assertEqual(list(columns["d"][i]), list(value.d))
+            self.assertEqual(columns["e"][i], value.e)
+            self.assertEqual(columns["g"][i], value.g)
+
+            f = columns["f"]
+            self.assertEqual(
+                list(f.values[f.offsets[i]:f.offsets[i + 1]]), list(value.f))
+            h = columns["h"]
+            self.assertEqual(
+                list(h.values[h.offsets[i]:h.offsets[i + 1]]), list(value.h))
+
+    def test_short_payload(self):
+        payloads = list(self.payloads)
+        payloads[3] = payloads[3][0:4]
+        self.assertRaises(ValueError, batch.decode_batch, self.custom_type,
+                          payloads)
+
+
+@unittest.skipIf(batch.numpy is None, "NumPy is not available")
+class TestEncodeBatch(BatchTestCase):
+    def test_round_trip(self):
+        columns = batch.decode_batch(self.custom_type, self.payloads)
+        payloads = batch.encode_batch(self.custom_type, columns)
+        self.assertEqual(payloads, self.payloads)
+
+    def test_fixed_layout(self):
+        fixed_type = parser.CompoundType(
+            "FixedType",
+            parser.CompoundType.KIND_MESSAGE,
+            "source.uavcan",
+            None,
+            ""
+        )
+        fixed_type.fields = self.custom_type.fields[0:6]
+        columns = {
+            "a": [1, 2, 1 << 40],
+            "b": [-5000, 17, 4095],
+            "inner.x": [-16, 3, 100],
+            "inner.y": [True, False, True],
+            "c": [0.5, -1.0, 1e6],
+            "d": [[1, 2, 3], [4095, 0, 1], [0, 0, 5000]],
+            "e": [-1, 0, 1 << 62]
+        }
+        payloads = batch.encode_batch(fixed_type, columns)
+
+        for i, payload in enumerate(payloads):
+            value = transport.CompoundValue(fixed_type)
+            for name in ("a", "b", "c", "e"):
+                setattr(value, name, columns[name][i])
+            value.inner.x = columns["inner.x"][i]
+            value.inner.y = columns["inner.y"][i]
+            for j in xrange(3):
+                value.d[j] = columns["d"][i][j]
+            stream = transport.BitStreamWriter()
+            value._pack(stream)
+            self.assertEqual(payload, stream.getvalue())
+
+    def test_cast_array(self):
+        for kind in (parser.PrimitiveType.KIND_UNSIGNED_INT,
+                     parser.PrimitiveType.KIND_SIGNED_INT):
+            for cast_mode in (parser.PrimitiveType.CAST_MODE_SATURATED,
+                              parser.PrimitiveType.CAST_MODE_TRUNCATED):
+                for bitlen in (4, 13, 33, 64):
+                    dtype = parser.PrimitiveType(kind, bitlen, cast_mode)
+                    values = [0, 1, -1, 7, -8, 100, -100, (1 << 31) - 1,
+                              -(1 << 31)]
+                    raw = batch.cast_array(
+                        batch.numpy.array(values, dtype=batch.numpy.int64),
+                        dtype)
+                    for value, result in zip(values, raw):
+                        expected = transport.PrimitiveValue(dtype)
+                        expected.value = value
+                        self.assertEqual(int(result), expected._raw)
+
+    def test_cast_array_float_truncated(self):
+        dtype = parser.PrimitiveType(
+            parser.PrimitiveType.KIND_FLOAT,
+            16,
+            parser.PrimitiveType.CAST_MODE_TRUNCATED)
+        raw = batch.cast_array([1.0, 1e6, -1e6], dtype)
+        self.assertEqual(list(raw), [0x3C00, 0x7C00, 0xFC00])
+
+
+@unittest.skipIf(batch.numpy is None, "NumPy is not available")
+class TestFloat16(unittest.TestCase):
+    def setUp(self):
+        rng = random.Random(2)
+        self.values = [rng.uniform(-100, 100) for i in xrange(1000)] + [
+            0.1, -3.14159, 1e-6, -3e-6, 6.1e-5, -6.2e-5, 1e-8, 0.0, -0.0,
+            65519.0, 65504.0, 70000.0, -1e6
+        ]
+
+    def test_cast_array_matches_scalar(self):
+        for cast_mode in (parser.PrimitiveType.CAST_MODE_SATURATED,
+                          parser.PrimitiveType.CAST_MODE_TRUNCATED):
+            dtype = parser.PrimitiveType(
+                parser.PrimitiveType.KIND_FLOAT, 16, cast_mode)
+            raw = batch.cast_array(self.values, dtype)
+            self.assertEqual(
+                [int(bits) for bits in raw],
+                [transport.raw_from_value(value, dtype)
+                 for value in self.values])
+
+    def test_decode_matches_scalar(self):
+        dtype = primitive(parser.PrimitiveType.KIND_FLOAT, 16)
+        float_type = parser.CompoundType(
+            "FloatType",
+            parser.CompoundType.KIND_MESSAGE,
+            "source.uavcan",
+            None,
+            ""
+        )
+        float_type.fields = [parser.Field(dtype, "x")]
+
+        # Every finite bit pattern, including subnormals
+        patterns = [raw for raw in xrange(0x10000) if raw & 0x7C00 != 0x7C00]
+        payloads = []
+        for raw in patterns:
+            stream = transport.BitStreamWriter()
+            stream.write(raw, 16)
+            payloads.append(stream.getvalue())
+        columns = batch.decode_batch(float_type, payloads)
+        for raw, value in zip(patterns, columns["x"]):
+            expected = transport.value_from_raw(raw, dtype)
+            self.assertEqual((value, math.copysign(1.0, value)),
+                             (expected, math.copysign(1.0, expected)),
+                             hex(raw))
+
+
+if __name__ == '__main__':
+    unittest.main()
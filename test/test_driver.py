@@ -1,8 +1,200 @@
+import socket
+import struct
 import unittest
 from uavcan import driver
 
 
-# TODO
+def can_frame(can_id, data):
+    return struct.pack("=IB3x8s", can_id, len(data), data)
+
+
+class TestSocketCANReceive(unittest.TestCase):
+    def setUp(self):
+        self.a, self.b = socket.socketpair(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self.b.setblocking(0)
+        self.can = driver.SocketCAN("test")
+        self.can.socket = self.b
+
+    def tearDown(self):
+        self.a.close()
+        self.b.close()
+
+    def send_frames(self, count):
+        expected = []
+        for i in range(count):
+            data = bytes(bytearray(range(i % 9)))
+            self.a.send(can_frame((i + 1) | driver.CAN_EFF_FLAG, data))
+            expected.append((i + 1, data, True))
+        return expected
+
+    def check_batches(self):
+        expected = self.send_frames(self.can.RX_BATCH + 10)
+        # A standard (11-bit) frame
+        self.a.send(can_frame(0x123, b"\xAA"))
+        expected.append((0x123, b"\xAA", False))
+
+        batches = []
+        self.can._read(0, None,
+                       batch_callback=lambda dev, messages:
+                       batches.append(messages))
+        self.can._read(0, None,
+                       batch_callback=lambda dev, messages:
+                       batches.append(messages))
+        self.assertEqual([len(batch) for batch in batches],
+                         [self.can.RX_BATCH, 11])
+        self.assertEqual(batches[0] + batches[1], expected)
+
+        # Nothing left to read
+        self.assertEqual(self.can._recv(), [])
+
+    @unittest.skipIf(driver._libc is None, "recvmmsg is not available")
+    def test_recvmmsg(self):
+        self.check_batches()
+
+    def test_recv_into(self):
+        self.can._rx_msgs = None
+        self.check_batches()
+
+    def test_callback(self):
+        expected = self.send_frames(3)
+        received = []
+        self.can._read(0, None,
+                       callback=lambda dev, message: received.append(message))
+        self.assertEqual(received, expected)
+
+
+class FakeIOLoop(object):
+    READ = 0x001
+    WRITE = 0x004
+
+    def __init__(self):
+        self.events = None
+        self.callbacks = []
+        self.timeouts = []
+
+    def add_handler(self, fd, handler, events):
+        self.handler = handler
+        self.events = events
+
+    def update_handler(self, fd, events):
+        self.events = events
+
+    def add_callback(self, callback):
+        self.callbacks.append(callback)
+
+    def call_later(self, delay, callback):
+        self.timeouts.append(callback)
+
+
+class TestSocketCANSend(unittest.TestCase):
+    def setUp(self):
+        self.a, self.b = socket.socketpair(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self.a.setblocking(0)
+        self.b.setblocking(0)
+        self.can = driver.SocketCAN("test")
+        self.can.socket = self.a
+
+    def tearDown(self):
+        self.a.close()
+        self.b.close()
+
+    def receive_all(self):
+        packets = []
+        while True:
+            try:
+                packets.append(self.b.recv(16))
+            except socket.error:
+                return packets
+
+    def check_queue(self):
+        expected = []
+        for i in range(2000):
+            data = bytes(bytearray(range(i % 9)))
+            self.can.send(i, data)
+            expected.append(can_frame(i | driver.CAN_EFF_FLAG, data))
+        # The receiving end's queue fills up, leaving frames queued
+        self.assertTrue(self.can.tx_queue_depth > 0)
+
+        packets = self.receive_all()
+        while self.can.flush():
+            packets.extend(self.receive_all())
+        packets.extend(self.receive_all())
+        self.assertEqual(packets, expected)
+        self.assertEqual(self.can.tx_queue_depth, 0)
+
+    @unittest.skipIf(driver._sendmmsg is None, "sendmmsg is not available")
+    def test_sendmmsg(self):
+        self.check_queue()
+
+    def test_send(self):
+        self.can._tx_msgs = None
+        self.check_queue()
+
+    def check_error(self):
+        self.b.close()
+        for i in range(3):
+            self.assertRaises(OSError, self.can.send, i, b"\x01")
+            self.assertEqual(self.can.tx_queue_depth, 0)
+
+    @unittest.skipIf(driver._sendmmsg is None, "sendmmsg is not available")
+    def test_sendmmsg_error(self):
+        self.check_error()
+
+    def test_send_error(self):
+        self.can._tx_msgs = None
+        self.check_error()
+
+    @unittest.skipIf(not hasattr(driver, "CANSocket"),
+                     "Python's socket module is used for SocketCAN")
+    def test_can_socket(self):
+        # The ctypes socket must report the errno of a failed write
+        self.can.socket = driver.CANSocket(self.a.fileno())
+        self.can._tx_msgs = None
+        self.check_queue()
+        self.check_error()
+
+    def test_ioloop_error(self):
+        ioloop = FakeIOLoop()
+        self.can.add_to_ioloop(ioloop)
+        self.b.close()
+        for i in range(3):
+            self.can.send(i, b"\x01")
+        # Each failing frame is dropped and the rest retried
+        for depth in (2, 1, 0):
+            self.assertRaises(OSError, ioloop.callbacks.pop(0))
+            self.assertEqual(self.can.tx_queue_depth, depth)
+        self.assertEqual(ioloop.callbacks, [])
+        self.assertEqual(ioloop.events, ioloop.READ)
+
+    def test_ioloop(self):
+        ioloop = FakeIOLoop()
+        self.can.add_to_ioloop(ioloop)
+
+        # Frames sent together are written by a single scheduled flush
+        self.can.send(1, b"\x01")
+        self.can.send(2, b"\x02")
+        self.assertEqual(len(ioloop.callbacks), 1)
+        self.assertEqual(self.can.tx_queue_depth, 2)
+        ioloop.callbacks.pop()()
+        self.assertEqual(self.receive_all(),
+                         [can_frame(1 | driver.CAN_EFF_FLAG, b"\x01"),
+                          can_frame(2 | driver.CAN_EFF_FLAG, b"\x02")])
+
+        # Once the socket is full, wait for it to become writable
+        for i in range(2000):
+            self.can.send(i, b"")
+        ioloop.callbacks.pop()()
+        self.assertEqual(ioloop.events, ioloop.READ | ioloop.WRITE)
+        self.can.send(2000, b"")
+        self.assertEqual(ioloop.callbacks, [])
+
+        received = self.receive_all()
+        while ioloop.events & ioloop.WRITE:
+            ioloop.handler(self.a.fileno(), ioloop.WRITE)
+            received.extend(self.receive_all())
+        self.assertEqual(len(received), 2001)
+        self.assertEqual(self.can.tx_queue_depth, 0)
+        self.assertEqual(ioloop.events, ioloop.READ)
 
 
 if __name__ == '__main__':
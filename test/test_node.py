@@ -1,8 +1,244 @@
+import time
 import unittest
-from uavcan import node
+import tornado.gen
+import tornado.ioloop
+import uavcan
+from uavcan import node, transport
+from uavcan.dsdl import parser
 
 
-# TODO
+class NodeTestCase(unittest.TestCase):
+    def setUp(self):
+        self.custom_type = parser.CompoundType(
+            "source.CustomType",
+            parser.CompoundType.KIND_MESSAGE,
+            "source.uavcan",
+            300,
+            ""
+        )
+        self.custom_type.fields = [
+            parser.Field(
+                parser.PrimitiveType(
+                    parser.PrimitiveType.KIND_UNSIGNED_INT,
+                    8,
+                    parser.PrimitiveType.CAST_MODE_SATURATED
+                ),
+                "a"
+            )
+        ]
+        self.custom_type.base_crc = 0x1234
+        def custom_type_factory(*args, **kwargs):
+            return transport.CompoundValue(self.custom_type, tao=True, *args,
+                                           **kwargs)
+        self.custom_type.__call__ = custom_type_factory
+        uavcan.DATATYPES[(300, self.custom_type.kind)] = self.custom_type
+
+        # Node looks up uavcan.protocol.NodeStatus, normally created by
+        # load_dsdl
+        self.protocol = getattr(uavcan, "protocol", None)
+        if self.protocol is None:
+            uavcan.protocol = uavcan.Namespace()
+            uavcan.protocol.NodeStatus = None
+
+        self.received = []
+
+    def tearDown(self):
+        del uavcan.DATATYPES[(300, self.custom_type.kind)]
+        if self.protocol is None:
+            del uavcan.protocol
+
+    def make_handler(self, tag):
+        received = self.received
+
+        class Handler(node.MessageHandler):
+            def __init__(self, *args, **kwargs):
+                super(Handler, self).__init__(*args, **kwargs)
+                self.suffix = kwargs.get("suffix", "")
+
+            def on_message(self, message):
+                received.append((tag + self.suffix, message.a))
+
+        return Handler
+
+    def receive(self, uavcan_node, a, transfer_id=0):
+        value = self.custom_type()
+        value.a = a
+        transfer = transport.Transfer(payload=value, source_node_id=42,
+                                      transfer_id=transfer_id)
+        for frame in transfer.to_frames():
+            uavcan_node._recv_frame(None, (frame.message_id,
+                                           frame.to_bytes(), True))
+
+
+class TestHandlerDispatch(NodeTestCase):
+    def test_constructor_handlers(self):
+        uavcan_node = node.Node([
+            (self.custom_type, self.make_handler("first")),
+            (self.custom_type, self.make_handler("second"),
+             {"suffix": "!"})
+        ])
+        self.receive(uavcan_node, 5)
+        self.assertEqual(self.received, [("first", 5), ("second!", 5)])
+
+    def test_add_remove(self):
+        first = self.make_handler("first")
+        second = self.make_handler("second")
+        uavcan_node = node.Node([])
+        uavcan_node.add_handler(self.custom_type, first)
+        uavcan_node.add_handler(self.custom_type, second)
+        self.receive(uavcan_node, 1, transfer_id=0)
+
+        uavcan_node.remove_handler(self.custom_type, first)
+        self.receive(uavcan_node, 2, transfer_id=1)
+        self.assertEqual(self.received,
+                         [("first", 1), ("second", 1), ("second", 2)])
+
+        uavcan_node.remove_handler(self.custom_type, second)
+        self.receive(uavcan_node, 3, transfer_id=2)
+        self.assertEqual(len(self.received), 3)
+        self.assertRaises(ValueError, uavcan_node.remove_handler,
+                          self.custom_type, second)
+
+
+class FakeCAN(object):
+    def __init__(self):
+        self.sent = []
+
+    def send(self, message_id, message, extended=False):
+        self.sent.append((message_id, message))
+
+
+class TestPendingRequests(NodeTestCase):
+    def setUp(self):
+        super(TestPendingRequests, self).setUp()
+        self.service_type = parser.CompoundType(
+            "source.CustomService",
+            parser.CompoundType.KIND_SERVICE,
+            "source.uavcan",
+            200,
+            ""
+        )
+        field_type = parser.PrimitiveType(
+            parser.PrimitiveType.KIND_UNSIGNED_INT,
+            8,
+            parser.PrimitiveType.CAST_MODE_SATURATED
+        )
+        self.service_type.request_fields = [parser.Field(field_type, "x")]
+        self.service_type.response_fields = [parser.Field(field_type, "y")]
+        self.service_type.base_crc = 0x4321
+        def service_type_factory(*args, **kwargs):
+            return transport.CompoundValue(self.service_type, tao=True,
+                                           *args, **kwargs)
+        self.service_type.__call__ = service_type_factory
+        uavcan.DATATYPES[(200, self.service_type.kind)] = self.service_type
+
+        self.node = node.Node([], node_id=10)
+        self.node.can = FakeCAN()
+
+    def tearDown(self):
+        del uavcan.DATATYPES[(200, self.service_type.kind)]
+        super(TestPendingRequests, self).tearDown()
+
+    def send_request(self, server_node_id, x, timeout=None, callback=None):
+        request = self.service_type(mode="request")
+        request.x = x
+        return self.node.send_request(request, server_node_id,
+                                      callback=callback, timeout=timeout)
+
+    def respond(self, server_node_id, transfer_id, y):
+        response = self.service_type(mode="response")
+        response.y = y
+        transfer = transport.Transfer(payload=response,
+                                      source_node_id=server_node_id,
+                                      dest_node_id=self.node.node_id,
+                                      transfer_id=transfer_id,
+                                      service_not_message=True,
+                                      request_not_response=False)
+        for frame in transfer.to_frames():
+            self.node._recv_frame(None, (frame.message_id,
+                                         frame.to_bytes(), True))
+
+    def test_response_matching(self):
+        futures = [self.send_request(server, server * 2)
+                   for server in (20, 21, 22)]
+        self.assertEqual(set(self.node.pending_requests),
+                         set([(20, 200, 0), (21, 200, 0), (22, 200, 0)]))
+
+        self.respond(21, 0, 5)
+        self.assertTrue(futures[1].done())
+        self.assertFalse(futures[0].done() or futures[2].done())
+        payload, transfer = futures[1].result()
+        self.assertEqual(payload.y, 5)
+        self.assertEqual(transfer.source_node_id, 21)
+
+        # A response with the wrong transfer ID is ignored
+        self.respond(20, 1, 6)
+        self.assertFalse(futures[0].done())
+        self.assertEqual(len(self.node.pending_requests), 2)
+
+    def test_cancel(self):
+        futures = [self.send_request(server, 1) for server in (20, 20, 21)]
+        cancelled = self.node.cancel_requests(dest_node_id=20)
+        self.assertEqual(sorted(request.key for request in cancelled),
+                         [(20, 200, 0), (20, 200, 1)])
+        self.assertEqual(list(self.node.pending_requests), [(21, 200, 0)])
+        self.assertEqual(len(self.node.cancel_requests()), 1)
+        self.assertEqual(self.node.pending_requests, {})
+        self.assertEqual(len(self.node.request_deadlines), 0)
+        for future in futures:
+            self.assertIsInstance(future.exception(), RuntimeError)
+
+    def test_transfer_id_wrap(self):
+        futures = [self.send_request(20, 1) for i in xrange(33)]
+        self.assertIsInstance(futures[0].exception(), RuntimeError)
+        self.assertFalse(any(future.done() for future in futures[1:]))
+        self.assertEqual(len(self.node.pending_requests), 32)
+        self.assertEqual(len(self.node.request_deadlines), 32)
+
+        # The response with transfer ID 0 now answers the 33rd request
+        self.respond(20, 0, 7)
+        self.assertEqual(futures[32].result()[0].y, 7)
+        self.node.expire_timeouts(time.time() + 100)
+        self.assertTrue(all(future.done() for future in futures))
+        self.assertEqual(self.node.pending_requests, {})
+
+    def test_timeout(self):
+        slow = self.send_request(20, 1, timeout=5.0)
+        fast = self.send_request(21, 1, timeout=0.5)
+        self.node.expire_timeouts(time.time() + 1.0)
+        self.assertIsInstance(fast.exception(), tornado.gen.TimeoutError)
+        self.assertFalse(slow.done())
+        self.assertEqual(list(self.node.pending_requests), [(20, 200, 0)])
+
+        self.respond(20, 0, 1)
+        self.assertEqual(slow.result()[0].y, 1)
+        self.node.expire_timeouts(time.time() + 10.0)
+        self.assertEqual(len(self.node.request_deadlines), 0)
+
+    def test_callback(self):
+        results = []
+        self.send_request(20, 1, callback=results.append)
+        self.send_request(21, 1, timeout=0.5, callback=results.append)
+        self.send_request(22, 1, callback=results.append)
+        self.respond(20, 0, 3)
+        self.node.expire_timeouts(time.time() + 0.75)
+        self.node.cancel_requests(dest_node_id=22)
+
+        # Future callbacks run on the IO loop
+        tornado.ioloop.IOLoop.current().run_sync(lambda: None)
+        self.assertEqual(len(results), 3)
+        self.assertEqual(results[0][0].y, 3)
+        self.assertEqual(results[1:], [None, None])
+
+    def test_partial_transfer_timeout(self):
+        manager = self.node.transfer_manager
+        frame = transport.Frame((16 << 24) | (300 << 8) | 42,
+                                bytearray(b"\x01\x02\x03\x04\x05\x06\x07\x83"))
+        self.assertIsNone(manager.receive_frame(frame))
+        self.node.expire_timeouts(time.time() + manager.timeout / 2)
+        self.assertIn(frame.transfer_key, manager.active_transfers)
+        self.node.expire_timeouts(time.time() + manager.timeout * 2)
+        self.assertEqual(len(manager.active_transfers), 0)
 
 
 if __name__ == '__main__':
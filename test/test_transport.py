@@ -1,6 +1,18 @@
+import time
 import unittest
+import collections
+import uavcan
 from uavcan import transport
-from uavcan.dsdl import parser
+from uavcan.dsdl import common, parser
+
+
+def primitive(kind, bitlen):
+    return parser.PrimitiveType(kind, bitlen,
+                                parser.PrimitiveType.CAST_MODE_SATURATED)
+
+
+def uint(bitlen):
+    return primitive(parser.PrimitiveType.KIND_UNSIGNED_INT, bitlen)
 
 
 class TestBitsFromBytes(unittest.TestCase):
@@ -155,6 +167,63 @@ class TestLEFromBEBits(unittest.TestCase):
         self.assertEqual(out_bits,          b"10100101100101101")
 
 
+class TestBitStreamReader(unittest.TestCase):
+    def test_partial_byte(self):
+        stream = transport.BitStreamReader(bytearray("\xA5"))
+        self.assertEqual(stream.read(3), 0x5)
+        self.assertEqual(stream.read(1), 0x0)
+        self.assertEqual(stream.read(4), 0x5)
+        self.assertEqual(stream.remaining, 0)
+
+    def test_multiple_bytes(self):
+        #                                 llllllllmmmm
+        stream = transport.BitStreamReader.from_bits("110110101110")
+        self.assertEqual(stream.read(12), int("111011011010", 2))
+
+        stream = transport.BitStreamReader(bytearray("\x34\x12"))
+        self.assertEqual(stream.read(16), 0x1234)
+
+    def test_unaligned(self):
+        bits = "101" + "10100101100101101"
+        stream = transport.BitStreamReader.from_bits(bits)
+        self.assertEqual(stream.read(3), 0x5)
+        self.assertEqual(stream.read(17), int("11001011010100101", 2))
+
+    def test_underflow(self):
+        stream = transport.BitStreamReader(bytearray("\xFF"))
+        stream.read(5)
+        self.assertRaises(ValueError, stream.read, 4)
+
+
+class TestBitStreamWriter(unittest.TestCase):
+    def test_partial_byte(self):
+        stream = transport.BitStreamWriter()
+        stream.write(0x5, 3)
+        self.assertEqual(stream.to_bits(), "101")
+        self.assertEqual(stream.getvalue(), bytearray("\xA0"))
+
+    def test_multiple_bytes(self):
+        stream = transport.BitStreamWriter()
+        stream.write(0x1234, 16)
+        self.assertEqual(stream.getvalue(), bytearray("\x34\x12"))
+
+        stream = transport.BitStreamWriter()
+        stream.write(int("111011011010", 2), 12)
+        self.assertEqual(stream.to_bits(), "110110101110")
+
+    def test_round_trip(self):
+        fields = [(1, 1), (0x1FFFF, 17), (0, 3), (0x1234, 16),
+                  (0xDEADBEEFCAFEF00D, 64), (0x55, 7)]
+        writer = transport.BitStreamWriter()
+        for value, bitlen in fields:
+            writer.write(value, bitlen)
+        self.assertEqual(writer.bitlen, sum(f[1] for f in fields))
+
+        reader = transport.BitStreamReader(writer.getvalue())
+        for value, bitlen in fields:
+            self.assertEqual(reader.read(bitlen), value)
+
+
 class TestCast(unittest.TestCase):
     def test_truncated_1bit(self):
         dtype = parser.PrimitiveType(
@@ -446,5 +515,919 @@ class TestArrayBasic(unittest.TestCase):
         )
 
 
+class TestValueEncoding(unittest.TestCase):
+    def test_signed_negative(self):
+        value = transport.PrimitiveValue(parser.PrimitiveType(
+            parser.PrimitiveType.KIND_SIGNED_INT,
+            12,
+            parser.PrimitiveType.CAST_MODE_SATURATED))
+        value.value = -2
+        self.assertEqual(value.pack(), "11111110" + "1111")
+
+        decoded = transport.PrimitiveValue(value.type)
+        self.assertEqual(decoded.unpack(value.pack() + "01"), "01")
+        self.assertEqual(decoded.value, -2)
+
+    def test_dynamic_array_length_width(self):
+        # The length prefix of a [<=N] array is N.bit_length() bits wide
+        array_type = parser.ArrayType(
+            parser.PrimitiveType(
+                parser.PrimitiveType.KIND_UNSIGNED_INT,
+                8,
+                parser.PrimitiveType.CAST_MODE_SATURATED
+            ),
+            parser.ArrayType.MODE_DYNAMIC,
+            256
+        )
+        a1 = transport.ArrayValue(array_type)
+        a1.from_bytes(b"\x01\x02")
+        bits = a1.pack()
+        self.assertEqual(len(bits), 9 + 16)
+
+        a2 = transport.ArrayValue(array_type)
+        self.assertEqual(a2.unpack(bits), "")
+        self.assertEqual(a2.to_bytes(), b"\x01\x02")
+
+
+class TestArrayStorage(unittest.TestCase):
+    def setUp(self):
+        self.bytes_type = parser.ArrayType(
+            parser.PrimitiveType(
+                parser.PrimitiveType.KIND_UNSIGNED_INT,
+                8,
+                parser.PrimitiveType.CAST_MODE_SATURATED
+            ),
+            parser.ArrayType.MODE_DYNAMIC,
+            16
+        )
+        self.int12_type = parser.ArrayType(
+            parser.PrimitiveType(
+                parser.PrimitiveType.KIND_SIGNED_INT,
+                12,
+                parser.PrimitiveType.CAST_MODE_SATURATED
+            ),
+            parser.ArrayType.MODE_STATIC,
+            3
+        )
+
+    def test_raw_items(self):
+        a1 = transport.ArrayValue(self.bytes_type)
+        a1.from_bytes(b"abc")
+        self.assertIsInstance(a1.raw_items, bytearray)
+        self.assertEqual(memoryview(a1.raw_items).tobytes(), b"abc")
+
+        a2 = transport.ArrayValue(self.int12_type)
+        a2[0] = -2
+        a2[1] = 5000
+        self.assertEqual(list(a2.raw_items), [0xFFE, 0x7FF, 0])
+        self.assertEqual(list(a2), [-2, 2047, 0])
+
+    def test_sub_byte_errors(self):
+        bool_type = primitive(parser.PrimitiveType.KIND_BOOLEAN, 1)
+        static = transport.ArrayValue(
+            parser.ArrayType(bool_type, parser.ArrayType.MODE_STATIC, 40))
+        self.assertRaises(ValueError, static.unpack_from, b"\xFF\xFF")
+
+        dynamic = transport.ArrayValue(
+            parser.ArrayType(bool_type, parser.ArrayType.MODE_DYNAMIC, 64))
+        self.assertRaises(ValueError, dynamic.extend,
+                          [1] * 20 + [None] + [1] * 19)
+        self.assertEqual(len(dynamic), 0)
+
+    def test_slices(self):
+        a1 = transport.ArrayValue(self.bytes_type)
+        a1.extend([1, 2, 3, 300])
+        self.assertEqual(a1[1:3], [2, 3])
+        self.assertEqual(a1[3], 255)
+
+        a1[1:3] = [7, 8, 9]
+        self.assertEqual(list(a1), [1, 7, 8, 9, 255])
+        del a1[0:2]
+        self.assertEqual(a1.to_bytes(), b"\x08\x09\xFF")
+        with self.assertRaises(IndexError):
+            a1[:] = bytearray(17)
+
+    def test_unaligned_round_trip(self):
+        array_type = parser.ArrayType(
+            self.bytes_type.value_type,
+            parser.ArrayType.MODE_STATIC,
+            4
+        )
+        a1 = transport.ArrayValue(array_type)
+        a1.from_bytes(b"\xA5\x5A")
+
+        stream = transport.BitStreamWriter()
+        stream.write(1, 3)
+        a1._pack(stream)
+        self.assertEqual(stream.bitlen, 3 + 32)
+
+        a2 = transport.ArrayValue(array_type)
+        reader = transport.BitStreamReader(stream.getvalue(), 3)
+        a2._unpack(reader)
+        self.assertEqual(a2.to_bytes(), b"\xA5\x5A\x00\x00")
+
+    def test_sequence_interface(self):
+        a1 = transport.ArrayValue(self.bytes_type)
+        self.assertIsInstance(a1, collections.MutableSequence)
+        self.assertFalse(hasattr(a1, "__dict__"))
+        a1 += [3, 1, 2]
+        a1.append(1)
+        self.assertEqual(a1.count(1), 2)
+        self.assertEqual(a1.index(2), 2)
+        self.assertIn(3, a1)
+        self.assertEqual(a1.pop(), 1)
+        a1.remove(3)
+        self.assertEqual(list(reversed(a1)), [2, 1])
+
+    def test_string(self):
+        a1 = transport.ArrayValue(self.bytes_type)
+        a1.encode(u"h\xe9llo")
+        self.assertEqual(len(a1), 6)
+        self.assertEqual(a1.decode(), u"h\xe9llo")
+
+
+class TestCompiledCodec(unittest.TestCase):
+    def setUp(self):
+        self.custom_type = parser.CompoundType(
+            "CustomType",
+            parser.CompoundType.KIND_MESSAGE,
+            "source.uavcan",
+            0,
+            ""
+        )
+        self.custom_type.fields = [
+            parser.Field(
+                primitive(parser.PrimitiveType.KIND_UNSIGNED_INT, 8), "a"),
+            parser.Field(
+                primitive(parser.PrimitiveType.KIND_UNSIGNED_INT, 16), "b"),
+            parser.Field(
+                primitive(parser.PrimitiveType.KIND_SIGNED_INT, 13), "c"),
+            parser.Field(
+                primitive(parser.PrimitiveType.KIND_FLOAT, 16), "d"),
+            parser.Field(
+                parser.ArrayType(
+                    primitive(parser.PrimitiveType.KIND_UNSIGNED_INT, 8),
+                    parser.ArrayType.MODE_DYNAMIC,
+                    10
+                ),
+                "e"
+            ),
+            parser.Field(
+                primitive(parser.PrimitiveType.KIND_UNSIGNED_INT, 64), "f"),
+            parser.Field(
+                primitive(parser.PrimitiveType.KIND_BOOLEAN, 1), "g")
+        ]
+
+    def populate(self, value):
+        value.a = 0xA5
+        value.b = 0x1234
+        value.c = -1000
+        value.d = 1.5
+        value.e.from_bytes(b"\x01\x02\x03")
+        value.f = 0xDEADBEEFCAFEF00D
+        value.g = True
+
+    def test_cached(self):
+        self.assertIs(transport.compile_codec(self.custom_type),
+                      transport.compile_codec(self.custom_type))
+
+    def test_matches_field_walk(self):
+        value = transport.CompoundValue(self.custom_type)
+        self.populate(value)
+
+        stream = transport.BitStreamWriter()
+        for field in value.fields.values():
+            field._pack(stream)
+        self.assertEqual(value.pack(), stream.to_bits())
+
+    def test_compact_layout(self):
+        value = transport.CompoundValue(self.custom_type)
+        other = transport.CompoundValue(self.custom_type)
+        self.assertFalse(hasattr(value, "__dict__"))
+        self.assertIs(value.constants, other.constants)
+        self.assertEqual(list(value.fields.keys()),
+                         ["a", "b", "c", "d", "e", "f", "g"])
+        with self.assertRaises(AttributeError):
+            value.missing = 1
+
+    def test_serialized_size(self):
+        value = transport.CompoundValue(self.custom_type)
+        self.assertEqual(value.serialized_size(), len(value.pack()))
+        self.populate(value)
+        self.assertEqual(value.serialized_size(), len(value.pack()))
+
+        value = transport.CompoundValue(self.custom_type, tao=True)
+        self.populate(value)
+        self.assertEqual(value.serialized_size(), len(value.pack()))
+
+    def test_pack_into(self):
+        value = transport.CompoundValue(self.custom_type)
+        self.populate(value)
+        size = value.serialized_size()
+
+        for offset in (0, 5, 16):
+            buffer = bytearray(b"\xFF" * ((offset + size + 7) // 8 + 1))
+            self.assertEqual(value.pack_into(buffer, offset), size)
+            bits = transport.bits_from_bytes(buffer)
+            self.assertEqual(bits[offset:offset + size], value.pack())
+            self.assertEqual(bits[0:offset], "1" * offset)
+            self.assertEqual(set(bits[offset + size:]), set("1"))
+
+        buffer = bytearray((size + 7) // 8)
+        value.pack_into(memoryview(buffer))
+        self.assertEqual(transport.bits_from_bytes(buffer)[0:size],
+                         value.pack())
+
+    def test_prototype(self):
+        self.assertIs(transport.prototype(self.custom_type),
+                      transport.prototype(self.custom_type))
+
+        value = transport.CompoundValue(self.custom_type)
+        self.populate(value)
+        other = transport.CompoundValue(self.custom_type)
+        self.assertEqual(len(other.e), 0)
+        self.assertEqual(len(transport.prototype(self.custom_type).e), 0)
+
+        clone = value._clone()
+        clone.e.append(4)
+        clone.a = 1
+        self.assertEqual(value.e.to_bytes(), b"\x01\x02\x03")
+        self.assertEqual(clone.e.to_bytes(), b"\x01\x02\x03\x04")
+        self.assertEqual((value.a, clone.a), (0xA5, 1))
+        self.assertEqual(value._clone().pack(), value.pack())
+
+    def test_round_trip(self):
+        value = transport.CompoundValue(self.custom_type)
+        self.populate(value)
+
+        # Decode at several bit alignments to exercise the non-struct path
+        for prefix in ("", "1", "101", "1100110"):
+            stream = transport.BitStreamReader.from_bits(
+                prefix + value.pack())
+            stream.read(len(prefix))
+            decoded = transport.CompoundValue(self.custom_type)
+            decoded._unpack(stream)
+            self.assertEqual(stream.remaining, 0)
+            for name in ("a", "b", "c", "d", "f", "g"):
+                self.assertEqual(getattr(decoded, name), getattr(value, name))
+            self.assertEqual(decoded.e.to_bytes(), b"\x01\x02\x03")
+
+
+class CountingReader(transport.BitStreamReader):
+    def __init__(self, *args, **kwargs):
+        super(CountingReader, self).__init__(*args, **kwargs)
+        self.reads = 0
+
+    def read_raw(self, bitlen):
+        self.reads += 1
+        return super(CountingReader, self).read_raw(bitlen)
+
+
+class TestFixedLayout(unittest.TestCase):
+    def setUp(self):
+        self.timestamp_type = parser.CompoundType(
+            "Timestamp",
+            parser.CompoundType.KIND_MESSAGE,
+            "source.uavcan",
+            None,
+            ""
+        )
+        self.timestamp_type.fields = [
+            parser.Field(
+                primitive(parser.PrimitiveType.KIND_UNSIGNED_INT, 56),
+                "usec")
+        ]
+        self.command_type = parser.CompoundType(
+            "Command",
+            parser.CompoundType.KIND_MESSAGE,
+            "source.uavcan",
+            None,
+            ""
+        )
+        self.command_type.fields = [
+            parser.Field(self.timestamp_type, "timestamp"),
+            parser.Field(
+                primitive(parser.PrimitiveType.KIND_SIGNED_INT, 14), "cmd"),
+            parser.Field(
+                parser.ArrayType(
+                    primitive(parser.PrimitiveType.KIND_FLOAT, 16),
+                    parser.ArrayType.MODE_STATIC,
+                    2
+                ),
+                "setpoint"
+            ),
+            parser.Field(
+                primitive(parser.PrimitiveType.KIND_BOOLEAN, 1), "flag")
+        ]
+
+    def populate(self, value):
+        value.timestamp.usec = 0x123456789ABCDE
+        value.cmd = -1234
+        value.setpoint[0] = 0.5
+        value.setpoint[1] = -2.0
+        value.flag = True
+
+    def test_single_read(self):
+        value = transport.CompoundValue(self.command_type)
+        self.populate(value)
+        bits = value.pack()
+        self.assertEqual(len(bits),
+                         transport.fixed_bitlen(self.command_type))
+
+        stream = transport.BitStreamWriter()
+        stream.write(1, 3)
+        value._pack(stream)
+        reader = CountingReader(stream.getvalue(), 3)
+        decoded = transport.CompoundValue(self.command_type)
+        decoded._unpack(reader)
+        self.assertEqual(reader.reads, 1)
+        self.assertEqual(decoded.timestamp.usec, 0x123456789ABCDE)
+        self.assertEqual(decoded.cmd, -1234)
+        self.assertEqual(list(decoded.setpoint), [0.5, -2.0])
+        self.assertEqual(decoded.flag, True)
+
+    def test_matches_field_walk(self):
+        value = transport.CompoundValue(self.command_type)
+        self.populate(value)
+        del value.setpoint[1]
+
+        stream = transport.BitStreamWriter()
+        for field in value.fields.values():
+            field._pack(stream)
+        self.assertEqual(value.pack(), stream.to_bits())
+
+    def test_resets_lazy_nested(self):
+        value = transport.CompoundValue(self.command_type)
+        self.populate(value)
+        other = transport.CompoundValue(self.command_type)
+        other.timestamp.usec = 42
+
+        decoded = transport.CompoundValue(self.command_type)
+        decoded.unpack_lazy(bytearray(transport.bytes_from_bits(
+            other.pack() + "0" * 7)))
+        decoded.timestamp
+        decoded.unpack(value.pack())
+        self.assertEqual(decoded.timestamp.usec, 0x123456789ABCDE)
+
+
+class TestEncodingCache(unittest.TestCase):
+    def setUp(self):
+        self.inner_type = parser.CompoundType(
+            "InnerType",
+            parser.CompoundType.KIND_MESSAGE,
+            "source.uavcan",
+            None,
+            ""
+        )
+        self.inner_type.fields = [
+            parser.Field(parser.ArrayType(
+                uint(8), parser.ArrayType.MODE_DYNAMIC, 5), "x"),
+            parser.Field(uint(3), "y")
+        ]
+        self.outer_type = parser.CompoundType(
+            "OuterType",
+            parser.CompoundType.KIND_MESSAGE,
+            "source.uavcan",
+            None,
+            ""
+        )
+        self.outer_type.fields = [
+            parser.Field(uint(5), "a"),
+            parser.Field(self.inner_type, "inner"),
+            parser.Field(parser.ArrayType(
+                self.inner_type, parser.ArrayType.MODE_STATIC, 2), "items")
+        ]
+        self.value = transport.CompoundValue(self.outer_type)
+        self.value.a = 3
+        self.value.inner.x.from_bytes(b"\x01\x02")
+        self.value.items[1].y = 2
+
+    def assertEncodesLikeCopy(self, value):
+        copy = transport.CompoundValue(self.outer_type)
+        copy.unpack(value.pack())
+        copy._encoded = None
+        self.assertEqual(value.pack(), copy.pack())
+
+    def test_reused(self):
+        bits = self.value.pack()
+        self.value.pack()
+        self.assertIsNotNone(self.value._encoded[0])
+        self.value.a = 3
+        self.assertIsNotNone(self.value._cached_encoding())
+
+        stream = transport.BitStreamWriter()
+        stream.write(1, 3)
+        self.value._pack(stream)
+        self.assertEqual(stream.to_bits(), "001" + bits)
+        self.assertEqual(self.value.serialized_size(), len(bits))
+
+    def test_invalidated(self):
+        modifications = [
+            lambda value: setattr(value, "a", 4),
+            lambda value: value.inner.x.append(7),
+            lambda value: setattr(value.inner, "y", 1),
+            lambda value: setattr(value.items[0], "y", 6),
+            lambda value: value.unpack("00001" + "000" * 6),
+            lambda value: value.inner.x.extend([1, 2]),
+            lambda value: value.inner.x.raw_items.__setitem__(0, 0x55),
+            lambda value: setattr(value.fields["a"], "value", 9),
+            lambda value: setattr(value.items[1].fields["y"], "value", 5)
+        ]
+        for modify in modifications:
+            self.value.pack()
+            self.value.pack()
+            before = self.value.pack()
+            modify(self.value)
+            self.assertNotEqual(self.value.pack(), before)
+            self.assertEncodesLikeCopy(self.value)
+
+    def test_nested_encoded_separately(self):
+        # A nested value re-encoded on its own after a change must not
+        # make its parent's cached encoding look current
+        self.value.pack()
+        self.value.pack()
+        self.value.inner.x.append(9)
+        self.value.inner.pack()
+        self.assertEqual(list(self.value.inner.x), [1, 2, 9])
+        self.assertEncodesLikeCopy(self.value)
+
+
+class TestUnpackFrom(unittest.TestCase):
+    def setUp(self):
+        self.custom_type = parser.CompoundType(
+            "CustomType",
+            parser.CompoundType.KIND_MESSAGE,
+            "source.uavcan",
+            300,
+            ""
+        )
+        self.custom_type.fields = [
+            parser.Field(
+                parser.PrimitiveType(
+                    parser.PrimitiveType.KIND_UNSIGNED_INT,
+                    4,
+                    parser.PrimitiveType.CAST_MODE_SATURATED
+                ),
+                "a"
+            ),
+            parser.Field(
+                parser.ArrayType(
+                    parser.PrimitiveType(
+                        parser.PrimitiveType.KIND_UNSIGNED_INT,
+                        8,
+                        parser.PrimitiveType.CAST_MODE_SATURATED
+                    ),
+                    parser.ArrayType.MODE_DYNAMIC,
+                    32
+                ),
+                "b"
+            )
+        ]
+        self.custom_type.base_crc = 0x1234
+        def custom_type_factory(*args, **kwargs):
+            return transport.CompoundValue(self.custom_type, tao=True, *args,
+                                           **kwargs)
+        self.custom_type.__call__ = custom_type_factory
+        uavcan.DATATYPES[(300, self.custom_type.kind)] = self.custom_type
+
+    def tearDown(self):
+        del uavcan.DATATYPES[(300, self.custom_type.kind)]
+
+    def test_memoryview_offset(self):
+        # 0xF prefix, then a = 0x5 and b = [0xAB, 0xCD] with TAO
+        buf = bytearray("\xF5\xAB\xCD")
+        value = self.custom_type()
+        consumed = value.unpack_from(memoryview(buf), 4)
+        self.assertEqual(consumed, 20)
+        self.assertEqual(value.a, 0x5)
+        self.assertEqual(value.b.to_bytes(), b"\xAB\xCD")
+
+    def test_from_frames_single(self):
+        message_id = (16 << 24) | (300 << 8) | 42
+        frame = transport.Frame(message_id, "\x50\x10\x20\xC3")
+        transfer = transport.Transfer()
+        transfer.from_frames([frame])
+        self.assertEqual(transfer.source_node_id, 42)
+        self.assertEqual(transfer.payload.a, 0x5)
+        self.assertEqual(transfer.payload.b.to_bytes(), b"\x01\x02")
+
+    def test_from_frame(self):
+        message_id = (16 << 24) | (300 << 8) | 42
+        transfer = transport.Transfer()
+        transfer.from_frame(transport.Frame(message_id, "\x50\x10\x20\xC3"))
+        self.assertEqual(transfer.transfer_id, 3)
+        self.assertEqual(transfer.message_id, message_id)
+        self.assertEqual(transfer.payload.b.to_bytes(), b"\x01\x02")
+
+        for tail in ("\x83", "\x43", "\xE3"):
+            self.assertRaises(ValueError, transport.Transfer().from_frame,
+                              transport.Frame(message_id, "\x50" + tail))
+
+    def test_from_frames_multi(self):
+        message_id = (16 << 24) | (300 << 8) | 42
+        value = self.custom_type()
+        value.a = 0x5
+        value.b.from_bytes(bytearray(xrange(1, 11)))
+        stream = transport.BitStreamWriter()
+        value._pack(stream)
+        payload = stream.getvalue()
+        crc = common.crc16_from_bytes(payload, initial=0x1234)
+        data = bytearray([crc & 0xFF, crc >> 8]) + payload
+        frames = [
+            transport.Frame(message_id, data[0:7] + bytearray("\x83")),
+            transport.Frame(message_id, data[7:13] + bytearray("\x63"))
+        ]
+        transfer = transport.Transfer()
+        transfer.from_frames(frames)
+        self.assertEqual(transfer.payload.b.to_bytes(),
+                         bytes(bytearray(xrange(1, 11))))
+
+        frames[1].bytes[0] ^= 0xFF
+        self.assertRaises(ValueError, transport.Transfer().from_frames,
+                          frames)
+
+    def test_to_frames_round_trip(self):
+        for count in (0, 3, 5, 6, 30):
+            value = self.custom_type()
+            value.a = 0x9
+            value.b.from_bytes(bytearray(xrange(count)))
+            transfer = transport.Transfer(payload=value, source_node_id=42,
+                                          transfer_id=7,
+                                          transfer_priority=16)
+            frames = transfer.to_frames()
+            self.assertEqual(len(frames), 1 if count < 7 else
+                             (count + 2 + 7) // 7)
+            for idx, frame in enumerate(frames):
+                self.assertEqual(frame.message_id,
+                                 (16 << 24) | (300 << 8) | 42)
+                self.assertEqual(frame.start_of_transfer, idx == 0)
+                self.assertEqual(frame.end_of_transfer,
+                                 idx == len(frames) - 1)
+                self.assertEqual(frame.toggle, bool(idx & 1))
+                self.assertEqual(frame.bytes[-1] & 0x1F, 7)
+
+            received = transport.Transfer()
+            received.from_frames(frames)
+            self.assertEqual(received.transfer_priority, 16)
+            self.assertEqual(received.payload.a, 0x9)
+            self.assertEqual(list(received.payload.b), list(xrange(count)))
+
+    def make_frames(self, count, transfer_id=7):
+        value = self.custom_type()
+        value.a = 0x9
+        value.b.from_bytes(bytearray(xrange(count)))
+        transfer = transport.Transfer(payload=value, source_node_id=42,
+                                      transfer_id=transfer_id)
+        return transfer.to_frames()
+
+    def test_iter_frames(self):
+        value = self.custom_type()
+        value.a = 0x9
+        value.b.from_bytes(bytearray(xrange(30)))
+        transfer = transport.Transfer(payload=value, source_node_id=42,
+                                      transfer_id=7)
+        frames = transfer.iter_frames()
+        first = next(frames)
+        self.assertTrue(first.start_of_transfer)
+        self.assertFalse(first.end_of_transfer)
+        frames = [first] + list(frames)
+        self.assertEqual([bytes(frame.bytes) for frame in frames],
+                         [bytes(frame.bytes) for frame in transfer.to_frames()])
+
+    def test_transfer_manager(self):
+        manager = transport.TransferManager()
+        frames = self.make_frames(32)
+        other = self.make_frames(10, transfer_id=8)
+        # Interleave two transfers
+        for frame in frames[0:-1] + other[0:-1]:
+            self.assertIsNone(manager.receive_frame(frame))
+        self.assertEqual(len(manager.active_transfers), 2)
+
+        reassembly = manager.receive_frame(frames[-1])
+        self.assertTrue(reassembly.complete)
+        transfer = reassembly.decode()
+        self.assertEqual(transfer.transfer_id, 7)
+        self.assertEqual(list(transfer.payload.b), list(xrange(32)))
+
+        transfer = manager.receive_frame(other[-1]).decode(lazy=True)
+        self.assertEqual(list(transfer.payload.b), list(xrange(10)))
+        self.assertEqual(manager.active_transfers, {})
+        self.assertEqual(len(manager.deadlines), 0)
+
+    def test_remove_inactive_transfers(self):
+        manager = transport.TransferManager(timeout=1.0)
+        frames = self.make_frames(20)
+        manager.receive_frame(frames[0])
+        now = time.time()
+        self.assertEqual(manager.remove_inactive_transfers(now=now + 0.5), [])
+        # An explicit timeout overrides the manager's
+        self.assertEqual(manager.remove_inactive_transfers(2.0, now + 1.5),
+                         [])
+        self.assertEqual(manager.remove_inactive_transfers(0.25, now + 0.5),
+                         [frames[0].transfer_key])
+        self.assertEqual(manager.active_transfers, {})
+
+    def test_transfer_manager_errors(self):
+        manager = transport.TransferManager()
+        frames = self.make_frames(20)
+
+        # Frames without a start frame are ignored
+        self.assertIsNone(manager.receive_frame(frames[1]))
+        self.assertEqual(manager.active_transfers, {})
+
+        # A repeated frame breaks the toggle sequence and drops the transfer
+        manager.receive_frame(frames[0])
+        manager.receive_frame(frames[1])
+        self.assertRaises(ValueError, manager.receive_frame, frames[1])
+        self.assertEqual(manager.active_transfers, {})
+        self.assertEqual(len(manager.deadlines), 0)
+
+        # A CRC mismatch is detected on the last frame
+        frames[2].bytes[0] ^= 0x01
+        for frame in frames[0:-1]:
+            manager.receive_frame(frame)
+        self.assertRaises(ValueError, manager.receive_frame, frames[-1])
+        self.assertEqual(manager.active_transfers, {})
+
+    def test_from_frames_sequence_errors(self):
+        frames = self.make_frames(20)
+        for bad in (frames[1:], frames[0:-1], frames[0:1] + frames[2:],
+                    frames + frames[-1:]):
+            self.assertRaises(ValueError, transport.Transfer().from_frames,
+                              bad)
+
+
+class TestStreamingDecode(unittest.TestCase):
+    def setUp(self):
+        def dynamic(bitlen, max_size):
+            return parser.ArrayType(uint(bitlen),
+                                    parser.ArrayType.MODE_DYNAMIC, max_size)
+
+        self.custom_type = parser.CompoundType(
+            "StreamType",
+            parser.CompoundType.KIND_MESSAGE,
+            "source.uavcan",
+            301,
+            ""
+        )
+        self.custom_type.fields = [
+            parser.Field(uint(16), "a"),
+            parser.Field(dynamic(12, 20), "b"),
+            parser.Field(uint(32), "c"),
+            parser.Field(dynamic(8, 64), "d")
+        ]
+        self.custom_type.base_crc = 0x4567
+        def custom_type_factory(*args, **kwargs):
+            return transport.CompoundValue(self.custom_type, tao=True, *args,
+                                           **kwargs)
+        self.custom_type.__call__ = custom_type_factory
+        uavcan.DATATYPES[(301, self.custom_type.kind)] = self.custom_type
+
+    def tearDown(self):
+        del uavcan.DATATYPES[(301, self.custom_type.kind)]
+
+    def make_frames(self, b_count, d_count):
+        value = self.custom_type()
+        value.a = 0x1234
+        for i in xrange(b_count):
+            value.b.append(i * 100)
+        value.c = 0xDEADBEEF
+        value.d.from_bytes(bytearray(xrange(d_count)))
+        transfer = transport.Transfer(payload=value, source_node_id=42,
+                                      transfer_id=1)
+        return value, transfer.to_frames()
+
+    def test_matches_decode(self):
+        for b_count, d_count in ((0, 10), (3, 0), (20, 64), (7, 33)):
+            value, frames = self.make_frames(b_count, d_count)
+            reassembly = transport.TransferReassembly(frames[0],
+                                                      streaming=True)
+            for frame in frames[1:]:
+                reassembly.add(frame)
+            payload = reassembly.decode().payload
+            self.assertEqual(payload.a, 0x1234)
+            self.assertEqual(list(payload.b), list(value.b))
+            self.assertEqual(payload.c, 0xDEADBEEF)
+            self.assertEqual(list(payload.d), list(value.d))
+            self.assertEqual(payload.pack(), value.pack())
+
+    def test_progress(self):
+        value, frames = self.make_frames(20, 64)
+        reassembly = transport.TransferReassembly(frames[0], streaming=True)
+        # a and part of b
+        self.assertEqual(reassembly.decoder.index, 1)
+        for frame in frames[1:-1]:
+            reassembly.add(frame)
+        # Only the tail array is left
+        self.assertEqual(reassembly.decoder.index, 3)
+        self.assertEqual(list(reassembly.decoder.value.b), list(value.b))
+        reassembly.add(frames[-1])
+        self.assertEqual(list(reassembly.decode().payload.d), list(value.d))
+
+    def test_nested_sub_byte_array(self):
+        # A static bool array following a dynamic array inside a nested
+        # compound spans frames, and must wait for them rather than fail
+        bool_type = primitive(parser.PrimitiveType.KIND_BOOLEAN, 1)
+        uint8_type = uint(8)
+        inner_type = parser.CompoundType(
+            "Inner",
+            parser.CompoundType.KIND_MESSAGE,
+            "source.uavcan",
+            None,
+            ""
+        )
+        inner_type.fields = [
+            parser.Field(parser.ArrayType(
+                uint8_type, parser.ArrayType.MODE_DYNAMIC, 4), "d"),
+            parser.Field(parser.ArrayType(
+                bool_type, parser.ArrayType.MODE_STATIC, 64), "bits")
+        ]
+        outer_type = parser.CompoundType(
+            "Outer",
+            parser.CompoundType.KIND_MESSAGE,
+            "source.uavcan",
+            302,
+            ""
+        )
+        outer_type.fields = [
+            parser.Field(inner_type, "inner"),
+            parser.Field(uint8_type, "tail")
+        ]
+        outer_type.base_crc = 0x7654
+        outer_type.__call__ = lambda *args, **kwargs: \
+            transport.CompoundValue(outer_type, tao=True, *args, **kwargs)
+        uavcan.DATATYPES[(302, outer_type.kind)] = outer_type
+        self.addCleanup(uavcan.DATATYPES.pop, (302, outer_type.kind))
+
+        value = transport.CompoundValue(outer_type, tao=True)
+        value.inner.d.from_bytes(b"\x01\x02\x03")
+        for i in xrange(64):
+            value.inner.bits[i] = i % 3 == 0
+        value.tail = 0x5A
+        frames = transport.Transfer(payload=value, source_node_id=42,
+                                    transfer_id=1).to_frames()
+        self.assertTrue(len(frames) > 1)
+
+        for streaming in (False, True):
+            manager = transport.TransferManager(streaming=streaming)
+            for frame in frames[0:-1]:
+                self.assertIsNone(manager.receive_frame(frame))
+            payload = manager.receive_frame(frames[-1]).decode().payload
+            self.assertEqual(list(payload.inner.bits),
+                             list(value.inner.bits))
+            self.assertEqual(payload.tail, 0x5A)
+            self.assertEqual(payload.pack(), value.pack())
+
+    def test_crc_mismatch(self):
+        value, frames = self.make_frames(20, 64)
+        frames[-2].bytes[0] ^= 0x01
+        manager = transport.TransferManager(streaming=True)
+        for frame in frames[0:-1]:
+            self.assertIsNone(manager.receive_frame(frame))
+        self.assertRaises(ValueError, manager.receive_frame, frames[-1])
+        self.assertEqual(manager.active_transfers, {})
+
+
+class TestMessageId(unittest.TestCase):
+    def test_message(self):
+        transfer = transport.Transfer(source_node_id=42,
+                                      transfer_priority=16)
+        transfer.data_type_id = 300
+        self.assertEqual(transfer.message_id, (16 << 24) | (300 << 8) | 42)
+
+    def test_service(self):
+        transfer = transport.Transfer(source_node_id=42, dest_node_id=10,
+                                      transfer_priority=1,
+                                      service_not_message=True,
+                                      request_not_response=True)
+        transfer.data_type_id = 200
+        message_id = (1 << 24) | (200 << 16) | 0x8000 | (10 << 8) | 0x80 | 42
+        self.assertEqual(transfer.message_id, message_id)
+
+        received = transport.Transfer()
+        received.message_id = message_id
+        self.assertEqual((received.data_type_id, received.dest_node_id,
+                          received.request_not_response,
+                          received.source_node_id), (200, 10, True, 42))
+        self.assertEqual(received.message_id, message_id)
+
+    def test_anonymous(self):
+        transfer = transport.Transfer(discriminator=0x1234)
+        transfer.data_type_id = 2
+        message_id = (31 << 24) | (0x1234 << 10) | (2 << 8)
+        self.assertEqual(transfer.message_id, message_id)
+
+    def test_cached(self):
+        transfer = transport.Transfer(source_node_id=42)
+        transfer.data_type_id = 300
+        message_id = transfer.message_id
+        self.assertEqual(transfer.message_id, message_id)
+        transfer.source_node_id = 43
+        self.assertEqual(transfer.message_id, message_id + 1)
+
+
+class TestDeadlineQueue(unittest.TestCase):
+    def test_expire_in_order(self):
+        queue = transport.DeadlineQueue()
+        for key, deadline in (("c", 3.0), ("a", 1.0), ("b", 2.0)):
+            queue.schedule(key, deadline)
+        self.assertEqual(queue.next_deadline(), 1.0)
+        self.assertEqual(queue.expire(0.5), [])
+        self.assertEqual(queue.expire(2.0), ["a", "b"])
+        self.assertEqual(len(queue), 1)
+        self.assertEqual(queue.expire(10.0), ["c"])
+        self.assertIsNone(queue.next_deadline())
+
+    def test_reschedule_and_cancel(self):
+        queue = transport.DeadlineQueue()
+        queue.schedule("a", 1.0)
+        queue.schedule("b", 2.0)
+        queue.schedule("a", 5.0)
+        queue.cancel("b")
+        self.assertEqual(queue.expire(3.0), [])
+        self.assertNotIn("b", queue)
+        self.assertEqual(queue.next_deadline(), 5.0)
+        queue.schedule("a", 4.0)
+        self.assertEqual(queue.expire(4.5), ["a"])
+        self.assertEqual(queue.expire(10.0), [])
+        self.assertEqual(len(queue), 0)
+
+
+class TestLazyCompound(unittest.TestCase):
+    def setUp(self):
+        def dynamic_array(max_size):
+            return parser.ArrayType(
+                uint(8), parser.ArrayType.MODE_DYNAMIC, max_size)
+
+        self.inner_type = parser.CompoundType(
+            "InnerType",
+            parser.CompoundType.KIND_MESSAGE,
+            "source.uavcan",
+            None,
+            ""
+        )
+        self.inner_type.fields = [
+            parser.Field(dynamic_array(5), "x"),
+            parser.Field(uint(3), "y")
+        ]
+        self.outer_type = parser.CompoundType(
+            "OuterType",
+            parser.CompoundType.KIND_MESSAGE,
+            "source.uavcan",
+            None,
+            ""
+        )
+        self.outer_type.fields = [
+            parser.Field(uint(8), "a"),
+            parser.Field(uint(12), "b"),
+            parser.Field(self.inner_type, "inner"),
+            parser.Field(uint(16), "c"),
+            parser.Field(dynamic_array(10), "tail")
+        ]
+
+        value = transport.CompoundValue(self.outer_type, tao=True)
+        value.a = 0x12
+        value.b = 0x345
+        value.inner.x.from_bytes(b"\x01\x02\x03")
+        value.inner.y = 5
+        value.c = 0xBEEF
+        value.tail.from_bytes(b"\xAA\xBB")
+        self.value = value
+        stream = transport.BitStreamWriter()
+        value._pack(stream)
+        self.payload = stream.getvalue()
+
+    def test_layout(self):
+        layout = transport.field_layout(self.outer_type)
+        self.assertEqual(layout.offsets, [0, 8, 20, None, None, None])
+        self.assertEqual(layout.bitlens, [8, 12, None, 16, None])
+        self.assertIs(layout, transport.field_layout(self.outer_type))
+
+    def test_decodes_on_access(self):
+        value = transport.CompoundValue(self.outer_type, tao=True)
+        value.unpack_lazy(self.payload)
+        self.assertEqual(value.b, 0x345)
+        self.assertEqual(value._lazy.pending,
+                         set(["a", "inner", "c", "tail"]))
+
+        self.assertEqual(value.c, 0xBEEF)
+        self.assertEqual(value.inner._lazy.pending, set(["y"]))
+        self.assertEqual(value._lazy.pending, set(["a", "tail"]))
+        self.assertEqual(value.tail.to_bytes(), b"\xAA\xBB")
+        self.assertEqual(value.inner.y, 5)
+        self.assertEqual(value.a, 0x12)
+
+    def test_repr_and_pack(self):
+        value = transport.CompoundValue(self.outer_type, tao=True)
+        value.unpack_lazy(self.payload)
+        self.assertEqual(repr(value), repr(self.value))
+
+        value = transport.CompoundValue(self.outer_type, tao=True)
+        value.unpack_lazy(self.payload)
+        value.c = 0x1234
+        self.value.c = 0x1234
+        self.assertEqual(value.pack(), self.value.pack())
+
+
 if __name__ == '__main__':
     unittest.main()
@@ -1,5 +1,4 @@
 import sys
-import struct
 import logging
 import functools
 import uavcan.dsdl as dsdl
@@ -58,9 +57,7 @@ def load_dsdl(paths):
         root_namespace._path(namespace).__dict__[typename] = dtype
         if dtype.default_dtid:
             DATATYPES[(dtype.default_dtid, dtype.kind)] = dtype
-            # Add the base CRC to each data type capable of being transmitted
-            dtype.base_crc = dsdl.common.crc16_from_bytes(
-                struct.pack("<Q", dtype.get_data_type_signature()))
+            # The base CRC is computed on first access and cached on the type
             logging.debug("DSDL Load {: >30} DTID: {: >4} base_crc:{: >8}".
                           format(typename, dtype.default_dtid,
                                  hex(dtype.base_crc)))
@@ -73,6 +70,14 @@ def load_dsdl(paths):
 
         dtype.__call__ = create_instance_closure(dtype)
 
+        # Build the prototypes new values are cloned from up front, so the
+        # first message of each type doesn't pay for it
+        if dtype.kind == dsdl.parser.CompoundType.KIND_SERVICE:
+            transport.prototype(dtype, "request", tao=True)
+            transport.prototype(dtype, "response", tao=True)
+        else:
+            transport.prototype(dtype, tao=True)
+
     namespace = root_namespace._path("uavcan")
     for top_namespace in namespace._namespaces():
         MODULE.__dict__[str(top_namespace)] = namespace.__dict__[top_namespace]
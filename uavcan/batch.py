@@ -0,0 +1,460 @@
+#encoding=utf-8
+
+import binascii
+import collections
+import logging as log
+
+
+import uavcan.dsdl as dsdl
+import uavcan.transport as transport
+
+
+# Batch conversion works on NumPy arrays; without NumPy the rest of the
+# library still works, but this module's functions are unavailable
+try:
+    import numpy
+except ImportError:
+    numpy = None
+    log.info("uavcan.batch cannot import NumPy; batch encoding and " +
+             "decoding will not be available.")
+
+
+# Column holding a dynamic array field for every payload in a batch: the
+# items for payload i are values[offsets[i]:offsets[i + 1]]
+RaggedColumn = collections.namedtuple("RaggedColumn", ["offsets", "values"])
+
+
+def dtype_for(uavcan_type):
+    "Returns the NumPy dtype that holds values of a primitive type."
+    if uavcan_type.kind == dsdl.parser.PrimitiveType.KIND_BOOLEAN:
+        return numpy.dtype(numpy.bool_)
+    elif uavcan_type.kind == dsdl.parser.PrimitiveType.KIND_FLOAT:
+        return numpy.dtype("<f{0:d}".format(uavcan_type.bitlen // 8))
+
+    for nbytes in (1, 2, 4, 8):
+        if uavcan_type.bitlen <= nbytes * 8:
+            break
+    if uavcan_type.kind == dsdl.parser.PrimitiveType.KIND_SIGNED_INT:
+        return numpy.dtype("<i{0:d}".format(nbytes))
+    else:
+        return numpy.dtype("<u{0:d}".format(nbytes))
+
+
+def _leaves(uavcan_type, mode=None, prefix="", base_offset=0):
+    # Flattens a compound type into (column name, path, type, offset)
+    # tuples. Nested compounds are expanded into dotted column names; the
+    # offset is the field's static bit offset in the payload, or None if
+    # it follows a dynamic array.
+    fields = transport.compound_fields(uavcan_type, mode)[0]
+    layout = transport.field_layout(uavcan_type, mode)
+    for field, offset in zip(fields, layout.offsets):
+        if base_offset is None or offset is None:
+            offset = None
+        else:
+            offset += base_offset
+
+        name = prefix + field.name
+        if isinstance(field.type, dsdl.parser.CompoundType):
+            for leaf in _leaves(field.type, None, name + ".", offset):
+                yield (leaf[0], (field.name, ) + leaf[1], leaf[2], leaf[3])
+        else:
+            yield (name, (field.name, ), field.type, offset)
+
+
+def _split_leaves(compound_type, mode):
+    # Separates the columns of a type into those at a static offset, which
+    # are converted for all payloads at once, and the rest. Also returns
+    # the number of bits spanned by the former.
+    leaves = list(_leaves(compound_type, mode))
+    vectorized = []
+    deferred = []
+    for name, path, uavcan_type, offset in leaves:
+        if offset is not None and (
+                isinstance(uavcan_type, dsdl.parser.PrimitiveType) or
+                (uavcan_type.mode == dsdl.parser.ArrayType.MODE_STATIC and
+                 isinstance(uavcan_type.value_type,
+                            dsdl.parser.PrimitiveType))):
+            vectorized.append((name, uavcan_type, offset))
+        else:
+            deferred.append((name, path, uavcan_type))
+
+    prefix_bitlen = max([0] + [offset + transport.fixed_bitlen(t)
+                               for _, t, offset in vectorized])
+    return leaves, vectorized, deferred, prefix_bitlen
+
+
+def _value_bits(bitlen):
+    # For each bit of a field in stream order, the bit of the field's value
+    # it holds under the UAVCAN byte order
+    return [transport.le_from_raw(1 << (bitlen - 1 - j), bitlen).bit_length()
+            - 1 for j in xrange(bitlen)]
+
+
+def _primitive_columns(uavcan_type, offset):
+    # Yields (offset, primitive type, column index) for the primitive
+    # values making up a vectorized column
+    if isinstance(uavcan_type, dsdl.parser.PrimitiveType):
+        yield offset, uavcan_type, None
+    else:
+        item_type = uavcan_type.value_type
+        for i in xrange(uavcan_type.max_size):
+            yield offset + i * item_type.bitlen, item_type, i
+
+
+def _payload_matrix(payloads, min_width):
+    # Copies the payloads into an (N, max length) array of bytes, padding
+    # short payloads with zeros
+    lengths = numpy.array([len(p) for p in payloads], dtype=numpy.intp)
+    width = max([min_width] + [len(p) for p in payloads])
+    if len(payloads) and (lengths == width).all():
+        data = numpy.frombuffer(b"".join(bytes(p) for p in payloads),
+                                dtype=numpy.uint8)
+        return data.reshape(len(payloads), width), lengths
+
+    matrix = numpy.zeros((len(payloads), width), dtype=numpy.uint8)
+    for i, payload in enumerate(payloads):
+        matrix[i, 0:len(payload)] = numpy.frombuffer(bytes(payload),
+                                                     dtype=numpy.uint8)
+    return matrix, lengths
+
+
+class _BitMatrix(object):
+    # Extracts fixed-position fields from every row of a payload matrix at
+    # once. The unpacked bit matrix is only built if a field isn't
+    # byte-aligned.
+    def __init__(self, matrix):
+        self.matrix = matrix
+        self._bits = None
+
+    def extract(self, offset, bitlen):
+        "Returns the unsigned value of a field in each row, as uint64."
+        if not offset & 7 and bitlen in (8, 16, 32, 64):
+            start = offset // 8
+            column = numpy.ascontiguousarray(
+                self.matrix[:, start:start + bitlen // 8])
+            return column.view("<u{0:d}".format(bitlen // 8)).reshape(
+                len(self.matrix)).astype(numpy.uint64)
+
+        if self._bits is None:
+            self._bits = numpy.unpackbits(self.matrix, axis=1)
+
+        # Stream bit j of the field lands at the value bit given by the
+        # UAVCAN byte order
+        weights = numpy.uint64(1) << numpy.array(_value_bits(bitlen),
+                                                 dtype=numpy.uint64)
+        return numpy.dot(
+            self._bits[:, offset:offset + bitlen].astype(numpy.uint64),
+            weights)
+
+
+def f16_from_f32(values):
+    """Vectorized transport.f16_from_f32: returns the float16 bit patterns
+    of an array of values as uint64. Like the scalar conversion, values are
+    rounded to float32, then the mantissa is truncated and values too small
+    for a normal float16 are flushed to zero, so the bits differ from
+    NumPy's own float16 rounding."""
+    f32 = numpy.asarray(values, dtype=numpy.float32).view(numpy.uint32) \
+        .astype(numpy.int64)
+    sign = (f32 >> 16) & 0x8000
+    exponent = ((f32 >> 23) & 0xFF) - 127
+    mantissa = f32 & 0x007FFFFF
+
+    f16 = numpy.where(exponent > -15,
+                      sign | ((exponent + 15) << 10) | (mantissa >> 13),
+                      sign)
+    f16 = numpy.where(exponent > 15, sign | 0x7C00, f16)
+    f16 = numpy.where(exponent == 128, sign | 0x7C00 | (mantissa & 0x3FF),
+                      f16)
+    return f16.astype(numpy.uint64)
+
+
+def _convert(raw, uavcan_type):
+    # Converts unsigned uint64 field values to the column's dtype
+    dtype = dtype_for(uavcan_type)
+    if uavcan_type.kind == dsdl.parser.PrimitiveType.KIND_SIGNED_INT:
+        values = raw.view(numpy.int64)
+        if uavcan_type.bitlen < 64:
+            sign = numpy.int64(1) << (uavcan_type.bitlen - 1)
+            values = (values ^ sign) - sign
+        return values.astype(dtype)
+    elif uavcan_type.kind == dsdl.parser.PrimitiveType.KIND_FLOAT:
+        int_dtype = "<u{0:d}".format(uavcan_type.bitlen // 8)
+        bits = raw.astype(int_dtype)
+        if uavcan_type.bitlen == 16:
+            # transport.f32_from_f16 decodes subnormals as (signed) zero
+            bits = numpy.where(bits & 0x7C00, bits,
+                               bits & 0x8000).astype(int_dtype)
+        return bits.view(dtype)
+    else:
+        return raw.astype(dtype)
+
+
+def decode_batch(compound_type, payloads, mode=None, tao=True):
+    """Decodes a sequence of serialized payloads, all of the same compound
+    type, into a dict of NumPy columns keyed by field name (with nested
+    compound fields flattened into dotted names).
+
+    Primitive fields become 1-D arrays and static arrays of primitives
+    2-D arrays with one row per payload. Dynamic arrays of primitives
+    become a RaggedColumn. Arrays of compound values are returned as
+    object arrays holding the decoded ArrayValue for each payload.
+
+    Fields at a fixed position in the payload -- everything up to the
+    first dynamic array -- are extracted for all payloads at once;
+    fields after that are decoded one payload at a time.
+
+    `mode` selects the request or response half of a service type, and
+    `tao` whether the payloads use tail array optimization (as complete
+    transfer payloads do)."""
+    if numpy is None:
+        raise RuntimeError("NumPy not imported; batch decoding is not " +
+                           "available")
+
+    leaves, vectorized, deferred, prefix_bitlen = \
+        _split_leaves(compound_type, mode)
+    matrix, lengths = _payload_matrix(payloads, (prefix_bitlen + 7) // 8)
+    bit_matrix = _BitMatrix(matrix)
+    columns = {}
+
+    for name, uavcan_type, offset in vectorized:
+        end = offset + transport.fixed_bitlen(uavcan_type)
+        short = numpy.nonzero(lengths * 8 < end)[0]
+        if len(short):
+            raise ValueError(("Payload {0:d} too short for field {1}; " +
+                              "need {2:d} bits but got {3:d}").format(
+                              short[0], name, end, lengths[short[0]] * 8))
+
+        parts = [_convert(bit_matrix.extract(o, t.bitlen), t)
+                 for o, t, _ in _primitive_columns(uavcan_type, offset)]
+        if isinstance(uavcan_type, dsdl.parser.PrimitiveType):
+            columns[name] = parts[0]
+        else:
+            columns[name] = numpy.column_stack(parts).reshape(
+                len(payloads), uavcan_type.max_size)
+
+    if deferred:
+        columns.update(_decode_deferred(compound_type, payloads, mode, tao,
+                                        deferred))
+
+    # Keep the columns in field order
+    return collections.OrderedDict((leaf[0], columns[leaf[0]])
+                                   for leaf in leaves)
+
+
+def _decode_deferred(compound_type, payloads, mode, tao, leaves):
+    # Decodes the remaining fields one payload at a time. Decoding starts
+    # at the first top-level field with a deferred column, which always has
+    # a static offset, so the fields already extracted aren't decoded again.
+    fields = transport.compound_fields(compound_type, mode)[0]
+    layout = transport.field_layout(compound_type, mode)
+    first = min(layout.index[path[0]] for _, path, _ in leaves)
+
+    rows = collections.defaultdict(list)
+    for payload in payloads:
+        stream = transport.BitStreamReader(payload, layout.offsets[first])
+        values = {}
+        for field in fields[first:]:
+            values[field.name] = transport.new_value(
+                field.type, tao=tao and field is fields[-1])
+            values[field.name]._unpack(stream)
+
+        for name, path, _ in leaves:
+            field = values[path[0]]
+            for attr in path[1:]:
+                field = getattr(field, attr)
+            if isinstance(field, transport.PrimitiveValue):
+                field = field.value
+            rows[name].append(field)
+
+    columns = {}
+    for name, path, uavcan_type in leaves:
+        if isinstance(uavcan_type, dsdl.parser.PrimitiveType):
+            columns[name] = numpy.array(rows[name],
+                                        dtype=dtype_for(uavcan_type))
+        elif not isinstance(uavcan_type.value_type,
+                            dsdl.parser.PrimitiveType):
+            column = numpy.empty(len(payloads), dtype=object)
+            column[:] = rows[name]
+            columns[name] = column
+        elif uavcan_type.mode == dsdl.parser.ArrayType.MODE_STATIC:
+            columns[name] = numpy.array(
+                [list(items) for items in rows[name]],
+                dtype=dtype_for(uavcan_type.value_type)).reshape(
+                len(payloads), uavcan_type.max_size)
+        else:
+            offsets = numpy.zeros(len(payloads) + 1, dtype=numpy.intp)
+            offsets[1:] = numpy.cumsum([len(items) for items in rows[name]])
+            values = numpy.array(
+                [item for items in rows[name] for item in items],
+                dtype=dtype_for(uavcan_type.value_type))
+            columns[name] = RaggedColumn(offsets, values)
+    return columns
+
+
+def cast_array(values, uavcan_type):
+    """Vectorized counterpart of transport.cast combined with the
+    PrimitiveValue setter: applies the type's saturation or truncation to
+    an array of values and returns their serialized bit patterns as
+    uint64."""
+    values = numpy.asarray(values)
+    low, high = uavcan_type.value_range
+    saturated = \
+        uavcan_type.cast_mode == dsdl.parser.PrimitiveType.CAST_MODE_SATURATED
+    mask = numpy.uint64((1 << uavcan_type.bitlen) - 1)
+
+    if uavcan_type.kind == dsdl.parser.PrimitiveType.KIND_BOOLEAN:
+        return (values != 0).astype(numpy.uint64)
+    elif uavcan_type.kind == dsdl.parser.PrimitiveType.KIND_FLOAT:
+        if saturated:
+            values = numpy.clip(values, low, high)
+        else:
+            values = numpy.where(values > high, numpy.inf,
+                                 numpy.where(values < low, -numpy.inf,
+                                             values))
+        if uavcan_type.bitlen == 16:
+            return f16_from_f32(values)
+        return values.astype(numpy.float32).view(numpy.uint32).astype(
+            numpy.uint64)
+    elif not saturated:
+        if values.dtype.kind == "f":
+            values = values.astype(numpy.int64)
+        return values.astype(numpy.uint64) & mask
+    elif uavcan_type.kind == dsdl.parser.PrimitiveType.KIND_UNSIGNED_INT:
+        if values.dtype.kind != "u":
+            values = numpy.maximum(values, 0)
+        return numpy.minimum(values.astype(numpy.uint64), numpy.uint64(high))
+    else:
+        if values.dtype.kind == "u":
+            values = numpy.minimum(values, numpy.uint64((1 << 63) - 1))
+        # The 64-bit range computed by the DSDL parser is off by one due to
+        # float rounding; keep the limits representable
+        low = numpy.int64(max(low, -(1 << 63)))
+        high = numpy.int64(min(high, (1 << 63) - 1))
+        values = numpy.clip(values.astype(numpy.int64), low, high)
+        return values.view(numpy.uint64) & mask
+
+
+def encode_batch(compound_type, columns, mode=None, tao=True):
+    """Encodes a batch of values of one compound type, given as columns in
+    the format returned by decode_batch, and returns the list of
+    serialized payloads.
+
+    Fields at a fixed position in the payload are cast and packed for the
+    whole batch at once; fields from the first dynamic array onwards are
+    encoded one payload at a time."""
+    if numpy is None:
+        raise RuntimeError("NumPy not imported; batch encoding is not " +
+                           "available")
+
+    leaves, vectorized, deferred, prefix_bitlen = \
+        _split_leaves(compound_type, mode)
+    first_column = columns[leaves[0][0]] if leaves else ()
+    if isinstance(first_column, RaggedColumn):
+        count = len(first_column.offsets) - 1
+    else:
+        count = len(first_column)
+
+    # Fields which are byte-aligned and a whole number of bytes long are
+    # written straight into the payload matrix; all others are set bit by
+    # bit in a bit matrix which is then packed into it
+    matrix = numpy.zeros((count, (prefix_bitlen + 7) // 8),
+                         dtype=numpy.uint8)
+    bits = None
+    aligned = []
+    for name, uavcan_type, offset in vectorized:
+        column = numpy.asarray(columns[name])
+        for o, t, i in _primitive_columns(uavcan_type, offset):
+            raw = cast_array(column if i is None else column[:, i], t)
+            if not o & 7 and t.bitlen in (8, 16, 32, 64):
+                aligned.append((o, t.bitlen, raw))
+                continue
+
+            if bits is None:
+                bits = numpy.zeros((count, matrix.shape[1] * 8),
+                                   dtype=numpy.uint8)
+            for j, value_bit in enumerate(_value_bits(t.bitlen)):
+                bits[:, o + j] = (raw >> numpy.uint64(value_bit)) & \
+                                 numpy.uint64(1)
+
+    if bits is not None:
+        matrix = numpy.packbits(bits, axis=1)
+    for offset, bitlen, raw in aligned:
+        nbytes = bitlen // 8
+        matrix[:, offset // 8:offset // 8 + nbytes] = \
+            raw.astype("<u{0:d}".format(nbytes)).view(numpy.uint8).reshape(
+                count, nbytes)
+
+    if not deferred:
+        return [bytearray(row.tostring()) for row in matrix]
+    return _encode_deferred(compound_type, columns, mode, tao, deferred,
+                            matrix, count)
+
+
+def _encode_deferred(compound_type, columns, mode, tao, leaves, matrix,
+                     count):
+    # Encodes the remaining fields one payload at a time, after the static
+    # prefix up to the first top-level field with a deferred column
+    fields = transport.compound_fields(compound_type, mode)[0]
+    layout = transport.field_layout(compound_type, mode)
+    first = min(layout.index[path[0]] for _, path, _ in leaves)
+    prefix_bitlen = layout.offsets[first]
+
+    # Every column touching the fields from `first` onwards is needed here,
+    # including any that were vectorized
+    rows = {}
+    for name, path, uavcan_type, _ in _leaves(compound_type, mode):
+        if layout.index[path[0]] < first:
+            continue
+        column = columns[name]
+        if isinstance(column, RaggedColumn):
+            offsets = column.offsets.tolist()
+            values = column.values.tolist()
+            rows[name] = (path, [values[offsets[i]:offsets[i + 1]]
+                                 for i in xrange(count)])
+        elif isinstance(column, numpy.ndarray) and column.dtype != object:
+            rows[name] = (path, column.tolist())
+        else:
+            rows[name] = (path, list(column))
+
+    payloads = []
+    for i in xrange(count):
+        stream = transport.BitStreamWriter()
+        if prefix_bitlen:
+            prefix = matrix[i].tostring()[0:(prefix_bitlen + 7) // 8]
+            raw = int(binascii.hexlify(prefix), 16)
+            stream.write_raw(raw >> (-prefix_bitlen & 7), prefix_bitlen)
+
+        values = collections.OrderedDict()
+        for field in fields[first:]:
+            values[field.name] = transport.new_value(
+                field.type, tao=tao and field is fields[-1])
+        for path, column_rows in rows.itervalues():
+            _set_leaf(values, path, column_rows[i])
+
+        for value in values.itervalues():
+            value._pack(stream)
+        payloads.append(stream.getvalue())
+    return payloads
+
+
+def _set_leaf(values, path, item):
+    # Stores one row of a column into the value tree being encoded
+    parent = values
+    for attr in path[0:-1]:
+        parent = parent[attr] if parent is values else getattr(parent, attr)
+    field = parent[path[-1]] if parent is values else \
+            parent._values[parent._layout.index[path[-1]]]
+
+    if isinstance(field, transport.PrimitiveValue):
+        field.value = item
+    elif isinstance(item, transport.ArrayValue):
+        if parent is values:
+            values[path[-1]] = item
+        else:
+            parent._values[parent._layout.index[path[-1]]] = item
+    elif field.type.mode == dsdl.parser.ArrayType.MODE_STATIC:
+        for idx, value in enumerate(item):
+            field[idx] = value
+    else:
+        del field[:]
+        field.extend(item)
@@ -3,11 +3,16 @@
 import os
 import sys
 import time
+import errno
 import socket
 import fcntl
 import struct
+import ctypes
+import ctypes.util
 import binascii
 import functools
+import itertools
+import collections
 import logging as log
 
 
@@ -33,7 +38,7 @@ try:
 except Exception:
     import ctypes
     import ctypes.util
-    libc = ctypes.CDLL(ctypes.util.find_library("c"))
+    libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
 
     # from linux/can.h
     CAN_RAW = 1
@@ -97,12 +102,27 @@ except Exception:
             return ctypes.string_at(ctypes.byref(frame),
                                     ctypes.sizeof(frame))[0:nbytes]
 
+        def recv_into(self, buffer, nbytes=0, flags=None):
+            frame = can_frame()
+            nbytes = libc.read(self.fd, ctypes.byref(frame),
+                               ctypes.sizeof(frame))
+            if nbytes <= 0:
+                return 0
+            buffer[0:nbytes] = ctypes.string_at(ctypes.byref(frame), nbytes)
+            return nbytes
+
         def send(self, data, flags=None):
             frame = can_frame()
             ctypes.memmove(ctypes.byref(frame), data,
                            ctypes.sizeof(frame))
-            return libc.write(self.fd, ctypes.byref(frame),
-                              ctypes.sizeof(frame))
+            nbytes = libc.write(self.fd, ctypes.byref(frame),
+                                ctypes.sizeof(frame))
+            if nbytes < 0:
+                # Raised like a socket's error, so callers can tell a full
+                # queue (EAGAIN, ENOBUFS) from a failure
+                error = ctypes.get_errno()
+                raise socket.error(error, os.strerror(error))
+            return nbytes
 
         def fileno(self):
             return self.fd
@@ -130,45 +150,162 @@ CAN_EFF_FLAG = 0x80000000
 CAN_EFF_MASK = 0x1FFFFFFF
 
 
+# recvmmsg(2) and sendmmsg(2) read or write many datagrams -- here CAN
+# frames -- in one system call. They aren't exposed by the socket module, so
+# they are called through ctypes where the C library has them; otherwise
+# frames are read and written one at a time.
+try:
+    _libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+    _libc.recvmmsg
+except (OSError, AttributeError):
+    _libc = None
+_sendmmsg = getattr(_libc, "sendmmsg", None)
+
+# from linux/socket.h
+MSG_DONTWAIT = 0x40
+
+
+class iovec(ctypes.Structure):
+    _fields_ = [
+        ("iov_base", ctypes.c_void_p),
+        ("iov_len", ctypes.c_size_t)
+    ]
+
+
+class msghdr(ctypes.Structure):
+    _fields_ = [
+        ("msg_name", ctypes.c_void_p),
+        ("msg_namelen", ctypes.c_uint32),
+        ("msg_iov", ctypes.POINTER(iovec)),
+        ("msg_iovlen", ctypes.c_size_t),
+        ("msg_control", ctypes.c_void_p),
+        ("msg_controllen", ctypes.c_size_t),
+        ("msg_flags", ctypes.c_int)
+    ]
+
+
+class mmsghdr(ctypes.Structure):
+    _fields_ = [
+        ("msg_hdr", msghdr),
+        ("msg_len", ctypes.c_uint)
+    ]
+
+
+def _mmsghdrs(buffer, size, count):
+    """Returns an array of `count` mmsghdr structures, each with a single
+    iovec pointing at the next `size` bytes of the bytearray `buffer`."""
+    c_buffer = (ctypes.c_char * len(buffer)).from_buffer(buffer)
+    iovecs = (iovec * count)()
+    msgs = (mmsghdr * count)()
+    for i in range(count):
+        iovecs[i].iov_base = ctypes.addressof(c_buffer) + i * size
+        iovecs[i].iov_len = size
+        msgs[i].msg_hdr.msg_iov = ctypes.pointer(iovecs[i])
+        msgs[i].msg_hdr.msg_iovlen = 1
+    # Keep the buffer and iovecs alive for as long as the headers
+    msgs._buffers = (c_buffer, iovecs)
+    return msgs
+
+
 class SocketCAN(object):
+    # struct can_frame, as read from and written to a raw CAN socket
+    FRAME = struct.Struct("=IB3x8s")
+    # Maximum number of frames read or written per system call
+    RX_BATCH = 64
+    TX_BATCH = 64
+    # Seconds to wait before retrying a send which failed with ENOBUFS
+    TX_RETRY_DELAY = 0.001
+
     def __init__(self, interface):
         self.interface = interface
         self.socket = None
-
-    def _read(self, fd, events, callback=None):
+        self._ioloop = None
+        self._handler_events = None
+        # Frames are read into a preallocated buffer and decoded from there
+        size = self.FRAME.size
+        self._rx_buffer = bytearray(size * self.RX_BATCH)
+        self._rx_msgs = _mmsghdrs(self._rx_buffer, size,
+                                  self.RX_BATCH) if _libc else None
+        view = memoryview(self._rx_buffer)
+        self._rx_views = [(offset, view[offset:offset + size])
+                          for offset in range(0, len(view), size)]
+        # Frames waiting to be sent, as (CAN ID, DLC, data) tuples
+        self._tx_queue = collections.deque()
+        self._tx_buffer = bytearray(size * self.TX_BATCH)
+        self._tx_msgs = _mmsghdrs(self._tx_buffer, size,
+                                  self.TX_BATCH) if _sendmmsg else None
+        # True while a flush is scheduled on the IO loop
+        self._tx_scheduled = False
+
+    def _read_frames(self):
+        """Returns the (message ID, data, extended) tuples for up to RX_BATCH
+        frames waiting on the socket."""
+        size = self.FRAME.size
+        if self._rx_msgs is not None:
+            count = _libc.recvmmsg(self.socket.fileno(), self._rx_msgs,
+                                   self.RX_BATCH, MSG_DONTWAIT, None)
+            if count < 0:
+                error = ctypes.get_errno()
+                if error in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+                    return []
+                raise OSError(error, os.strerror(error))
+            offsets = [i * size for i in range(count)
+                       if self._rx_msgs[i].msg_len == size]
+        else:
+            recv_into = self.socket.recv_into
+            offsets = []
+            for offset, view in self._rx_views:
+                try:
+                    nbytes = recv_into(view, size)
+                except socket.error:
+                    break
+                if nbytes != size:
+                    break
+                offsets.append(offset)
+
+        unpack_from = self.FRAME.unpack_from
         messages = []
-        packet = self.socket.recv(16)
-        while len(packet) == 16:
-            can_id, can_dlc, can_data = \
-                struct.unpack("=IB3x8s", packet)
-            message = (can_id & CAN_EFF_MASK, can_data[0:can_dlc],
-                       True if (can_id & CAN_EFF_FLAG) else False)
-            messages.append(message)
+        for offset in offsets:
+            can_id, can_dlc, can_data = unpack_from(self._rx_buffer, offset)
+            messages.append((can_id & CAN_EFF_MASK, can_data[0:can_dlc],
+                             True if (can_id & CAN_EFF_FLAG) else False))
+        return messages
 
-            try:
-                packet = self.socket.recv(16)
-            except Exception:
-                break
+    def _read(self, fd, events, callback=None, batch_callback=None):
+        messages = self._read_frames()
 
-        if callback:
+        if log.getLogger().isEnabledFor(log.DEBUG):
             for message in messages:
                 log.debug("CAN.recv(): {!r} data:{}".format(message, binascii.hexlify(message[1])))
-                try:
-                    callback(self, message)
-                except Exception:
-                    raise
-        else:
+
+        if batch_callback:
+            if messages:
+                batch_callback(self, messages)
+        elif callback:
             for message in messages:
-                log.debug("CAN.recv(): {!r} data:{}".format(message, binascii.hexlify(message[1])))
+                callback(self, message)
+        else:
             return messages
 
     def _recv(self, callback=None):
         return self._read(0, None, callback)
 
-    def add_to_ioloop(self, ioloop, callback=None):
+    def _handle_events(self, fd, events, callback=None, batch_callback=None):
+        if events & self._ioloop.WRITE:
+            self.flush()
+        if events & self._ioloop.READ:
+            self._read(fd, events, callback, batch_callback)
+
+    def add_to_ioloop(self, ioloop, callback=None, batch_callback=None):
+        """Calls `callback(driver, message)` for each frame received, or
+        `batch_callback(driver, messages)` once per batch of frames read
+        together. Frames sent afterwards are written from the IO loop."""
+        self._ioloop = ioloop
+        self._handler_events = ioloop.READ
         ioloop.add_handler(
             self.socket.fileno(),
-            functools.partial(self._read, callback=callback),
+            functools.partial(self._handle_events, callback=callback,
+                              batch_callback=batch_callback),
             ioloop.READ)
 
     def open(self, callback=None):
@@ -177,13 +314,100 @@ class SocketCAN(object):
     def close(self, callback=None):
         self.socket.close()
 
-    def send(self, message_id, message, extended=False):
-        log.debug("CAN.send({!r}, {!r}, {!r})".format(message_id, binascii.hexlify(message),
-                                                      extended))
+    @property
+    def tx_queue_depth(self):
+        """Number of frames queued but not yet accepted by the kernel."""
+        return len(self._tx_queue)
+
+    def _write_frames(self):
+        """Writes up to TX_BATCH frames from the head of the queue. Returns
+        the number written, and the errno which stopped the write (if any)."""
+        queue = self._tx_queue
+        if self._tx_msgs is not None:
+            size = self.FRAME.size
+            pack_into = self.FRAME.pack_into
+            count = 0
+            for frame in itertools.islice(queue, self.TX_BATCH):
+                pack_into(self._tx_buffer, count * size, *frame)
+                count += 1
+
+            sent = _sendmmsg(self.socket.fileno(), self._tx_msgs, count,
+                             MSG_DONTWAIT)
+            if sent < 0:
+                return 0, ctypes.get_errno()
+            # After a partial write the next call reports the error
+            return sent, None
+        else:
+            try:
+                self.socket.send(self.FRAME.pack(*queue[0]))
+            except socket.error as e:
+                return 0, e.errno
+            return 1, None
+
+    def flush(self):
+        """Writes queued frames until the queue is empty or the kernel's
+        transmit queue is full. When added to an IO loop, the remaining frames
+        are retried once the socket is writable. Returns the queue depth.
+
+        Other errors drop the frame that failed and raise OSError."""
+        self._tx_scheduled = False
+        queue = self._tx_queue
+        error = None
+        while queue:
+            sent, error = self._write_frames()
+            for i in range(sent):
+                queue.popleft()
+            if error == errno.EINTR:
+                error = None
+            elif error:
+                break
 
-        message_pad = bytes(message) + b"\x00" * (8 - len(message))
-        self.socket.send(struct.pack("=IB3x8s", message_id | CAN_EFF_FLAG,
-                                     len(message), message_pad))
+        failed = error not in (None, errno.EAGAIN, errno.EWOULDBLOCK,
+                               errno.ENOBUFS)
+        if failed:
+            # Any other error is down to the frame at the head of the queue
+            # or the interface; the frame is dropped so the queue can't grow
+            # behind it, and the rest are tried again
+            queue.popleft()
+
+        if self._ioloop is not None:
+            # Wait for writability after EAGAIN; CAN sockets stay writable
+            # while the interface queue is full (ENOBUFS), so that is retried
+            # after a delay instead.
+            events = self._ioloop.READ
+            if failed:
+                if queue:
+                    self._tx_scheduled = True
+                    self._ioloop.add_callback(self.flush)
+            elif error == errno.ENOBUFS:
+                self._tx_scheduled = True
+                self._ioloop.call_later(self.TX_RETRY_DELAY, self.flush)
+            elif error:
+                self._tx_scheduled = True
+                events |= self._ioloop.WRITE
+            if events != self._handler_events:
+                self._handler_events = events
+                self._ioloop.update_handler(self.socket.fileno(), events)
+
+        if failed:
+            raise OSError(error, os.strerror(error))
+        return len(queue)
+
+    def send(self, message_id, message, extended=False):
+        """Queues a frame for transmission. Outside an IO loop the queue is
+        flushed immediately; inside one, frames sent in the same iteration are
+        written together."""
+        if log.getLogger().isEnabledFor(log.DEBUG):
+            log.debug("CAN.send({!r}, {!r}, {!r})".format(message_id, binascii.hexlify(message),
+                                                          extended))
+
+        self._tx_queue.append((message_id | CAN_EFF_FLAG, len(message),
+                               bytes(message)))
+        if self._ioloop is None:
+            self.flush()
+        elif not self._tx_scheduled:
+            self._tx_scheduled = True
+            self._ioloop.add_callback(self.flush)
 
 
 class SLCAN(object):
@@ -203,8 +427,9 @@ class SLCAN(object):
     def _get_bytes_async(self):
         return os.read(self.conn.fd, 1024)
 
-    def _ioloop_event_handler(self, fd, events, callback=None):
-        self._recv(callback=callback)
+    def _ioloop_event_handler(self, fd, events, callback=None,
+                              batch_callback=None):
+        self._recv(callback=callback, batch_callback=batch_callback)
 
     def _parse(self, message):
         try:
@@ -224,7 +449,7 @@ class SLCAN(object):
         except Exception:
             return None
 
-    def _recv(self, callback=None):
+    def _recv(self, callback=None, batch_callback=None):
         bytes = ""
         new_bytes = self._read_handler()
         while new_bytes:
@@ -232,7 +457,7 @@ class SLCAN(object):
             new_bytes = self._read_handler()
 
         if not bytes:
-            if callback:
+            if callback or batch_callback:
                 return
             else:
                 return []
@@ -254,7 +479,12 @@ class SLCAN(object):
                         if m and m[0] in ("t", "T"))
         messages = filter(lambda x: x and x[0], messages)
 
-        if callback:
+        if batch_callback:
+            for message in messages:
+                log.debug("CAN.recv(): {!r}".format(message))
+            if messages:
+                batch_callback(self, messages)
+        elif callback:
             for message in messages:
                 log.debug("CAN.recv(): {!r}".format(message))
                 try:
@@ -266,11 +496,15 @@ class SLCAN(object):
                 log.debug("CAN.recv(): {!r}".format(message))
             return messages
 
-    def add_to_ioloop(self, ioloop, callback=None):
+    def add_to_ioloop(self, ioloop, callback=None, batch_callback=None):
+        """Calls `callback(driver, message)` for each frame received, or
+        `batch_callback(driver, messages)` once per batch of frames read
+        together."""
         self._read_handler = self._get_bytes_async
         ioloop.add_handler(
             self.conn.fd,
-            functools.partial(self._ioloop_event_handler, callback=callback),
+            functools.partial(self._ioloop_event_handler, callback=callback,
+                              batch_callback=batch_callback),
             ioloop.READ)
 
     def open(self, callback=None):
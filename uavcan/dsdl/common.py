@@ -35,31 +35,92 @@ def pretty_filename(filename):
     return a if '..' in r else r
 
 
-def crc16_from_bytes(bytes, initial=0xFFFF):
-    # CRC-16-CCITT
-    # Initial value: 0xFFFF
-    # Poly: 0x1021
-    # Reverse: no
-    # Output xor: 0
-    # Check string: '123456789'
-    # Check value: 0x29B1
-
-    try:
-        if isinstance(bytes, basestring):  # Python 2.7 compatibility
-            bytes = map(ord, bytes)
-    except NameError:
-        if isinstance(bytes, str):  # This branch will be taken on Python 3
-            bytes = map(ord, bytes)
-
-    crc = initial
-    for byte in bytes:
-        crc ^= byte << 8
+try:
+    # binascii.crc_hqx computes the same CRC-16-CCITT in C
+    from binascii import crc_hqx as _crc_hqx
+except ImportError:
+    _crc_hqx = None
+
+
+def _make_crc16_table():
+    table = []
+    for byte in range(256):
+        crc = byte << 8
         for bit in range(8):
             if crc & 0x8000:
                 crc = ((crc << 1) ^ 0x1021) & 0xFFFF
             else:
                 crc = (crc << 1) & 0xFFFF
-    return crc & 0xFFFF
+        table.append(crc)
+    return tuple(table)
+
+CRC16_TABLE = _make_crc16_table()
+
+
+def crc16_update_table(crc, data_bytes):
+    '''Table-driven CRC-16-CCITT update, one lookup per byte. Used where
+    binascii.crc_hqx is not available or cannot take data_bytes.'''
+    table = CRC16_TABLE
+    for byte in bytearray(data_bytes):
+        crc = ((crc << 8) & 0xFF00) ^ table[(crc >> 8) ^ byte]
+    return crc
+
+
+def crc16_update(crc, data_bytes):
+    '''Returns crc updated with data_bytes (anything supporting the buffer
+    interface, or a sequence of byte values).'''
+    if _crc_hqx is not None:
+        try:
+            return _crc_hqx(data_bytes, crc)
+        except TypeError:
+            pass  # e.g. a list of integers
+    return crc16_update_table(crc, data_bytes)
+
+
+#
+# CRC-16-CCITT
+# Initial value: 0xFFFF
+# Poly: 0x1021
+# Reverse: no
+# Output xor: 0
+# Check string: '123456789'
+# Check value: 0x29B1
+#
+class CRC16:
+    '''
+    This class implements the transfer CRC, and can be fed the payload in
+    chunks as frames arrive.
+    '''
+    def __init__(self, initial=0xFFFF):
+        '''
+        initial    Initial value (optional), normally the data type's base CRC
+        '''
+        self._crc = int(initial) & 0xFFFF
+
+    def add(self, data_bytes):
+        '''Feed ASCII string, bytes, bytearray, memoryview or a sequence of
+        byte values to the CRC function'''
+        try:
+            if isinstance(data_bytes, unicode):  # Python 2.7 compatibility
+                data_bytes = data_bytes.encode('latin-1')
+        except NameError:
+            if isinstance(data_bytes, str):  # This branch will be taken on Python 3
+                data_bytes = data_bytes.encode('latin-1')
+        self._crc = crc16_update(self._crc, data_bytes)
+
+    def get_value(self):
+        '''Returns integer CRC value'''
+        return self._crc
+
+
+def crc16_from_bytes(bytes, initial=0xFFFF):
+    '''
+    One-shot CRC-16-CCITT computation for ASCII string or bytes.
+    Returns integer CRC value.
+    '''
+    crc = CRC16(initial)
+    crc.add(bytes)
+    return crc.get_value()
 
 
 def bytes_from_crc64(crc64):
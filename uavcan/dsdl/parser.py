@@ -10,7 +10,7 @@ import os, re, logging
 from io import StringIO
 from uavcan.dsdl.signature import compute_signature, Signature
 from uavcan.dsdl.common import DsdlException, pretty_filename, \
-                               bytes_from_crc64
+                               bytes_from_crc64, crc16_from_bytes
 from uavcan.dsdl.type_limits import get_unsigned_integer_range, \
                                     get_signed_integer_range, get_float_range
 
@@ -26,6 +26,11 @@ except NameError:
 
 MAX_FULL_TYPE_NAME_LEN = 80
 
+# Bumped whenever a compound type attribute that signatures depend on is
+# reassigned. Signatures cached on compound types are only valid for the
+# generation they were computed in, which also covers changes to nested types.
+_signature_generation = 0
+
 SERVICE_DATA_TYPE_ID_MAX = 255
 MESSAGE_DATA_TYPE_ID_MAX = 65535
 
@@ -160,10 +165,19 @@ class CompoundType(Type):
 
     Extra methods if kind == KIND_MESSAGE:
         get_max_bitlen()            Returns maximum total bit length for the serialized struct
+
+    Lazily computed fields:
+        base_crc            Transfer CRC initial value, the CRC-16 of the data type signature
+
+    The normalized definition, signatures and base_crc are computed once and cached. Reassigning any of
+    SIGNATURE_ATTRIBUTES on any compound type invalidates the cache; field lists must not be modified in place
+    once a signature has been computed.
     '''
     KIND_SERVICE = 0
     KIND_MESSAGE = 1
 
+    SIGNATURE_ATTRIBUTES = frozenset(['full_name', 'kind', 'fields', 'request_fields', 'response_fields'])
+
     def __init__(self, full_name, kind, source_file, default_dtid, source_text):
         Type.__init__(self, full_name, Type.CATEGORY_COMPOUND)
         self.source_file = source_file
@@ -185,11 +199,37 @@ class CompoundType(Type):
         else:
             error('Compound type of unknown kind [%s]', kind)
 
+    def __setattr__(self, name, value):
+        global _signature_generation
+        if name in CompoundType.SIGNATURE_ATTRIBUTES:
+            _signature_generation += 1
+        self.__dict__[name] = value
+
+    def __getattr__(self, name):
+        if name == 'base_crc':
+            return self._cached('base_crc', self._compute_base_crc)
+        raise AttributeError(name)
+
+    def _cached(self, key, compute):
+        '''Returns the cached result of compute(), calling it if the cache is missing or stale.'''
+        cache = self.__dict__.get('_signature_cache')
+        if cache is None or cache[0] != _signature_generation:
+            cache = self.__dict__['_signature_cache'] = (_signature_generation, {})
+        values = cache[1]
+        try:
+            return values[key]
+        except KeyError:
+            value = values[key] = compute()
+            return value
+
     def get_dsdl_signature_source_definition(self):
         '''
         Returns normalized DSDL definition text.
         Please refer to the specification for details about normalized DSDL definitions.
         '''
+        return self._cached('source_definition', self._compute_dsdl_signature_source_definition)
+
+    def _compute_dsdl_signature_source_definition(self):
         txt = StringIO()
         txt.write(self.full_name + '\n')
         adjoin = lambda attrs: txt.write('\n'.join(x.get_normalized_definition() for x in attrs) + '\n')
@@ -208,7 +248,8 @@ class CompoundType(Type):
         Computes DSDL signature of this type.
         Please refer to the specification for details about signatures.
         '''
-        return compute_signature(self.get_dsdl_signature_source_definition())
+        return self._cached('dsdl_signature',
+                            lambda: compute_signature(self.get_dsdl_signature_source_definition()))
 
     def get_data_type_signature(self):
         '''
@@ -216,6 +257,9 @@ class CompoundType(Type):
         guaranteed to match only if all nested data structures are compatible.
         Please refer to the specification for details about signatures.
         '''
+        return self._cached('data_type_signature', self._compute_data_type_signature)
+
+    def _compute_data_type_signature(self):
         sig = Signature(self.get_dsdl_signature())
         fields = self.request_fields + self.response_fields \
                  if self.kind == CompoundType.KIND_SERVICE else self.fields
@@ -227,6 +271,9 @@ class CompoundType(Type):
                 sig.add(bytes_from_crc64(sig_value))
         return sig.get_value()
 
+    def _compute_base_crc(self):
+        return crc16_from_bytes(bytes_from_crc64(self.get_data_type_signature()))
+
     def get_normalized_definition(self):
         '''Returns full type name string, e.g. "uavcan.protocol.NodeStatus"'''
         return self.full_name
@@ -5,6 +5,7 @@
 #
 
 from __future__ import division, absolute_import, print_function, unicode_literals
+import struct
 
 #
 # CRC-64-WE
@@ -18,10 +19,19 @@ from __future__ import division, absolute_import, print_function, unicode_litera
 class Signature:
     '''
     This class implements the UAVCAN DSDL signature hash function. Please refer to the specification for details.
+    Data is processed eight bytes at a time using slice-by-8 tables, so
+    large inputs such as firmware images can be fed in chunks.
     '''
     MASK64 = 0xFFFFFFFFFFFFFFFF
     POLY = 0x42F0E1EBA9EA3693
 
+    # TABLES[k][b] is the CRC contribution of byte b followed by k zero
+    # bytes; filled in below the class definition
+    TABLES = None
+
+    # Number of 64-bit words processed per struct.unpack_from call
+    WORDS_PER_BLOCK = 512
+
     def __init__(self, extend_from=None):
         '''
         extend_from    Initial value (optional)
@@ -32,27 +42,76 @@ class Signature:
             self._crc = Signature.MASK64
 
     def add(self, data_bytes):
-        '''Feed ASCII string or bytes to the signature function'''
+        '''Feed ASCII string, bytes, bytearray or memoryview to the signature function'''
         try:
-            if isinstance(data_bytes, basestring):  # Python 2.7 compatibility
-                data_bytes = map(ord, data_bytes)
+            if isinstance(data_bytes, unicode):  # Python 2.7 compatibility
+                data_bytes = data_bytes.encode('latin-1')
         except NameError:
             if isinstance(data_bytes, str):  # This branch will be taken on Python 3
-                data_bytes = map(ord, data_bytes)
+                data_bytes = data_bytes.encode('latin-1')
+
+        t0, t1, t2, t3, t4, t5, t6, t7 = Signature.TABLES
+        mask = Signature.MASK64
+        crc = self._crc
+        length = len(data_bytes)
+        words = length // 8
+        offset = 0
+
+        while words:
+            count = min(words, Signature.WORDS_PER_BLOCK)
+            for word in struct.unpack_from(str('>{0:d}Q').format(count),
+                                           data_bytes, offset):
+                x = crc ^ word
+                crc = (t7[x >> 56] ^ t6[(x >> 48) & 0xFF] ^
+                       t5[(x >> 40) & 0xFF] ^ t4[(x >> 32) & 0xFF] ^
+                       t3[(x >> 24) & 0xFF] ^ t2[(x >> 16) & 0xFF] ^
+                       t1[(x >> 8) & 0xFF] ^ t0[x & 0xFF])
+            offset += count * 8
+            words -= count
+
+        for b in bytearray(data_bytes[offset:length]):
+            crc = ((crc << 8) & mask) ^ t0[(crc >> 56) ^ b]
 
-        for b in data_bytes:
-            self._crc ^= (b << 56) & Signature.MASK64
-            for _ in range(8):
-                if self._crc & (1 << 63):
-                    self._crc = ((self._crc << 1) & Signature.MASK64) ^ Signature.POLY
-                else:
-                    self._crc <<= 1
+        self._crc = crc
+
+    def add_file(self, fileobj, chunk_size=65536):
+        '''Feed the remaining contents of a binary file object to the
+        signature function, chunk_size bytes at a time. Returns the number of
+        bytes read.'''
+        total = 0
+        while True:
+            chunk = fileobj.read(chunk_size)
+            if not chunk:
+                return total
+            self.add(chunk)
+            total += len(chunk)
 
     def get_value(self):
         '''Returns integer signature value'''
         return (self._crc & Signature.MASK64) ^ Signature.MASK64
 
 
+def _make_tables():
+    mask = Signature.MASK64
+    t0 = []
+    for b in range(256):
+        crc = b << 56
+        for _ in range(8):
+            if crc & (1 << 63):
+                crc = ((crc << 1) & mask) ^ Signature.POLY
+            else:
+                crc = (crc << 1) & mask
+        t0.append(crc)
+
+    tables = [tuple(t0)]
+    for _ in range(7):
+        tables.append(tuple(((crc << 8) & mask) ^ t0[crc >> 56]
+                            for crc in tables[-1]))
+    return tuple(tables)
+
+Signature.TABLES = _make_tables()
+
+
 def compute_signature(data):
     '''
     One-shot signature computation for ASCII string or bytes.
@@ -198,11 +198,11 @@ class FileGetInfoHandler(uavcan.node.ServiceHandler):
         try:
             vpath = self.request.path.path.decode()
             with open(os.path.join(self.base_path, vpath), "rb") as fw:
-                data = fw.read()
+                crc64 = uavcan.dsdl.signature.Signature()
+                size = crc64.add_file(fw)
                 self.response.error.value = self.response.error.OK
-                self.response.size = len(data)
-                self.response.crc64 = \
-                    uavcan.dsdl.signature.compute_signature(data)
+                self.response.size = size
+                self.response.crc64 = crc64.get_value()
                 self.response.entry_type.flags = \
                     (self.response.entry_type.FLAG_FILE |
                      self.response.entry_type.FLAG_READABLE)
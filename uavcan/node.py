@@ -25,15 +25,47 @@ except ImportError:
     pass
 
 
+class PendingRequest(object):
+    """A service request awaiting its response, keyed by (server node ID,
+    data type ID, transfer ID) -- the fields the response will carry. The
+    future resolves to a (payload, transfer) tuple for the response."""
+    __slots__ = ("key", "transfer", "future", "deadline")
+
+    def __init__(self, transfer, future, deadline):
+        self.key = (transfer.dest_node_id, transfer.data_type_id,
+                    transfer.transfer_id)
+        self.transfer = transfer
+        self.future = future
+        self.deadline = deadline
+
+
 class Node(object):
-    def __init__(self, handlers, node_id=127):
+    # Seconds to wait for a service response
+    REQUEST_TIMEOUT = 1.0
+    # Seconds a partially received transfer is kept without a new frame
+    TRANSFER_TIMEOUT = 1.0
+    # Interval of the timeout sweep in milliseconds
+    SWEEP_INTERVAL = 100
+
+    def __init__(self, handlers, node_id=127, lazy_decode=False,
+                 stream_decode=False):
         self.can = None
-        self.transfer_manager = transport.TransferManager()
-        self.handlers = handlers
+        # Decode received payload fields only when a handler reads them
+        self.lazy_decode = lazy_decode
+        # Decode multi-frame payloads as their frames arrive, so little is
+        # left to do once the last one has; ignored if lazy_decode is set
+        self.transfer_manager = transport.TransferManager(
+            timeout=self.TRANSFER_TIMEOUT,
+            streaming=stream_decode and not lazy_decode)
+        # Handler factories (the handler class with its keyword arguments
+        # bound) by (data type ID, kind), in registration order
+        self._handler_index = collections.defaultdict(list)
+        for handler in handlers:
+            self.add_handler(*handler)
         self.node_id = node_id
-        self.outstanding_requests = {}
-        self.outstanding_request_callbacks = {}
-        self.outstanding_request_timestamps = {}
+        # PendingRequest objects by key, and their deadlines
+        self.pending_requests = {}
+        self.request_deadlines = transport.DeadlineQueue()
         self.next_transfer_ids = collections.defaultdict(int)
         self.node_info = {}
 
@@ -45,38 +77,33 @@ class Node(object):
         frame = transport.Frame(frame_id, frame_data)
         # logging.debug("Node._recv_frame(): got {0!s}".format(frame))
 
-        transfer_frames = self.transfer_manager.receive_frame(frame)
-        if not transfer_frames:
+        try:
+            if frame.bytes[-1] & 0xC0 == 0xC0:
+                # Start and end of transfer are both set, so this is a
+                # single-frame transfer; decode it without going through the
+                # transfer manager
+                transfer = transport.Transfer()
+                transfer.from_frame(frame, lazy=self.lazy_decode)
+            else:
+                # Frames are reassembled into one buffer as they arrive
+                reassembly = self.transfer_manager.receive_frame(frame)
+                if reassembly is None:
+                    return
+                transfer = reassembly.decode(lazy=self.lazy_decode)
+        except ValueError:
+            logging.debug("Node._recv_frame(): dropping transfer",
+                          exc_info=True)
             return
 
-        dtid = transfer_frames[0].data_type_id
-        if transfer_frames[0].transfer_priority == \
-                transport.TransferPriority.SERVICE:
-            kind = dsdl.parser.CompoundType.KIND_SERVICE
-        else:
-            kind = dsdl.parser.CompoundType.KIND_MESSAGE
-        datatype = uavcan.DATATYPES.get((dtid, kind))
-        if not datatype:
-            logging.debug(("Node._recv_frame(): unrecognised data type " +
-                           "ID {0:d} for kind {1:d}").format(dtid, kind))
-            return
+        payload = transfer.payload
+        datatype = payload.type
 
-        transfer = transport.Transfer()
-        transfer.from_frames(transfer_frames, datatype_crc=datatype.base_crc)
-
-        if transfer.is_message():
-            payload = datatype()  # Broadcast or unicast
-        elif transfer.is_request():
-            payload = datatype(mode="request")
-        else:  # transfer.is_response()
-            payload = datatype(mode="response")
-
-        payload.unpack(transport.bits_from_bytes(transfer.payload))
-
-        logging.info("Node._recv_frame(): received {0!r}".format(payload))
+        # Let the logging module format the payload only if the record is
+        # emitted, so lazily-decoded payloads aren't decoded just for this
+        logging.info("Node._recv_frame(): received %r", payload)
 
         # If it's a node info request, keep track of the status of each node
-        if payload.type == uavcan.protocol.NodeStatus:
+        if payload.type is uavcan.protocol.NodeStatus:
             self.node_info[transfer.source_node_id] = {
                 "uptime": payload.uptime_sec,
                 "status": payload.status_code,
@@ -86,25 +113,48 @@ class Node(object):
         if transfer.is_response() and transfer.dest_node_id == self.node_id:
             # This is a reply to a request we sent. Look up the original
             # request and call the appropriate callback
-            requests = self.outstanding_requests.keys()
-            for key in requests:
-                if transfer.is_response_to(self.outstanding_requests[key]):
-                    # Call the request's callback and remove it from the
-                    # active list
-                    if key in self.outstanding_request_callbacks:
-                        self.outstanding_request_callbacks[key]((payload, transfer))
-                        del self.outstanding_request_callbacks[key]
-                    del self.outstanding_requests[key]
-                    del self.outstanding_request_timestamps[key]
-                    break
+            key = (transfer.source_node_id, transfer.data_type_id,
+                   transfer.transfer_id)
+            request = self.pending_requests.pop(key, None)
+            if request is not None:
+                self.request_deadlines.cancel(key)
+                request.future.set_result((payload, transfer))
         elif transfer.is_broadcast() or transfer.dest_node_id == self.node_id:
             # This is a request, a unicast or a broadcast; look up the
-            # appropriate handler by data type ID
-            for handler in self.handlers:
-                if handler[0] == datatype:
-                    kwargs = handler[2] if len(handler) == 3 else {}
-                    h = handler[1](payload, transfer, self, **kwargs)
-                    h._execute()
+            # appropriate handlers by data type
+            factories = self._handler_index.get(
+                (datatype.default_dtid, datatype.kind))
+            if factories:
+                # Copied so handlers may add or remove handlers
+                for factory in tuple(factories):
+                    factory[1](payload, transfer, self)._execute()
+
+    def _recv_frames(self, dev, messages):
+        for message in messages:
+            self._recv_frame(dev, message)
+
+    def add_handler(self, datatype, handler, kwargs=None):
+        """Calls `handler(payload, transfer, node, **kwargs)._execute()` for
+        each message or service request of `datatype` received. Several
+        handlers may be registered for a data type; they are run in the
+        order they were added."""
+        key = (datatype.default_dtid, datatype.kind)
+        self._handler_index[key].append(
+            (handler, functools.partial(handler, **(kwargs or {}))))
+
+    def remove_handler(self, datatype, handler):
+        """Unregisters the first registration of `handler` for `datatype`;
+        raises ValueError if there is none."""
+        key = (datatype.default_dtid, datatype.kind)
+        factories = self._handler_index.get(key, ())
+        for idx, factory in enumerate(factories):
+            if factory[0] is handler:
+                del factories[idx]
+                if not factories:
+                    del self._handler_index[key]
+                return
+        raise ValueError("{0!r} is not registered for {1}".format(
+                         handler, datatype.full_name))
 
     def _next_transfer_id(self, key):
         transfer_id = self.next_transfer_ids[key]
@@ -119,26 +169,54 @@ class Node(object):
 
         self.can.open()
         self.can.add_to_ioloop(tornado.ioloop.IOLoop.current(),
-                               callback=self._recv_frame)
+                               batch_callback=self._recv_frames)
 
         # Send node status every 0.5 sec
         self.start_time = time.time()
-        # TODO: make it easier to get constant values from UAVCAN types
-        self.status = uavcan.protocol.NodeStatus().STATUS_OK
+        # The same message is updated and re-sent each time, so the fields
+        # that don't change needn't be encoded again
+        self.node_status = uavcan.protocol.NodeStatus()
+        self.status = self.node_status.STATUS_OK
         self.nodestatus_timer = tornado.ioloop.PeriodicCallback(
             self.send_node_status,
             500, io_loop=io_loop)
         self.nodestatus_timer.start()
 
+        # Expire pending requests and partial transfers
+        self.timeout_timer = tornado.ioloop.PeriodicCallback(
+            self.expire_timeouts,
+            self.SWEEP_INTERVAL, io_loop=io_loop)
+        self.timeout_timer.start()
+
+    def expire_timeouts(self, now=None):
+        """Drops the partial transfers that have stopped receiving frames,
+        and fails the futures of the requests that have gone unanswered
+        with tornado.gen.TimeoutError."""
+        if now is None:
+            now = time.time()
+        self.transfer_manager.remove_inactive_transfers(now=now)
+        for key in self.request_deadlines.expire(now):
+            request = self.pending_requests.pop(key)
+            request.future.set_exception(tornado.gen.TimeoutError(
+                "No response from node {0:d} to {1!r}".format(
+                key[0], request.transfer.payload)))
+
     def send_node_status(self):
-        status = uavcan.protocol.NodeStatus()
+        status = self.node_status
         status.uptime_sec = int(time.time() - self.start_time)
         status.status_code = self.status
         status.vendor_specific_status_code = 0
         self.send_message(status)
 
-    @tornado.concurrent.return_future
-    def send_request(self, payload, dest_node_id=None, callback=None):
+    def send_request(self, payload, dest_node_id=None, callback=None,
+                     timeout=None):
+        """Sends a service request and returns a Future resolving to the
+        (payload, transfer) of the response. It fails with
+        tornado.gen.TimeoutError if no response arrives within `timeout`
+        seconds (REQUEST_TIMEOUT by default), or with RuntimeError if it is
+        cancelled or superseded by a later request with the same transfer ID.
+        `callback`, if given, is called with the same tuple once the response
+        arrives, or with None if the request times out or fails."""
         transfer_id = self._next_transfer_id((payload.type.default_dtid,
                                               dest_node_id))
         transfer = transport.Transfer(
@@ -149,16 +227,55 @@ class Node(object):
             service_not_message=True,
             request_not_response=True)
 
-        for frame in transfer.to_frames(datatype_crc=payload.type.base_crc):
+        for frame in transfer.iter_frames():
             self.can.send(frame.message_id, frame.to_bytes(), extended=True)
 
-        self.outstanding_requests[transfer.key] = transfer
-        self.outstanding_request_callbacks[transfer.key] = callback
-        self.outstanding_request_timestamps[transfer.key] = time.time()
+        future = tornado.concurrent.Future()
+        if callback is not None:
+            def on_done(future):
+                if future.exception() is not None:
+                    logging.warning(
+                        "Node.send_request(dest_node_id={0:d}): {1!s}".format(
+                        dest_node_id, future.exception()))
+                    callback(None)
+                else:
+                    callback(future.result())
+            future.add_done_callback(on_done)
+        request = PendingRequest(
+            transfer, future,
+            time.time() + (self.REQUEST_TIMEOUT if timeout is None
+                           else timeout))
+        # The 5-bit transfer ID wraps after 32 requests to the same server
+        # and data type; a request still pending under the same key could
+        # no longer be told apart from this one, so it is failed.
+        displaced = self.pending_requests.pop(request.key, None)
+        if displaced is not None:
+            self.request_deadlines.cancel(request.key)
+            displaced.future.set_exception(RuntimeError(
+                "Request superseded after transfer ID wrapped"))
+        self.pending_requests[request.key] = request
+        self.request_deadlines.schedule(request.key, request.deadline)
 
         logging.info(
             "Node.send_request(dest_node_id={0:d}): sent {1!r}".format(
             dest_node_id, payload))
+        return future
+
+    def cancel_requests(self, dest_node_id=None, datatype=None):
+        """Drops the pending requests to `dest_node_id` and/or of `datatype`
+        (all of them if neither is given), failing their futures with
+        RuntimeError. Returns the cancelled PendingRequest objects."""
+        data_type_id = datatype.default_dtid if datatype else None
+        cancelled = [request for request in self.pending_requests.itervalues()
+                     if (dest_node_id is None or
+                         request.key[0] == dest_node_id) and
+                        (data_type_id is None or
+                         request.key[1] == data_type_id)]
+        for request in cancelled:
+            del self.pending_requests[request.key]
+            self.request_deadlines.cancel(request.key)
+            request.future.set_exception(RuntimeError("Request cancelled"))
+        return cancelled
 
     def send_message(self, payload):
         transfer_id = self._next_transfer_id(payload.type.default_dtid)
@@ -168,7 +285,7 @@ class Node(object):
             transfer_id=transfer_id,
             service_not_message=False)
 
-        for frame in transfer.to_frames(datatype_crc=payload.type.base_crc):
+        for frame in transfer.iter_frames():
             self.can.send(frame.message_id, frame.to_bytes(), extended=True)
 
         logging.info("Node.send_message(): sent {0!r}".format(payload))
@@ -216,7 +333,7 @@ class ServiceHandler(MessageHandler):
             service_not_message=True,
             request_not_response=False
         )
-        for frame in transfer.to_frames(datatype_crc=self.request.type.base_crc):
+        for frame in transfer.iter_frames():
             self.node.can.send(frame.message_id, frame.to_bytes(),
                                extended=True)
 
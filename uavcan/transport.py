@@ -2,18 +2,26 @@
 
 import time
 import math
+import array
+import heapq
 import ctypes
 import struct
 import logging
 import binascii
 import functools
+import itertools
 import collections
 
 
+import uavcan
 import uavcan.dsdl as dsdl
 import uavcan.dsdl.common as common
 
 
+# Source of modification stamps; values record the stamp of their latest
+# modification so cached encodings can be checked for staleness
+_modifications = itertools.count(1)
+
 def bits_from_bytes(s):
     return "".join(format(c, "08b") for c in s)
 
@@ -46,6 +54,210 @@ def format_bits(s):
     return " ".join(s[i:i+8] for i in xrange(0, len(s), 8))
 
 
+# Struct formats for little-endian fields which start on a byte boundary and
+# are a whole number of bytes long; those can be read and written without
+# any bit shuffling.
+_ALIGNED_FORMATS = {
+    8: struct.Struct("<B"),
+    16: struct.Struct("<H"),
+    32: struct.Struct("<L"),
+    64: struct.Struct("<Q")
+}
+
+
+def le_from_raw(raw, bitlen):
+    """Converts the integer formed by `bitlen` bits of the stream (first bit
+    most significant) into the value those bits encode. UAVCAN puts the
+    least significant byte first, with any leftover high-order bits in the
+    final partial byte."""
+    value = 0
+    shift = 0
+    while bitlen >= 8:
+        bitlen -= 8
+        value |= ((raw >> bitlen) & 0xFF) << shift
+        shift += 8
+    if bitlen:
+        value |= (raw & ((1 << bitlen) - 1)) << shift
+    return value
+
+
+def raw_from_le(value, bitlen):
+    "Inverse of le_from_raw."
+    raw = 0
+    while bitlen >= 8:
+        bitlen -= 8
+        raw |= (value & 0xFF) << bitlen
+        value >>= 8
+    if bitlen:
+        raw |= value & ((1 << bitlen) - 1)
+    return raw
+
+
+class BitStreamReader(object):
+    """Reads fields out of a serialized payload held in a bytes-like object,
+    advancing a bit cursor rather than slicing the data."""
+
+    def __init__(self, data, offset=0, bitlen=None):
+        self.data = data
+        self.offset = offset
+        self.bitlen = len(data) * 8 if bitlen is None else bitlen
+
+    @classmethod
+    def from_bits(cls, s):
+        "Creates a reader over a string of '0'/'1' characters."
+        padding = "0" * (-len(s) & 7)
+        return cls(bytes_from_bits(s + padding), bitlen=len(s))
+
+    @property
+    def remaining(self):
+        return self.bitlen - self.offset
+
+    def read(self, bitlen):
+        """Returns the unsigned integer value of the next `bitlen`-bit
+        field."""
+        if not self.offset & 7 and bitlen in _ALIGNED_FORMATS and \
+                self.offset + bitlen <= self.bitlen:
+            value = _ALIGNED_FORMATS[bitlen].unpack_from(
+                self.data, self.offset >> 3)[0]
+            self.offset += bitlen
+            return value
+
+        raw = self.read_raw(bitlen)
+        return le_from_raw(raw, bitlen) if bitlen > 8 else raw
+
+    def read_raw(self, bitlen):
+        """Returns the next `bitlen` bits as an integer, with the first bit
+        most significant."""
+        offset = self.offset
+        if offset + bitlen > self.bitlen:
+            raise ValueError("Not enough bits; need {0} but got {1}".format(
+                             bitlen, self.bitlen - offset))
+        elif not bitlen:
+            return 0
+        self.offset = offset + bitlen
+
+        start = offset >> 3
+        stop = (offset + bitlen + 7) >> 3
+        raw = int(binascii.hexlify(self.data[start:stop]), 16)
+        return (raw >> ((stop << 3) - offset - bitlen)) & \
+               ((1 << bitlen) - 1)
+
+    def read_bytes(self, length):
+        "Returns the next `length` whole bytes as a bytearray."
+        if not length:
+            return bytearray()
+        elif not self.offset & 7 and self.offset + length * 8 <= self.bitlen:
+            start = self.offset >> 3
+            self.offset += length * 8
+            return bytearray(self.data[start:start + length])
+
+        raw = self.read_raw(length * 8)
+        return bytearray(binascii.unhexlify(
+            "{0:0{1}x}".format(raw, length * 2)))
+
+
+class BitStreamWriter(object):
+    """Writes serialized fields into a bytearray, growing it as needed, or
+    into a preallocated buffer starting at a given bit offset. Bits that
+    don't yet fill a whole byte are held in an integer until the next
+    write."""
+
+    def __init__(self, data=None, offset=0):
+        self.data = bytearray() if data is None else data
+        self._pos = offset >> 3
+        self._acc_bitlen = offset & 7
+        if self._acc_bitlen:
+            # Keep the bits preceding the offset in its byte
+            self._acc = bytearray(self.data[self._pos:self._pos + 1])[0] \
+                        >> (8 - self._acc_bitlen)
+        else:
+            self._acc = 0
+
+    @property
+    def bitlen(self):
+        "The bit position of the next write."
+        return self._pos * 8 + self._acc_bitlen
+
+    def _put(self, data):
+        # Stores whole bytes at the current byte position
+        pos = self._pos
+        self.data[pos:pos + len(data)] = data
+        self._pos = pos + len(data)
+
+    def write(self, value, bitlen):
+        "Appends `value` as an unsigned `bitlen`-bit field."
+        if not self._acc_bitlen and bitlen in _ALIGNED_FORMATS:
+            self._put(_ALIGNED_FORMATS[bitlen].pack(value))
+        elif bitlen > 8:
+            self.write_raw(raw_from_le(value, bitlen), bitlen)
+        else:
+            self.write_raw(value, bitlen)
+
+    def write_raw(self, raw, bitlen):
+        """Appends `bitlen` bits taken from `raw`, most significant bit
+        first."""
+        acc = (self._acc << bitlen) | raw
+        acc_bitlen = self._acc_bitlen + bitlen
+        if acc_bitlen >= 8:
+            nbytes = acc_bitlen >> 3
+            acc_bitlen &= 7
+            self._put(binascii.unhexlify(
+                "{0:0{1}x}".format(acc >> acc_bitlen, nbytes * 2)))
+            acc &= (1 << acc_bitlen) - 1
+        self._acc = acc
+        self._acc_bitlen = acc_bitlen
+
+    def write_bytes(self, data):
+        "Appends the bytes in `data`, which may be any bytes-like object."
+        if not self._acc_bitlen:
+            self._put(data)
+        elif len(data):
+            self.write_raw(int(binascii.hexlify(data), 16), len(data) * 8)
+
+    def write_from(self, data, offset, bitlen):
+        """Appends `bitlen` bits copied from the bytes-like object `data`,
+        starting `offset` bits in."""
+        if not offset & 7 and not self._acc_bitlen:
+            start = offset >> 3
+            nbytes = bitlen >> 3
+            self._put(data[start:start + nbytes])
+            if bitlen & 7:
+                self.write_raw(bytearray(data[start + nbytes:
+                                              start + nbytes + 1])[0] >>
+                               (8 - (bitlen & 7)), bitlen & 7)
+        else:
+            self.write_raw(BitStreamReader(data, offset).read_raw(bitlen),
+                           bitlen)
+
+    def flush(self):
+        """Stores bits that don't fill a whole byte into the buffer, keeping
+        the existing bits of that byte that follow them."""
+        if self._acc_bitlen:
+            shift = 8 - self._acc_bitlen
+            pos = self._pos
+            existing = bytearray(self.data[pos:pos + 1])
+            keep = existing[0] & ((1 << shift) - 1) if existing else 0
+            self.data[pos:pos + 1] = bytearray([(self._acc << shift) | keep])
+
+    def getvalue(self, start=0):
+        """Returns the written data, zero-padded to a whole number of bytes.
+        If `start` is given, the data begins with the byte holding that bit
+        position."""
+        data = self.data[start >> 3:self._pos]
+        if not isinstance(data, bytearray):
+            data = bytearray(data)
+        if self._acc_bitlen:
+            data.append((self._acc << (8 - self._acc_bitlen)) & 0xFF)
+        return data
+
+    def to_bits(self):
+        "Returns the written data as a string of '0'/'1' characters."
+        bits = bits_from_bytes(bytearray(self.data[0:self._pos]))
+        if self._acc_bitlen:
+            bits += format(self._acc, "0{0:d}b".format(self._acc_bitlen))
+        return bits
+
+
 # http://davidejones.com/blog/1413-python-precision-floating-point/
 def f16_from_f32(float32):
     F16_EXPONENT_BITS = 0x1F
@@ -104,9 +316,9 @@ def cast(value, dtype):
         return value
     elif (dtype.cast_mode == dsdl.parser.PrimitiveType.CAST_MODE_TRUNCATED and
             dtype.kind == dsdl.parser.PrimitiveType.KIND_FLOAT):
-        if not isnan(value) and value > dtype.value_range[1]:
+        if not math.isnan(value) and value > dtype.value_range[1]:
             value = float("+inf")
-        elif not isnan(value) and value < dtype.value_range[0]:
+        elif not math.isnan(value) and value < dtype.value_range[0]:
             value = float("-inf")
         return value
     elif dtype.cast_mode == dsdl.parser.PrimitiveType.CAST_MODE_TRUNCATED:
@@ -115,83 +327,485 @@ def cast(value, dtype):
         raise ValueError("Invalid cast_mode: " + repr(dtype))
 
 
+def value_from_raw(raw, dtype):
+    "Returns the value of primitive type `dtype` with bit pattern `raw`."
+    if dtype.kind == dsdl.parser.PrimitiveType.KIND_BOOLEAN:
+        return raw
+    elif dtype.kind == dsdl.parser.PrimitiveType.KIND_UNSIGNED_INT:
+        return raw
+    elif dtype.kind == dsdl.parser.PrimitiveType.KIND_SIGNED_INT:
+        if raw >= (1 << (dtype.bitlen - 1)):
+            raw = -((1 << dtype.bitlen) - raw)
+        return raw
+    elif dtype.kind == dsdl.parser.PrimitiveType.KIND_FLOAT:
+        if dtype.bitlen == 16:
+            return f32_from_f16(raw)
+        elif dtype.bitlen == 32:
+            return struct.unpack("<f", struct.pack("<L", raw))[0]
+        else:
+            raise ValueError("Only 16- or 32-bit floats are supported")
+
+
+def raw_from_value(value, dtype):
+    """Returns the bit pattern encoding `value` as primitive type `dtype`,
+    applying the type's cast mode."""
+    if value is None:
+        raise ValueError("Can't serialize a None value")
+    elif dtype.kind == dsdl.parser.PrimitiveType.KIND_BOOLEAN:
+        return 1 if value else 0
+    elif dtype.kind == dsdl.parser.PrimitiveType.KIND_UNSIGNED_INT:
+        return cast(value, dtype)
+    elif dtype.kind == dsdl.parser.PrimitiveType.KIND_SIGNED_INT:
+        return cast(value, dtype) & ((1 << dtype.bitlen) - 1)
+    elif dtype.kind == dsdl.parser.PrimitiveType.KIND_FLOAT:
+        value = cast(value, dtype)
+        if dtype.bitlen == 16:
+            return f16_from_f32(value)
+        elif dtype.bitlen == 32:
+            return struct.unpack("<L", struct.pack("<f", value))[0]
+        else:
+            raise ValueError("Only 16- or 32-bit floats are supported")
+
+
+def _storage_type(bitlen):
+    # Returns the callable building a raw_storage container from a list of
+    # bit patterns
+    if bitlen <= 8:
+        return bytearray
+    for typecode in "HIL":
+        if array.array(typecode).itemsize * 8 >= bitlen:
+            return functools.partial(array.array, typecode)
+    return list
+
+
+def raw_storage(bitlen, size=0):
+    """Returns a compact container of `size` zeroed bit patterns for
+    `bitlen`-bit primitives: a bytearray for elements of up to 8 bits,
+    otherwise the narrowest array.array that fits (or a list if none
+    does)."""
+    return _storage_type(bitlen)([0] * size)
+
+
+def compound_fields(uavcan_type, mode=None):
+    """Returns the (fields, constants) lists describing a compound type, or
+    the request/response half of a service type as selected by `mode`."""
+    if uavcan_type.kind == dsdl.parser.CompoundType.KIND_SERVICE:
+        if mode == "request":
+            return uavcan_type.request_fields, uavcan_type.request_constants
+        elif mode == "response":
+            return uavcan_type.response_fields, uavcan_type.response_constants
+        else:
+            raise ValueError("mode must be either 'request' or " +
+                             "'response' for service types")
+    else:
+        return uavcan_type.fields, uavcan_type.constants
+
+
+def _le_unpack_expr(var, shift, bitlen):
+    # Expression extracting the value of the `bitlen`-bit field found at bit
+    # `shift` of `var` (counting from the least significant end)
+    if bitlen <= 8:
+        return "(({0} >> {1}) & {2:#x})".format(var, shift,
+                                               (1 << bitlen) - 1)
+    terms = []
+    top = shift + bitlen
+    nbytes, rem = divmod(bitlen, 8)
+    for i in xrange(nbytes):
+        terms.append("((({0} >> {1}) & 0xff) << {2})".format(
+                     var, top - 8 * (i + 1), 8 * i))
+    if rem:
+        terms.append("((({0} >> {1}) & {2:#x}) << {3})".format(
+                     var, shift, (1 << rem) - 1, 8 * nbytes))
+    return " | ".join(terms)
+
+
+def _le_pack_expr(var, shift, bitlen):
+    # Inverse of _le_unpack_expr: places the value held in `var` at bit
+    # `shift` of the stream integer
+    if bitlen <= 8:
+        return "(({0} & {1:#x}) << {2})".format(var, (1 << bitlen) - 1,
+                                               shift)
+    terms = []
+    top = shift + bitlen
+    nbytes, rem = divmod(bitlen, 8)
+    for i in xrange(nbytes):
+        terms.append("((({0} >> {1}) & 0xff) << {2})".format(
+                     var, 8 * i, top - 8 * (i + 1)))
+    if rem:
+        terms.append("((({0} >> {1}) & {2:#x}) << {3})".format(
+                     var, 8 * nbytes, (1 << rem) - 1, shift))
+    return " | ".join(terms)
+
+
+# Static arrays of primitives with more items than this are left to
+# ArrayValue (which handles byte arrays in bulk) rather than unrolled
+_MAX_UNROLLED_ITEMS = 32
+
+
+def _codec_items(fields, values, compounds):
+    # Flattens `fields`, whose value objects are held in the list named
+    # `values`, into (kind, target, bitlens) items. Primitives ("raw") and
+    # short static arrays of primitives ("items") are read and written
+    # directly; fixed-layout nested compounds are expanded in place, their
+    # (name, target) pairs being appended to `compounds`; anything else
+    # ("value") is handed to the value object.
+    for i, field in enumerate(fields):
+        target = "{0}[{1:d}]".format(values, i)
+        field_type = field.type
+        if isinstance(field_type, dsdl.parser.PrimitiveType):
+            yield "raw", target, [field_type.bitlen]
+        elif isinstance(field_type, dsdl.parser.ArrayType) and \
+                field_type.mode == dsdl.parser.ArrayType.MODE_STATIC and \
+                isinstance(field_type.value_type,
+                           dsdl.parser.PrimitiveType) and \
+                field_type.max_size <= _MAX_UNROLLED_ITEMS:
+            yield ("items", target,
+                   [field_type.value_type.bitlen] * field_type.max_size)
+        elif isinstance(field_type, dsdl.parser.CompoundType) and \
+                fixed_bitlen(field_type) is not None:
+            name = "c{0:d}".format(len(compounds))
+            compounds.append((name, target))
+            for item in _codec_items(compound_fields(field_type)[0],
+                                     name + "v", compounds):
+                yield item
+        else:
+            yield "value", target, None
+
+
+def _codec_runs(items):
+    # Groups consecutive directly-encoded items so each group can be read or
+    # written with a single stream operation. A fixed-layout type becomes a
+    # single run.
+    run = []
+    for item in items:
+        if item[0] != "value":
+            run.append(item)
+        else:
+            if run:
+                yield run
+                run = []
+            yield item
+    if run:
+        yield run
+
+
+def _generate_codec(name, fields):
+    namespace = {
+        "lazy_slot": CompoundValue.__dict__["_lazy"],
+        "encoded_slot": CompoundValue.__dict__["_encoded"]
+    }
+    compounds = []
+    items = list(_codec_items(fields, "fields", compounds))
+    unpack_lines = ["def unpack(value, stream):",
+                    "    fields = value._values"]
+    pack_lines = ["def pack(value, stream):",
+                  "    fields = value._values"]
+
+    # Nested compounds that are encoded in place need to be unbound from
+    # any serialized data they were lazily decoding, and their cached
+    # encodings dropped
+    for compound, target in compounds:
+        unpack_lines += [
+            "    {0} = {1}".format(compound, target),
+            "    lazy_slot.__set__({0}, None)".format(compound),
+            "    encoded_slot.__set__({0}, None)".format(compound),
+            "    {0}v = {0}._values".format(compound)
+        ]
+        pack_lines.append("    {0}v = {1}._values".format(compound, target))
+
+    for idx, run in enumerate(_codec_runs(items)):
+        if not isinstance(run, list):
+            unpack_lines.append("    {0}._unpack(stream)".format(run[1]))
+            pack_lines.append("    {0}._pack(stream)".format(run[1]))
+            continue
+
+        bitlens = [bitlen for item in run for bitlen in item[2]]
+        total = sum(bitlens)
+        names = ["f{0:d}_{1:d}".format(idx, i) for i in xrange(len(bitlens))]
+        shifts = [total - sum(bitlens[0:i + 1])
+                  for i in xrange(len(bitlens))]
+        struct_name = "s{0:d}".format(idx)
+        use_struct = all(b in _ALIGNED_FORMATS for b in bitlens)
+        if use_struct:
+            namespace[struct_name] = struct.Struct(
+                "<" + "".join(_ALIGNED_FORMATS[b].format[1:]
+                              for b in bitlens))
+
+        # Decoding
+        if use_struct:
+            unpack_lines += [
+                "    if not stream.offset & 7 and "
+                "stream.remaining >= {0:d}:".format(total),
+                "        {0}, = {1}.unpack_from(stream.data, "
+                "stream.offset >> 3)".format(", ".join(names), struct_name),
+                "        stream.offset += {0:d}".format(total),
+                "    else:"
+            ]
+            indent = "        "
+        else:
+            indent = "    "
+        unpack_lines.append(indent + "raw = stream.read_raw({0:d})".format(
+                            total))
+        for var, shift, bitlen in zip(names, shifts, bitlens):
+            unpack_lines.append(indent + "{0} = {1}".format(
+                                var, _le_unpack_expr("raw", shift, bitlen)))
+        var_iter = iter(names)
+        for item_idx, (kind, target, item_bitlens) in enumerate(run):
+            item_vars = [next(var_iter) for bitlen in item_bitlens]
+            if kind == "raw":
+                unpack_lines.append("    {0}._raw = {1}".format(
+                                    target, item_vars[0]))
+            else:
+                store_name = "store{0:d}_{1:d}".format(idx, item_idx)
+                namespace[store_name] = _storage_type(item_bitlens[0])
+                unpack_lines.append(
+                    "    {0}._ArrayValue__items = {1}([{2}])".format(
+                        target, store_name, ", ".join(item_vars)))
+
+        # Encoding
+        var_iter = iter(names)
+        for item_idx, (kind, target, item_bitlens) in enumerate(run):
+            item_vars = [next(var_iter) for bitlen in item_bitlens]
+            if kind == "raw":
+                pack_lines.append("    {0} = {1}._raw or 0".format(
+                                  item_vars[0], target))
+                continue
+
+            # Static arrays may hold fewer items than their size, in which
+            # case they are padded with zeros
+            items_name = "a{0:d}_{1:d}".format(idx, item_idx)
+            pad_name = "pad{0:d}_{1:d}".format(idx, item_idx)
+            namespace[pad_name] = raw_storage(item_bitlens[0],
+                                              len(item_bitlens))
+            pack_lines += [
+                "    {0} = {1}._ArrayValue__items".format(items_name,
+                                                          target),
+                "    if len({0}) < {1:d}:".format(items_name,
+                                                  len(item_bitlens)),
+                "        {0} = {0} + {1}".format(items_name, pad_name)
+            ]
+            for i, var in enumerate(item_vars):
+                pack_lines.append("    {0} = {1}[{2:d}]".format(
+                                  var, items_name, i))
+        if use_struct:
+            pack_lines += [
+                "    if not stream.bitlen & 7:",
+                "        stream.write_bytes({0}.pack({1}))".format(
+                    struct_name, ", ".join(names)),
+                "    else:"
+            ]
+        pack_lines.append(indent + "stream.write_raw({0}, {1:d})".format(
+            " | ".join(_le_pack_expr(var, shift, bitlen)
+                       for var, shift, bitlen in zip(names, shifts, bitlens)),
+            total))
+
+    source = "\n".join(unpack_lines + ["", ""] + pack_lines) + "\n"
+    exec(compile(source, "<codec {0}>".format(name), "exec"), namespace)
+    return namespace["unpack"], namespace["pack"]
+
+
+def compile_codec(uavcan_type, mode=None):
+    """Returns (unpack, pack) functions for a compound type with the field
+    walk unrolled into straight-line code, generating them on first use.
+    The functions are cached on the type object."""
+    codecs = getattr(uavcan_type, "_codecs", None)
+    if codecs is None:
+        codecs = uavcan_type._codecs = {}
+    if mode not in codecs:
+        fields, _ = compound_fields(uavcan_type, mode)
+        codecs[mode] = _generate_codec(uavcan_type.full_name, fields)
+    return codecs[mode]
+
+
+def fixed_bitlen(uavcan_type):
+    """Returns the serialized length in bits of every value of a type, or
+    None if the length depends on the value (i.e. the type contains a
+    dynamic array)."""
+    if isinstance(uavcan_type, dsdl.parser.PrimitiveType):
+        return uavcan_type.bitlen
+    elif isinstance(uavcan_type, dsdl.parser.ArrayType):
+        if uavcan_type.mode != dsdl.parser.ArrayType.MODE_STATIC:
+            return None
+        item_bitlen = fixed_bitlen(uavcan_type.value_type)
+        if item_bitlen is None:
+            return None
+        return item_bitlen * uavcan_type.max_size
+    else:
+        total = 0
+        for field in compound_fields(uavcan_type)[0]:
+            field_bitlen = fixed_bitlen(field.type)
+            if field_bitlen is None:
+                return None
+            total += field_bitlen
+        return total
+
+
+class FieldLayout(object):
+    """Per-type table of field names and positions, shared by every value of
+    the type. CompoundValue uses `index` to find a field's slot, and the
+    positions are used to find a field in a serialized payload without
+    decoding the fields before it.
+
+    `offsets` has one entry per field plus one for the end of the payload;
+    each is the bit offset from the start of the payload, or None if it
+    depends on the length of a preceding dynamic array. `bitlens` holds the
+    length of each field, or None if it is variable. `constants` maps
+    constant names to their values."""
+
+    def __init__(self, fields, constants=()):
+        self.constants = dict((constant.name, constant.value)
+                              for constant in constants)
+        self.names = [field.name for field in fields]
+        self.index = dict((name, i) for i, name in enumerate(self.names))
+        self.bitlens = [fixed_bitlen(field.type) for field in fields]
+        # Total length of the fixed-length fields, and the indexes of the
+        # others
+        self.static_bitlen = sum(bitlen for bitlen in self.bitlens
+                                 if bitlen is not None)
+        self.variable = [idx for idx, bitlen in enumerate(self.bitlens)
+                         if bitlen is None]
+        # Indexes of the fields that aren't primitives
+        self.nested = [idx for idx, field in enumerate(fields)
+                       if not isinstance(field.type,
+                                         dsdl.parser.PrimitiveType)]
+        self.offsets = [0]
+        for bitlen in self.bitlens:
+            if self.offsets[-1] is None or bitlen is None:
+                self.offsets.append(None)
+            else:
+                self.offsets.append(self.offsets[-1] + bitlen)
+
+
+def field_layout(uavcan_type, mode=None):
+    "Returns the cached FieldLayout of a compound type."
+    layouts = getattr(uavcan_type, "_layouts", None)
+    if layouts is None:
+        layouts = uavcan_type._layouts = {}
+    if mode not in layouts:
+        layouts[mode] = FieldLayout(*compound_fields(uavcan_type, mode))
+    return layouts[mode]
+
+
+class _LazyState(object):
+    # Serialized data a lazily-decoded CompoundValue is bound to
+    __slots__ = ("layout", "data", "bitlen", "offsets", "pending")
+
+    def __init__(self, layout, data, offset, bitlen):
+        self.layout = layout
+        self.data = data
+        self.bitlen = bitlen
+        self.offsets = [None if o is None else offset + o
+                        for o in layout.offsets]
+        self.pending = set(layout.names)
+
+
 class BaseValue(object):
+    __slots__ = ("type", )
+
     def __init__(self, uavcan_type, *args, **kwargs):
         self.type = uavcan_type
-        self._bits = None
 
     def unpack(self, stream):
-        if self.type.bitlen:
-            self._bits = be_from_le_bits(stream, self.type.bitlen)
-            return stream[self.type.bitlen:]
-        else:
-            return stream
+        """Decodes the value from a string of '0'/'1' characters, returning
+        the portion of the string that was not consumed."""
+        reader = BitStreamReader.from_bits(stream)
+        self._unpack(reader)
+        return stream[reader.offset:]
 
     def pack(self):
-        if self._bits:
-            return le_from_be_bits(self._bits, self.type.bitlen)
-        else:
-            return "0" * self.type.bitlen
+        "Encodes the value as a string of '0'/'1' characters."
+        writer = BitStreamWriter()
+        self._pack(writer)
+        return writer.to_bits()
+
+    def unpack_from(self, buffer, offset=0):
+        """Decodes the value in place from `buffer`, which may be any object
+        supporting the buffer protocol (e.g. a bytearray or memoryview),
+        starting `offset` bits in. Returns the number of bits consumed."""
+        stream = BitStreamReader(buffer, offset)
+        self._unpack(stream)
+        return stream.offset - offset
+
+    def pack_into(self, buffer, offset=0):
+        """Encodes the value into `buffer` starting `offset` bits in, leaving
+        the bits around it untouched. `buffer` is a bytearray, which is
+        extended if it is too short, or a writable memoryview at least
+        serialized_size() bits long. Returns the number of bits written."""
+        stream = BitStreamWriter(buffer, offset)
+        self._pack(stream)
+        stream.flush()
+        return stream.bitlen - offset
+
+    def serialized_size(self):
+        "Returns the length of the value's serialized form in bits."
+        raise NotImplementedError()
+
+    def _unpack(self, stream):
+        raise NotImplementedError()
+
+    def _pack(self, stream):
+        raise NotImplementedError()
+
+    def _clone(self):
+        "Returns a deep copy of the value."
+        raise NotImplementedError()
 
 
 class PrimitiveValue(BaseValue):
+    __slots__ = ("_raw", )
+
+    def __init__(self, uavcan_type, *args, **kwargs):
+        super(PrimitiveValue, self).__init__(uavcan_type, *args, **kwargs)
+        # Unsigned integer holding the field's bit pattern, or None if the
+        # value hasn't been set
+        self._raw = None
+
     def __repr__(self):
         return repr(self.value)
 
+    def _unpack(self, stream):
+        self._raw = stream.read(self.type.bitlen)
+
+    def _pack(self, stream):
+        stream.write(self._raw or 0, self.type.bitlen)
+
+    def serialized_size(self):
+        return self.type.bitlen
+
+    def _clone(self):
+        value = PrimitiveValue.__new__(PrimitiveValue)
+        value.type = self.type
+        value._raw = self._raw
+        return value
+
     @property
     def value(self):
-        if not self._bits:
+        if self._raw is None:
             raise ValueError("Undefined value")
-
-        int_value = int(self._bits, 2)
-        if self.type.kind == dsdl.parser.PrimitiveType.KIND_BOOLEAN:
-            return int_value
-        elif self.type.kind == dsdl.parser.PrimitiveType.KIND_UNSIGNED_INT:
-            return int_value
-        elif self.type.kind == dsdl.parser.PrimitiveType.KIND_SIGNED_INT:
-            if int_value >= (1 << (self.type.bitlen - 1)):
-                int_value = -((1 << self.type.bitlen) - int_value)
-            return int_value
-        elif self.type.kind == dsdl.parser.PrimitiveType.KIND_FLOAT:
-            if self.type.bitlen == 16:
-                return f32_from_f16(int_value)
-            elif self.type.bitlen == 32:
-                return struct.unpack("<f", struct.pack("<L", int_value))[0]
-            else:
-                raise ValueError("Only 16- or 32-bit floats are supported")
+        return value_from_raw(self._raw, self.type)
 
     @value.setter
     def value(self, new_value):
-        if new_value is None:
-            raise ValueError("Can't serialize a None value")
-        elif self.type.kind == dsdl.parser.PrimitiveType.KIND_BOOLEAN:
-            self._bits = "1" if new_value else "0"
-        elif self.type.kind == dsdl.parser.PrimitiveType.KIND_UNSIGNED_INT:
-            new_value = cast(new_value, self.type)
-            self._bits = format(new_value, "0" + str(self.type.bitlen) + "b")
-        elif self.type.kind == dsdl.parser.PrimitiveType.KIND_SIGNED_INT:
-            new_value = cast(new_value, self.type)
-            self._bits=  format(new_value, "0" + str(self.type.bitlen) + "b")
-        elif self.type.kind == dsdl.parser.PrimitiveType.KIND_FLOAT:
-            new_value = cast(new_value, self.type)
-            if self.type.bitlen == 16:
-                int_value = f16_from_f32(new_value)
-            elif self.type.bitlen == 32:
-                int_value = \
-                    struct.unpack("<L", struct.pack("<f", new_value))[0]
-            else:
-                raise ValueError("Only 16- or 32-bit floats are supported")
-            self._bits = format(int_value, "0" + str(self.type.bitlen) + "b")
+        self._raw = raw_from_value(new_value, self.type)
 
 
-class ArrayValue(BaseValue, collections.MutableSequence):
+class ArrayValue(BaseValue):
+    # Not derived from collections.MutableSequence, as the ABCs would give
+    # every instance a __dict__; the mixin methods are defined below and the
+    # class is registered as a MutableSequence instead
+    __slots__ = ("_tao", "_modified", "_exported", "__primitive",
+                 "__item_ctor", "__items")
+
     def __init__(self, uavcan_type, tao=False, *args, **kwargs):
         super(ArrayValue, self).__init__(uavcan_type, *args, **kwargs)
         value_bitlen = getattr(self.type.value_type, "bitlen", None)
         self._tao = tao if value_bitlen >= 8 else False
-        if isinstance(self.type.value_type, dsdl.parser.PrimitiveType):
-            self.__item_ctor = functools.partial(PrimitiveValue,
-                                                 self.type.value_type)
+        # Primitive elements are held as bit patterns in a compact
+        # container rather than as one PrimitiveValue object each
+        self.__primitive = isinstance(self.type.value_type,
+                                      dsdl.parser.PrimitiveType)
+        if self.__primitive:
+            self.__item_ctor = None
         elif isinstance(self.type.value_type, dsdl.parser.ArrayType):
             self.__item_ctor = functools.partial(ArrayValue,
                                                  self.type.value_type)
@@ -199,39 +813,73 @@ class ArrayValue(BaseValue, collections.MutableSequence):
             self.__item_ctor = functools.partial(CompoundValue,
                                                  self.type.value_type)
         if self.type.mode == dsdl.parser.ArrayType.MODE_STATIC:
-            self.__items = list(self.__item_ctor()
-                                for i in xrange(self.type.max_size))
+            size = self.type.max_size
         else:
-            self.__items = []
+            size = 0
+        if self.__primitive:
+            self.__items = raw_storage(value_bitlen, size)
+        else:
+            self.__items = list(self.__item_ctor() for i in xrange(size))
+        self._modified = next(_modifications)
+        # True once raw_items has handed out the storage container, whose
+        # writes can't be tracked
+        self._exported = False
 
     def __repr__(self):
+        items = self[:] if self.__primitive else self.__items
         return "ArrayValue(type={0!r}, tao={1!r}, items={2!r})".format(
-                self.type, self._tao, self.__items)
+                self.type, self._tao, items)
 
     def __str__(self):
         return self.__repr__()
 
     def __getitem__(self, idx):
-        if isinstance(self.__items[idx], PrimitiveValue):
-            return self.__items[idx].value if self.__items[idx]._bits else 0
-        else:
+        if not self.__primitive:
             return self.__items[idx]
+        elif isinstance(idx, slice):
+            return [value_from_raw(raw, self.type.value_type)
+                    for raw in self.__items[idx]]
+        else:
+            return value_from_raw(self.__items[idx], self.type.value_type)
 
     def __setitem__(self, idx, value):
+        if isinstance(idx, slice):
+            if self.__primitive:
+                value = self.__raw_items(value)
+            else:
+                value = list(value)
+            size = len(self) - len(xrange(*idx.indices(len(self)))) + \
+                   len(value)
+            if size > self.type.max_size:
+                raise IndexError(("Array too large (max size " +
+                                  "{0})").format(self.type.max_size))
+            self.__items[idx] = value
+            self._modified = next(_modifications)
+            return
+
         if idx >= self.type.max_size:
             raise IndexError(("Index {0} too large (max size " +
                               "{1})").format(idx, self.type.max_size))
-        if isinstance(self.type.value_type, dsdl.parser.PrimitiveType):
-            self.__items[idx].value = value
+        if self.__primitive:
+            self.__items[idx] = raw_from_value(value, self.type.value_type)
         else:
             self.__items[idx] = value
+        self._modified = next(_modifications)
 
     def __delitem__(self, idx):
         del self.__items[idx]
+        self._modified = next(_modifications)
 
     def __len__(self):
         return len(self.__items)
 
+    def __iter__(self):
+        if self.__primitive:
+            value_type = self.type.value_type
+            return (value_from_raw(raw, value_type) for raw in self.__items)
+        else:
+            return iter(self.__items)
+
     def insert(self, idx, value):
         if idx >= self.type.max_size:
             raise IndexError(("Index {0} too large (max size " +
@@ -239,148 +887,485 @@ class ArrayValue(BaseValue, collections.MutableSequence):
         elif len(self) == self.type.max_size:
             raise IndexError(("Array already full (max size "
                               "{0})").format(self.type.max_size))
-        if isinstance(self.type.value_type, dsdl.parser.PrimitiveType):
-            new_item = self.__item_ctor()
-            new_item.value = value
-            self.__items.insert(idx, new_item)
+        if self.__primitive:
+            self.__items.insert(idx,
+                                raw_from_value(value, self.type.value_type))
         else:
             self.__items.insert(idx, value)
+        self._modified = next(_modifications)
 
-    def unpack(self, stream):
+    def append(self, value):
+        self.insert(len(self), value)
+
+    def extend(self, values):
+        self[len(self):] = values
+
+    def __iadd__(self, values):
+        self.extend(values)
+        return self
+
+    def pop(self, idx=-1):
+        value = self[idx]
+        del self[idx]
+        return value
+
+    def remove(self, value):
+        del self[self.index(value)]
+
+    def reverse(self):
+        self.__items.reverse()
+        self._modified = next(_modifications)
+
+    def __contains__(self, value):
+        return any(item == value for item in self)
+
+    def __reversed__(self):
+        for idx in reversed(xrange(len(self))):
+            yield self[idx]
+
+    def index(self, value):
+        for idx, item in enumerate(self):
+            if item == value:
+                return idx
+        raise ValueError(repr(value) + " is not in array")
+
+    def count(self, value):
+        return sum(1 for item in self if item == value)
+
+    @property
+    def raw_items(self):
+        """The container holding the bit pattern of each element of a
+        primitive array. It is a bytearray for elements of up to 8 bits and
+        an array.array otherwise, so it can be handed to anything accepting
+        the buffer protocol without copying. As writes to it can't be seen,
+        values containing the array stop caching their encoding."""
+        if not self.__primitive:
+            raise TypeError("Only arrays of primitives have raw items")
+        self._exported = True
+        return self.__items
+
+    def __raw_items(self, values):
+        # Converts an iterable of values into the storage container type
+        value_type = self.type.value_type
+        if value_type.bitlen == 8 and \
+                value_type.kind == dsdl.parser.PrimitiveType.KIND_UNSIGNED_INT \
+                and isinstance(values, (bytes, bytearray, memoryview)):
+            return bytearray(values)
+        # Built from a list: on Python 2, bytearray.extend() swallows
+        # exceptions raised by a generator
+        return _storage_type(value_type.bitlen)(
+            [raw_from_value(value, value_type) for value in values])
+
+    def __read_items(self, stream, count):
+        # Reads `count` primitive elements in one go where possible
+        bitlen = self.type.value_type.bitlen
+        if bitlen == 8:
+            return stream.read_bytes(count)
+        return _storage_type(bitlen)(
+            [stream.read(bitlen) for i in xrange(count)])
+
+    def __write_items(self, stream, items):
+        bitlen = self.type.value_type.bitlen
+        if bitlen == 8:
+            stream.write_bytes(items)
+        else:
+            for raw in items:
+                stream.write(raw, bitlen)
+
+    def _unpack(self, stream):
+        self._modified = next(_modifications)
         if self.type.mode == dsdl.parser.ArrayType.MODE_STATIC:
-            for i in xrange(self.type.max_size):
-                stream = self.__items[i].unpack(stream)
+            count = self.type.max_size
+        elif self._tao:
+            count = None
+        else:
+            count = stream.read(self.type.max_size.bit_length())
+
+        if self.__primitive:
+            if count is None:
+                count = stream.remaining // self.type.value_type.bitlen
+            self.__items = self.__read_items(stream, count)
+            self._exported = False
+        elif self.type.mode == dsdl.parser.ArrayType.MODE_STATIC:
+            for item in self.__items:
+                item._unpack(stream)
         elif self._tao:
             del self[:]
-            while len(stream) >= 8:
+            while stream.remaining >= 8:
                 new_item = self.__item_ctor()
-                stream = new_item.unpack(stream)
+                new_item._unpack(stream)
                 self.__items.append(new_item)
-            stream = ""
         else:
             del self[:]
-            count_width = int(math.ceil(math.log(self.type.max_size, 2))) or 1
-            count = int(stream[0:count_width], 2)
-            stream = stream[count_width:]
             for i in xrange(count):
                 new_item = self.__item_ctor()
-                stream = new_item.unpack(stream)
+                new_item._unpack(stream)
                 self.__items.append(new_item)
 
-        return stream
+    def _pack(self, stream):
+        if self.type.mode == dsdl.parser.ArrayType.MODE_DYNAMIC and \
+                not self._tao:
+            stream.write(len(self), self.type.max_size.bit_length())
 
-    def pack(self):
-        if self.type.mode == dsdl.parser.ArrayType.MODE_STATIC:
-            items = "".join(i.pack() for i in self.__items)
-            if len(self) < self.type.max_size:
+        if self.__primitive:
+            self.__write_items(stream, self.__items)
+        else:
+            for item in self.__items:
+                item._pack(stream)
+
+        if self.type.mode == dsdl.parser.ArrayType.MODE_STATIC and \
+                len(self) < self.type.max_size:
+            padding = self.type.max_size - len(self)
+            if self.__primitive:
+                self.__write_items(
+                    stream, raw_storage(self.type.value_type.bitlen, padding))
+            else:
                 empty_item = self.__item_ctor()
-                items += "".join(empty_item.pack() for i in
-                                 xrange(self.type.max_size - len(self)))
-            return items
-        elif self._tao:
-            return "".join(i.pack() for i in self.__items)
+                for i in xrange(padding):
+                    empty_item._pack(stream)
+
+    def serialized_size(self):
+        static = self.type.mode == dsdl.parser.ArrayType.MODE_STATIC
+        if static or self._tao:
+            size = 0
         else:
-            count_width = int(math.ceil(math.log(self.type.max_size, 2))) or 1
-            count = format(len(self), "0{0:1d}b".format(count_width))
-            return count + "".join(i.pack() for i in self.__items)
+            size = self.type.max_size.bit_length()
+
+        # Static arrays are padded with empty items up to their size
+        if self.__primitive:
+            count = self.type.max_size if static else len(self)
+            return size + count * self.type.value_type.bitlen
+        size += sum(item.serialized_size() for item in self.__items)
+        if static and len(self) < self.type.max_size:
+            size += (self.type.max_size - len(self)) * \
+                    self.__item_ctor().serialized_size()
+        return size
+
+    def _clone(self):
+        value = ArrayValue.__new__(ArrayValue)
+        value.type = self.type
+        value._tao = self._tao
+        value.__primitive = self.__primitive
+        value.__item_ctor = self.__item_ctor
+        if self.__primitive:
+            value.__items = self.__items[:]
+        else:
+            value.__items = [item._clone() for item in self.__items]
+        value._modified = next(_modifications)
+        value._exported = False
+        return value
+
+    def _last_modified(self):
+        # Latest modification stamp of the array or any of its items
+        if self._exported:
+            return next(_modifications)
+        modified = self._modified
+        if not self.__primitive:
+            for item in self.__items:
+                item_modified = item._last_modified()
+                if item_modified > modified:
+                    modified = item_modified
+        return modified
 
     def from_bytes(self, value):
-        del self[:]
-        for byte in bytearray(value):
-            self.append(byte)
+        self[:] = bytearray(value)
 
     def to_bytes(self):
-        return bytes(bytearray(item.value for item in self.__items
-                               if item._bits))
+        if isinstance(self.__items, bytearray):
+            return bytes(self.__items)
+        else:
+            return bytes(bytearray(self))
 
     def encode(self, value):
-        del self[:]
-        value = bytearray(value, encoding="utf-8")
-        for byte in value:
-            self.append(byte)
+        self[:] = bytearray(value, encoding="utf-8")
 
     def decode(self, encoding="utf-8"):
-        return bytearray(item.value for item in self.__items
-                         if item._bits).decode(encoding)
+        return self.to_bytes().decode(encoding)
+
+
+collections.MutableSequence.register(ArrayValue)
 
 
 class CompoundValue(BaseValue):
+    # Field values are held in a list indexed through the type's shared
+    # FieldLayout, rather than in a per-instance dict
+    __slots__ = ("mode", "data_type_id", "crc_base", "_tao", "_layout",
+                 "_codec", "_values", "_lazy", "_modified", "_exported",
+                 "_encoded")
+
     def __init__(self, uavcan_type, mode=None, tao=False, *args, **kwargs):
-        self.__dict__["fields"] = collections.OrderedDict()
-        self.__dict__["constants"] = {}
-        super(CompoundValue, self).__init__(uavcan_type, *args, **kwargs)
+        # New values are copied from the type's prototype rather than built
+        # up field by field
+        prototype(uavcan_type, mode, tao)._clone_into(self)
+
+    def _build(self, uavcan_type, mode, tao):
+        # Initializes an empty value from the type definition; only used to
+        # create prototypes
+        set_slot = super(CompoundValue, self).__setattr__
+        set_slot("_layout", field_layout(uavcan_type, mode))
+        set_slot("_codec", compile_codec(uavcan_type, mode))
+        set_slot("_lazy", None)
+        set_slot("_modified", next(_modifications))
+        set_slot("_exported", False)
+        set_slot("_encoded", None)
+        super(CompoundValue, self).__init__(uavcan_type)
         self.mode = mode
         self.data_type_id = self.type.default_dtid
         self.crc_base = ""
+        self._tao = tao
+
+        source_fields = compound_fields(self.type, self.mode)[0]
+        self._values = [
+            new_value(field.type, tao=tao and field is source_fields[-1])
+            for field in source_fields
+        ]
+
+    def serialized_size(self):
+        layout = self._layout
+        if self._lazy:
+            self._decode_lazy_fields()
+        encoded = self._cached_encoding()
+        if encoded and encoded[0] is not None:
+            return encoded[2]
+        size = layout.static_bitlen
+        for idx in layout.variable:
+            size += self._values[idx].serialized_size()
+        return size
+
+    def _clone(self):
+        value = CompoundValue.__new__(CompoundValue)
+        self._clone_into(value)
+        return value
 
-        source_fields = None
-        source_constants = None
-        if self.type.kind == dsdl.parser.CompoundType.KIND_SERVICE:
-            if self.mode == "request":
-                source_fields = self.type.request_fields
-                source_constants = self.type.request_constants
-            elif self.mode == "response":
-                source_fields = self.type.response_fields
-                source_constants = self.type.response_constants
-            else:
-                raise ValueError("mode must be either 'request' or " +
-                                 "'response' for service types")
-        else:
-            source_fields = self.type.fields
-            source_constants = self.type.constants
+    def _clone_into(self, value):
+        if self._lazy:
+            self._decode_lazy_fields()
+        set_slot = super(CompoundValue, value).__setattr__
+        set_slot("type", self.type)
+        set_slot("mode", self.mode)
+        set_slot("data_type_id", self.data_type_id)
+        set_slot("crc_base", self.crc_base)
+        set_slot("_tao", self._tao)
+        set_slot("_layout", self._layout)
+        set_slot("_codec", self._codec)
+        set_slot("_lazy", None)
+        set_slot("_modified", next(_modifications))
+        set_slot("_exported", False)
+        set_slot("_encoded", None)
+        set_slot("_values", [field._clone() for field in self._values])
+
+    def _last_modified(self):
+        # Latest modification stamp of the value or any field in it; fields
+        # handed out through `fields` may have been written at any time
+        if self._exported:
+            return next(_modifications)
+        modified = self._modified
+        values = self._values
+        for idx in self._layout.nested:
+            field_modified = values[idx]._last_modified()
+            if field_modified > modified:
+                modified = field_modified
+        return modified
+
+    def _cached_encoding(self):
+        # Returns the (data, offset, bitlen, stamp) record stored by the
+        # last _pack() if nothing in the value has changed since, or None.
+        # `data` is None if the encoded bits weren't kept.
+        encoded = self._encoded
+        if encoded is not None and self._last_modified() < encoded[3]:
+            return encoded
+        return None
 
-        for constant in source_constants:
-            self.constants[constant.name] = constant.value
+    @property
+    def fields(self):
+        """An ordered mapping of field names to their value objects. As
+        writes through these objects can't be seen, the value stops caching
+        its encoding; set fields as attributes where that matters."""
+        super(CompoundValue, self).__setattr__("_exported", True)
+        return collections.OrderedDict(zip(self._layout.names, self._values))
 
-        for field in source_fields:
-            atao = field is source_fields[-1] and tao
-            if isinstance(field.type, dsdl.parser.PrimitiveType):
-                self.fields[field.name] = PrimitiveValue(field.type)
-            elif isinstance(field.type, dsdl.parser.ArrayType):
-                self.fields[field.name] = ArrayValue(field.type, tao=atao)
-            elif isinstance(field.type, dsdl.parser.CompoundType):
-                self.fields[field.name] = CompoundValue(field.type, tao=atao)
+    @property
+    def constants(self):
+        "A mapping of constant names to values, shared by the whole type."
+        return self._layout.constants
 
     def __repr__(self):
+        if self._lazy:
+            self._decode_lazy_fields()
         fields = ", ".join("{0}={1!r}".format(f, v)
-                           for f, v in self.fields.items())
+                           for f, v in zip(self._layout.names, self._values))
         return "{0}({1})".format(self.type.full_name, fields)
 
     def __getattr__(self, attr):
-        if attr in self.constants:
-            return self.constants[attr]
-        elif attr in self.fields:
-            if isinstance(self.fields[attr], PrimitiveValue):
-                return self.fields[attr].value
+        # Only called for names that aren't slots, so private names can
+        # fail fast without recursing through an unset _layout
+        if attr.startswith("_"):
+            raise AttributeError(attr)
+        idx = self._layout.index.get(attr)
+        if idx is not None:
+            if self._lazy and attr in self._lazy.pending:
+                self._decode_lazy_field(attr)
+            field = self._values[idx]
+            if isinstance(field, PrimitiveValue):
+                return field.value
             else:
-                return self.fields[attr]
+                return field
+        elif attr in self._layout.constants:
+            return self._layout.constants[attr]
         else:
             raise AttributeError(attr)
 
     def __setattr__(self, attr, value):
-        if attr in self.constants:
+        idx = self._layout.index.get(attr)
+        if attr in self._layout.constants:
             raise AttributeError(attr + " is read-only")
-        elif attr in self.fields:
-            if isinstance(self.fields[attr].type, dsdl.parser.PrimitiveType):
-                self.fields[attr].value = value
+        elif idx is not None:
+            field = self._values[idx]
+            if isinstance(field, PrimitiveValue):
+                # Setting a field to its current value doesn't count as a
+                # modification, so cached encodings remain usable
+                raw = raw_from_value(value, field.type)
+                if raw != field._raw:
+                    field._raw = raw
+                    super(CompoundValue, self).__setattr__(
+                        "_modified", next(_modifications))
+                if self._lazy:
+                    self._lazy.pending.discard(attr)
             else:
                 raise AttributeError(attr + " cannot be set directly")
         else:
             super(CompoundValue, self).__setattr__(attr, value)
 
-    def unpack(self, stream):
-        for field in self.fields.itervalues():
-            stream = field.unpack(stream)
-        return stream
-
-    def pack(self):
-        return "".join(field.pack() for field in self.fields.itervalues())
+    def unpack_lazy(self, buffer, offset=0, bitlen=None):
+        """Binds the value to the serialized data in `buffer` starting
+        `offset` bits in, without decoding anything. Each field is decoded
+        the first time it is accessed, so fields that are never read cost
+        nothing. `bitlen` is the total length of the buffer in bits, if
+        not all of it is valid."""
+        if bitlen is None:
+            bitlen = len(buffer) * 8
+        self._lazy = _LazyState(field_layout(self.type, self.mode), buffer,
+                                offset, bitlen)
+        self._modified = next(_modifications)
+
+    def _lazy_offset(self, idx):
+        # Returns the absolute bit offset of field `idx` in the bound data,
+        # or of the end of the value if `idx` is the number of fields,
+        # decoding preceding variable-length fields as necessary
+        lazy = self._lazy
+        if lazy.offsets[idx] is None:
+            start = self._lazy_offset(idx - 1)
+            name = lazy.layout.names[idx - 1]
+            field = self._values[idx - 1]
+            if lazy.layout.bitlens[idx - 1] is not None:
+                lazy.offsets[idx] = start + lazy.layout.bitlens[idx - 1]
+                return lazy.offsets[idx]
+
+            if isinstance(field, CompoundValue) and name in lazy.pending:
+                self._decode_lazy_field(name)
+            if isinstance(field, CompoundValue) and field._lazy:
+                lazy.offsets[idx] = field._lazy_offset(
+                    len(field._lazy.layout.names))
+            else:
+                # Variable-length fields record their end offset when they
+                # are decoded
+                self._decode_lazy_field(name)
+        return lazy.offsets[idx]
+
+    def _decode_lazy_field(self, name):
+        lazy = self._lazy
+        idx = lazy.layout.index[name]
+        start = self._lazy_offset(idx)
+        field = self._values[idx]
+        if name in lazy.pending and isinstance(field, CompoundValue):
+            # Nested compounds are bound lazily in turn
+            field.unpack_lazy(lazy.data, start, lazy.bitlen)
+        else:
+            stream = BitStreamReader(lazy.data, start, lazy.bitlen)
+            if name in lazy.pending:
+                field._unpack(stream)
+            else:
+                # Already decoded or overwritten; skip over its data
+                type(field)(field.type, tao=field._tao)._unpack(stream)
+            lazy.offsets[idx + 1] = stream.offset
+        lazy.pending.discard(name)
+
+    def _decode_lazy_fields(self):
+        lazy = self._lazy
+        if len(lazy.pending) == len(lazy.layout.names):
+            stream = BitStreamReader(lazy.data, lazy.offsets[0], lazy.bitlen)
+            self._codec[0](self, stream)
+            lazy.offsets[-1] = stream.offset
+            lazy.pending.clear()
+        else:
+            for name in lazy.layout.names:
+                if name in lazy.pending:
+                    self._decode_lazy_field(name)
+        for field in self._values:
+            if isinstance(field, CompoundValue) and field._lazy:
+                field._decode_lazy_fields()
+
+    def _unpack(self, stream):
+        self._lazy = None
+        self._modified = next(_modifications)
+        self._codec[0](self, stream)
+
+    def _pack(self, stream):
+        # Values that haven't changed since they were last encoded write
+        # out the bits cached then
+        if self._lazy:
+            self._decode_lazy_fields()
+        encoded = self._cached_encoding()
+        if encoded and encoded[0] is not None:
+            stream.write_from(encoded[0], encoded[1], encoded[2])
+            return
+
+        start = stream.bitlen
+        self._codec[1](self, stream)
+        # The bits are only kept once the value is seen being encoded again
+        # unchanged, so values that change every time don't pay for copying
+        set_slot = super(CompoundValue, self).__setattr__
+        if encoded:
+            set_slot("_encoded", (stream.getvalue(start), start & 7,
+                                  stream.bitlen - start,
+                                  next(_modifications)))
+        else:
+            set_slot("_encoded", (None, None, None, next(_modifications)))
+
+
+def prototype(uavcan_type, mode=None, tao=False):
+    """Returns the empty CompoundValue that new values of a compound type
+    are cloned from, building it on first use. Prototypes are cached on the
+    type object and must not be modified."""
+    prototypes = getattr(uavcan_type, "_prototypes", None)
+    if prototypes is None:
+        prototypes = uavcan_type._prototypes = {}
+    key = (mode, tao)
+    if key not in prototypes:
+        value = CompoundValue.__new__(CompoundValue)
+        value._build(uavcan_type, mode, tao)
+        prototypes[key] = value
+    return prototypes[key]
+
+
+def new_value(uavcan_type, tao=False):
+    "Creates an empty value object of the class matching `uavcan_type`."
+    if isinstance(uavcan_type, dsdl.parser.PrimitiveType):
+        return PrimitiveValue(uavcan_type)
+    elif isinstance(uavcan_type, dsdl.parser.ArrayType):
+        return ArrayValue(uavcan_type, tao=tao)
+    elif isinstance(uavcan_type, dsdl.parser.CompoundType):
+        return CompoundValue(uavcan_type, tao=tao)
 
 
 class Frame(object):
+    __slots__ = ("message_id", "bytes")
+
     def __init__(self, message_id, bytes):
         self.message_id = message_id
-        self.bytes = bytearray(bytes)
+        # A bytearray is taken over rather than copied
+        self.bytes = bytes if isinstance(bytes, bytearray) \
+                     else bytearray(bytes)
 
     @property
     def transfer_key(self):
@@ -400,13 +1385,23 @@ class Frame(object):
     def start_of_transfer(self):
         return bool(self.bytes[-1] & 0x80)
 
+    def to_bytes(self):
+        return bytes(self.bytes)
+
 
 class Transfer(object):
+    __slots__ = ("transfer_priority", "transfer_id", "source_node_id",
+                 "data_type_id", "dest_node_id", "discriminator",
+                 "data_type_signature", "data_type_crc",
+                 "request_not_response", "service_not_message", "payload",
+                 "is_complete", "_tx_data", "_message_id")
+
     def __init__(self, transfer_id=0, source_node_id=0, data_type_id=0,
                  dest_node_id=None, payload=0, transfer_priority=31,
                  request_not_response=False, service_not_message=False,
                  discriminator=None):
         self.transfer_priority = transfer_priority
+        self.discriminator = discriminator
         self.transfer_id = transfer_id
         self.source_node_id = source_node_id
         self.data_type_id = data_type_id
@@ -414,16 +1409,22 @@ class Transfer(object):
         self.data_type_signature = 0
         self.request_not_response = request_not_response
         self.service_not_message = service_not_message
+        # (ID fields, CAN ID) as of the last message_id computation
+        self._message_id = None
 
         if payload:
-            payload_bits = payload.pack()
-            if len(payload_bits) & 7:
-                payload_bits += "0" * (8 - (len(payload_bits) & 7))
-            self.payload = bytes_from_bits(payload_bits)
+            # Serialize straight into the buffer the frames are cut from,
+            # leaving room for the transfer CRC if it will be needed
+            size = (payload.serialized_size() + 7) >> 3
+            crc_size = 2 if size > 7 else 0
+            self._tx_data = bytearray(crc_size + size)
+            payload.pack_into(self._tx_data, crc_size * 8)
+            self.payload = payload
             self.data_type_id = payload.type.default_dtid
             self.data_type_signature = payload.type.get_data_type_signature()
             self.data_type_crc = payload.type.base_crc
         else:
+            self._tx_data = None
             self.payload = None
             self.data_type_id = None
             self.data_type_signature = None
@@ -431,8 +1432,31 @@ class Transfer(object):
 
         self.is_complete = True if self.payload else False
 
+    def is_broadcast(self):
+        return not self.service_not_message
+
+    def is_request(self):
+        return self.service_not_message and self.request_not_response
+
+    def is_response(self):
+        return self.service_not_message and not self.request_not_response
+
+    def _id_fields(self):
+        return (self.transfer_priority, self.service_not_message,
+                self.source_node_id, self.data_type_id,
+                self.request_not_response, self.dest_node_id,
+                self.discriminator)
+
     @property
     def message_id(self):
+        # The ID is the same for every frame of the transfer, so it is
+        # computed on first use and kept for as long as the fields it is
+        # made from stay the same
+        fields = self._id_fields()
+        cached = self._message_id
+        if cached is not None and cached[0] == fields:
+            return cached[1]
+
         # Common fields
         id_ = (((self.transfer_priority & 0x1F) << 24) |
                (int(self.service_not_message) << 7) |
@@ -440,22 +1464,23 @@ class Transfer(object):
 
         if self.service_not_message:
             assert 0 <= self.data_type_id <= 0xFF
-            assert 1 <= self.destination_node_id <= 0x7F
+            assert 1 <= self.dest_node_id <= 0x7F
             # Service frame format
             id_ |= self.data_type_id << 16
             id_ |= int(self.request_not_response) << 15
-            id_ |= self.destination_node_id << 8
-        elif self.source_node_id == 0:
-            assert self.destination_node_id is None
+            id_ |= self.dest_node_id << 8
+        elif not self.source_node_id:
+            assert self.dest_node_id is None
             assert self.discriminator is not None
             # Anonymous message frame format
             id_ |= self.discriminator << 10
             id_ |= (self.data_type_id & 0x3) << 8
         else:
-            assert 0 <= self.message_type_id <= 0xFFFF
+            assert 0 <= self.data_type_id <= 0xFFFF
             # Message frame format
             id_ |= self.data_type_id << 8
 
+        self._message_id = (fields, id_)
         return id_
 
     @message_id.setter
@@ -467,107 +1492,113 @@ class Transfer(object):
         if self.service_not_message:
             self.data_type_id = (value >> 16) & 0xFF
             self.request_not_response = bool(value & 0x8000)
-            self.destination_node_id = (value >> 8) & 0x7F
+            self.dest_node_id = (value >> 8) & 0x7F
+            self.discriminator = None
         elif self.source_node_id == 0:
             self.discriminator = (value >> 10) & 0x3FFF
             self.data_type_id = (value >> 8) & 0x3
+            self.dest_node_id = None
         else:
             self.data_type_id = (value >> 8) & 0xFFFF
+            self.dest_node_id = None
+            self.discriminator = None
+
+        self._message_id = (self._id_fields(), value & 0x1FFFFFFF)
+
+    def iter_frames(self):
+        """Yields the transfer's frames one at a time, each cut from the
+        serialized payload only when it is asked for, so the first can be
+        sent without building the others."""
+        data = self._tx_data
+
+        # Multi-frame transfers start with the transfer CRC, for which
+        # Transfer.__init__ left two bytes free
+        if len(data) > 7:
+            crc = common.crc16_update(self.data_type_crc,
+                                      memoryview(data)[2:])
+            data[0] = crc & 0xFF
+            data[1] = crc >> 8
+
+        # Generate the frame sequence. Tail bytes contain start-of-transfer,
+        # end-of-transfer, toggle, and Transfer ID; apart from the first and
+        # last frames they alternate between the two toggle values.
+        message_id = self.message_id
+        transfer_id = self.transfer_id & 0x1F
+        tails = (transfer_id, transfer_id | 0x20)
+        last = max(len(data) - 1, 0) // 7
+        for index in xrange(last + 1):
+            frame_bytes = data[index * 7:index * 7 + 7]
+            tail = tails[index & 1]
+            if index == 0:
+                tail |= 0x80
+            if index == last:
+                tail |= 0x40
+            frame_bytes.append(tail)
+            yield Frame(message_id, frame_bytes)
 
     def to_frames(self):
-        out_frames = []
-        remaining_payload = self.payload
-
-        # Prepend the transfer CRC to the payload if the transfer requires
-        # multiple frames
-        if len(remaining_payload) > 7:
-            crc = common.crc16_from_bytes(self.payload,
-                                          initial=self.data_type_crc)
-            remaining_payload = bytearray([crc & 0xFF, crc >> 8]) + \
-                                remaining_payload
-
-        # Generate the frame sequence
-        tail = 0x20  # set toggle bit high so the first frame is emitted with
-                     # it cleared
-        while True:
-            # Tail byte contains start-of-transfer, end-of-transfer, toggle,
-            # and Transfer ID
-            tail = ((0x80 if not out_frames else 0) |
-                    (0x40 if len(remaining_payload) <= 7 else 0) |
-                    (tail ^ 0x20) |
-                    (self.transfer_id & 0x1F))
-            out_frames.append(Frame(message_id=self.message_id,
-                                    bytes=remaining_payload[0:7] +
-                                          bytearray(tail)))
-            remaining_payload = remaining_payload[7:]
-            if not remaining_payload:
-                break
-
-        return out_frames
-
-    def from_frames(self, frames):
-        # Validate the flags in the tail byte
-        expected_toggle = 0
-        expected_transfer_id = frames[0].bytes[-1] & 0x1F
-        for idx, f in enumerate(frames):
-            tail = f.bytes[-1]
-            if (tail & 0x1F) != expected_transfer_id:
-                raise ValueError(("Transfer ID {0} incorrect, expected " +
-                                  "{1}").format(
-                                  tail & 0x1F, expected_transfer_id))
-            elif idx == 0 and not (tail & 0x80):
-                raise ValueError("Start of transmission not set on frame 0")
-            elif tail & 0x80:
-                raise ValueError(("Start of transmission set unexpectedly " +
-                                  "on frame {0}").format(idx))
-            elif idx == len(frames) - 1 and not (tail & 0x40):
-                raise ValueError("End of transmission not set on last frame")
-            elif tail & 0x40:
+        return list(self.iter_frames())
+
+    def from_frames(self, frames, lazy=False):
+        """Reassembles and decodes the transfer made up of `frames`. If
+        `lazy` is set, the payload's fields are decoded on first access
+        (see CompoundValue.unpack_lazy)."""
+        reassembly = TransferReassembly(frames[0], self)
+        for idx, f in enumerate(frames[1:], 1):
+            if reassembly.complete:
                 raise ValueError(("End of transmission set unexpectedly " +
-                                  "on frame {0}").format(idx))
-            elif (tail & 0x20) != last_toggle:
-                raise ValueError(("Toggle bit value {0} incorrect on frame " +
-                                  "{1}").format(tail & 0x20, idx))
-
-            expected_toggle ^= 0x20
-
-        self.message_id = frames[0].message_id
-        payload_bytes = sum((f.bytes[0:-1] for f in frames), bytearray())
-
-        # Find the data type
+                                  "on frame {0}").format(idx - 1))
+            reassembly.add(f)
+        if not reassembly.complete:
+            raise ValueError("End of transmission not set on last frame")
+
+        reassembly.decode(lazy)
+
+    def from_frame(self, frame, lazy=False):
+        """Decodes a single-frame transfer (one with both the start and end
+        of transfer flags set) straight from `frame`. Such transfers carry
+        no transfer CRC and need no reassembly."""
+        tail = frame.bytes[-1]
+        if tail & 0xE0 != 0xC0:
+            raise ValueError(("Tail byte {0:02x} is not that of a " +
+                              "single-frame transfer").format(tail))
+
+        self.message_id = frame.message_id
+        self.transfer_id = tail & 0x1F
+        self._decode(self._find_datatype(), frame.bytes[0:-1], lazy)
+
+    def _find_datatype(self):
         if self.service_not_message:
             kind = dsdl.parser.CompoundType.KIND_SERVICE
         else:
             kind = dsdl.parser.CompoundType.KIND_MESSAGE
         datatype = uavcan.DATATYPES.get((self.data_type_id, kind))
-        if not datatype:
-            raise ValueError("Unrecognised {0} type ID {0}".format(
+        if datatype is None:
+            raise ValueError("Unrecognised {0} type ID {1:d}".format(
                              "service" if self.service_not_message
                                        else "message",
                              self.data_type_id))
+        return datatype
 
-        # For a multi-frame transfer, validate the CRC and frame indexes
-        if len(frames) > 1:
-            transfer_crc = payload_bytes[0] + (payload_bytes[1] << 8)
-            payload_bytes = payload_bytes[2:]
-            crc = common.crc16_from_bytes(payload_bytes,
-                                          initial=datatype.base_crc)
-            if crc != transfer_crc:
-                raise ValueError(("CRC mismatch: expected {0:x}, got {1:x} " +
-                                  "for payload {2!r} (DTID {3:d})").format(
-                                  crc, transfer_crc, payload_bytes,
-                                  self.data_type_id))
-
+    def _set_datatype(self, datatype):
         self.data_type_id = datatype.default_dtid
         self.data_type_signature = datatype.get_data_type_signature()
         self.data_type_crc = datatype.base_crc
 
+    def _new_payload(self, datatype):
         if self.service_not_message:
-            self.payload = datatype(
-                mode="request" if self.reqeust_not_response else "response")
+            return datatype(
+                mode="request" if self.request_not_response else "response")
         else:
-            self.payload = datatype()
-        self.payload.unpack(transport.bits_from_bytes(payload_bytes))
+            return datatype()
+
+    def _decode(self, datatype, payload_bytes, lazy):
+        self._set_datatype(datatype)
+        self.payload = self._new_payload(datatype)
+        if lazy:
+            self.payload.unpack_lazy(payload_bytes)
+        else:
+            self.payload.unpack_from(payload_bytes)
 
     @property
     def key(self):
@@ -586,29 +1617,284 @@ class Transfer(object):
             return False
 
 
-class TransferManager(object):
+class StreamingDecoder(object):
+    """Decodes a compound value's top-level fields from a buffer that is
+    still being filled, each as soon as the buffer holds all of it.
+
+    Fields of fixed length are decoded once enough bits have arrived.
+    Variable-length fields are attempted each time the buffer grows, and
+    decoded again from the start on the next attempt if data ran out. The
+    last field may be a tail array, whose length is only known at the end,
+    so if it is variable-length it waits for finish()."""
+    __slots__ = ("value", "data", "index", "offset")
+
+    def __init__(self, value, data, offset=0):
+        self.value = value
+        self.data = data
+        # Next field to decode, and the bit offset it starts at
+        self.index = 0
+        self.offset = offset
+
+    def advance(self, final=False):
+        """Decodes the fields the buffer now holds in full. With `final`
+        set, the buffer is complete and every remaining field is decoded,
+        raising ValueError if the data runs out."""
+        layout = self.value._layout
+        values = self.value._values
+        last = len(values) - 1
+        bitlen = len(self.data) * 8
+        while self.index <= last:
+            idx = self.index
+            fixed = layout.bitlens[idx]
+            if not final:
+                if fixed is not None:
+                    if self.offset + fixed > bitlen:
+                        break
+                elif idx == last or \
+                        self._incomplete_array(values[idx], bitlen):
+                    break
+
+            stream = BitStreamReader(self.data, self.offset, bitlen)
+            try:
+                values[idx]._unpack(stream)
+            except ValueError:
+                if final:
+                    raise
+                break  # Not all there yet
+            self.offset = stream.offset
+            self.index += 1
+
+    def _incomplete_array(self, field, bitlen):
+        # Returns True if `field` is a dynamic array of primitives whose
+        # length prefix shows it isn't all in the first `bitlen` bits yet,
+        # so it isn't decoded only to run out of data
+        if not isinstance(field, ArrayValue) or \
+                not isinstance(field.type.value_type,
+                               dsdl.parser.PrimitiveType):
+            return False
+        prefix_bitlen = field.type.max_size.bit_length()
+        if self.offset + prefix_bitlen > bitlen:
+            return True
+        count = BitStreamReader(self.data, self.offset, bitlen).read(
+            prefix_bitlen)
+        return self.offset + prefix_bitlen + \
+               count * field.type.value_type.bitlen > bitlen
+
+    def finish(self):
+        """Decodes the remaining fields from the complete buffer and returns
+        the value."""
+        self.advance(final=True)
+        self.value._lazy = None
+        self.value._modified = next(_modifications)
+        return self.value
+
+
+class TransferReassembly(object):
+    """Reassembles a transfer frame by frame. The payload of each frame is
+    appended to a single buffer, and the tail byte and the transfer CRC are
+    checked as each frame arrives, so completing the transfer needs no
+    further pass over its frames.
+
+    The first frame fixes the CAN ID, Transfer ID and data type, all of
+    which are recorded in `transfer`; `complete` is set once the frame with
+    the end of transfer flag has been added.
+
+    With `streaming` set, the payload of a multi-frame transfer is decoded
+    field by field as frames arrive (see StreamingDecoder), leaving only
+    the last fields for decode(). The partly decoded value is only handed
+    over once the transfer CRC has matched, and is discarded otherwise."""
+    __slots__ = ("transfer", "datatype", "data", "crc", "transfer_crc",
+                 "toggle", "complete", "decoder")
+
+    def __init__(self, frame, transfer=None, streaming=False):
+        tail = frame.bytes[-1]
+        if not tail & 0x80:
+            raise ValueError("Start of transmission not set on frame 0")
+        elif tail & 0x20:
+            raise ValueError(("Toggle bit value {0} incorrect on frame " +
+                              "0").format(tail & 0x20))
+
+        self.transfer = transfer if transfer is not None else Transfer()
+        self.transfer.message_id = frame.message_id
+        self.transfer.transfer_id = tail & 0x1F
+        self.datatype = self.transfer._find_datatype()
+        self.toggle = 0x20
+        self.decoder = None
+
+        if tail & 0x40:
+            # Single-frame transfers carry no transfer CRC
+            self.data = frame.bytes[0:-1]
+            self.crc = self.transfer_crc = None
+            self.complete = True
+        else:
+            # The first two bytes of the first frame hold the transfer CRC;
+            # leave them out of the reassembled payload
+            if len(frame.bytes) < 3:
+                raise ValueError("Frame 0 too short for the transfer CRC")
+            self.transfer_crc = frame.bytes[0] | (frame.bytes[1] << 8)
+            self.data = frame.bytes[2:-1]
+            self.crc = common.crc16_update(self.datatype.base_crc, self.data)
+            self.complete = False
+            if streaming:
+                self.decoder = StreamingDecoder(
+                    self.transfer._new_payload(self.datatype), self.data)
+                self.decoder.advance()
+
+    def add(self, frame):
+        """Appends the next frame of the transfer. Returns True if it
+        completed the transfer; raises ValueError if the frame does not
+        belong where it was added, or the transfer CRC does not match."""
+        tail = frame.bytes[-1]
+        if self.complete:
+            raise ValueError("Transfer already complete")
+        elif (tail & 0x1F) != self.transfer.transfer_id:
+            raise ValueError(("Transfer ID {0} incorrect, expected " +
+                              "{1}").format(
+                              tail & 0x1F, self.transfer.transfer_id))
+        elif tail & 0x80:
+            raise ValueError("Start of transmission set unexpectedly")
+        elif (tail & 0x20) != self.toggle:
+            raise ValueError("Toggle bit value {0} incorrect".format(
+                             tail & 0x20))
+
+        payload = frame.bytes[0:-1]
+        self.data += payload
+        self.crc = common.crc16_update(self.crc, payload)
+        self.toggle ^= 0x20
+
+        if tail & 0x40:
+            if self.crc != self.transfer_crc:
+                self.decoder = None
+                raise ValueError(("CRC mismatch: expected {0:x}, got {1:x} " +
+                                  "for payload {2!r} (DTID {3:d})").format(
+                                  self.crc, self.transfer_crc, self.data,
+                                  self.transfer.data_type_id))
+            self.complete = True
+        elif self.decoder is not None:
+            self.decoder.advance()
+        return self.complete
+
+    def decode(self, lazy=False):
+        """Decodes the payload of the complete transfer into
+        `transfer.payload`, and returns the transfer. Streamed payloads are
+        finished rather than decoded lazily."""
+        if self.decoder is not None:
+            self.transfer._set_datatype(self.datatype)
+            self.transfer.payload = self.decoder.finish()
+        else:
+            self.transfer._decode(self.datatype, self.data, lazy)
+        return self.transfer
+
+
+class DeadlineQueue(object):
+    """Tracks a deadline per key and returns the keys whose deadline has
+    passed in O(log n) per expired key, without scanning the others.
+
+    Deadlines live in a min-heap with lazy removal: cancelling a key or
+    moving its deadline later only updates a dict, and superseded heap
+    entries are discarded (or pushed back with the current deadline) as
+    they reach the top."""
+    __slots__ = ("_heap", "_deadlines")
+
     def __init__(self):
-        self.active_transfers = collections.defaultdict(list)
-        self.active_transfer_timestamps = {}
+        self._heap = []
+        self._deadlines = {}
+
+    def __len__(self):
+        return len(self._deadlines)
+
+    def __contains__(self, key):
+        return key in self._deadlines
+
+    def schedule(self, key, deadline):
+        """Sets the deadline of `key`, replacing any previous one."""
+        current = self._deadlines.get(key)
+        self._deadlines[key] = deadline
+        if current is None or deadline < current:
+            heapq.heappush(self._heap, (deadline, key))
+
+    def cancel(self, key):
+        self._deadlines.pop(key, None)
+
+    def next_deadline(self):
+        """Returns the earliest deadline, or None if there is none."""
+        heap, deadlines = self._heap, self._deadlines
+        while heap and deadlines.get(heap[0][1]) != heap[0][0]:
+            deadline, key = heapq.heappop(heap)
+            if key in deadlines:
+                heapq.heappush(heap, (deadlines[key], key))
+        return heap[0][0] if heap else None
+
+    def expire(self, now):
+        """Removes and returns the keys with a deadline of `now` or
+        earlier, earliest first."""
+        heap, deadlines = self._heap, self._deadlines
+        expired = []
+        while heap and heap[0][0] <= now:
+            deadline, key = heapq.heappop(heap)
+            current = deadlines.get(key)
+            if current is None:
+                continue  # Cancelled
+            elif current <= now:
+                del deadlines[key]
+                expired.append(key)
+            elif current != deadline:
+                heapq.heappush(heap, (current, key))
+        return expired
+
+
+class TransferManager(object):
+    def __init__(self, timeout=1.0, streaming=False):
+        # TransferReassembly objects by transfer key
+        self.active_transfers = {}
+        # Partial transfers are dropped if no frame arrives for `timeout`
+        # seconds
+        self.timeout = timeout
+        self.deadlines = DeadlineQueue()
+        # Decode payloads as their frames arrive
+        self.streaming = streaming
 
     def receive_frame(self, frame):
+        """Adds `frame` to the transfer it belongs to, and returns that
+        transfer's TransferReassembly if the frame completed it, or None
+        otherwise. Raises ValueError if the frame was out of sequence or the
+        transfer CRC did not match, dropping the transfer."""
         key = frame.transfer_key
-        self.active_transfers[key].append(frame)
-        self.active_transfer_timestamps[key] = time.time()
-
-        # If the last frame of a transfer was received, return its frames
-        result = None
-        if frame.last_frame:
-            result = self.active_transfers[key]
-            del self.active_transfers[key]
-            del self.active_transfer_timestamps[key]
-
-        return result
-
-    def remove_inactive_transfers(self, timeout=1.0):
-        t = time.time()
-        transfer_keys = self.active_transfers.keys()
-        for key in transfer_keys:
-            if t - self.active_transfer_timestamps[key] > timeout:
+
+        if frame.bytes[-1] & 0x80:
+            # A start frame replaces any partial transfer with the same key
+            self.active_transfers.pop(key, None)
+            reassembly = TransferReassembly(frame, streaming=self.streaming)
+        else:
+            reassembly = self.active_transfers.get(key)
+            if reassembly is None:
+                return None  # The start of the transfer was missed
+            try:
+                reassembly.add(frame)
+            except ValueError:
                 del self.active_transfers[key]
-                del self.active_transfer_timestamps[key]
+                self.deadlines.cancel(key)
+                raise
+
+        if reassembly.complete:
+            self.active_transfers.pop(key, None)
+            self.deadlines.cancel(key)
+            return reassembly
+
+        self.active_transfers[key] = reassembly
+        self.deadlines.schedule(key, time.time() + self.timeout)
+        return None
+
+    def remove_inactive_transfers(self, timeout=None, now=None):
+        """Drops the partial transfers that have received no frame for
+        `timeout` seconds (the manager's timeout by default) as of `now`,
+        and returns their keys."""
+        if now is None:
+            now = time.time()
+        # Deadlines are scheduled `self.timeout` after the last frame
+        if timeout is not None:
+            now += self.timeout - timeout
+        expired = self.deadlines.expire(now)
+        for key in expired:
+            self.active_transfers.pop(key, None)
+        return expired